@@ -1,10 +1,11 @@
-import copy
 import json
 import os
 import logging
 import uuid
+import time
 import httpx
 import asyncio
+from importlib.util import find_spec
 from quart import (
     Blueprint,
     Quart,
@@ -14,26 +15,78 @@ from quart import (
     send_from_directory,
     render_template,
     current_app,
+    g,
 )
 
 from openai import AsyncAzureOpenAI
-from azure.identity.aio import (
-    DefaultAzureCredential,
-    get_bearer_token_provider
-)
+from opentelemetry.trace import SpanKind
+from azure.identity.aio import DefaultAzureCredential
 from backend.auth.auth_utils import get_authenticated_user_details
+from backend.auth.token_cache import CachedTokenCredential, COGNITIVE_SERVICES_SCOPE
+from backend.aoai.admission import DeploymentAdmission
+from backend.aoai.cache import (
+    ResponseCache,
+    cached_completion,
+    record_stream,
+    response_cache_key,
+)
+from backend.aoai.semantic_cache import (
+    AzureOpenAIEmbedder,
+    SemanticCache,
+    first_question,
+    semantic_scope_key,
+)
+from backend.aoai.routing import Deployment, DeploymentRouter
+from backend.metrics import (
+    count_error,
+    observe_chat_completion,
+    observe_chat_stream,
+    render_metrics,
+)
+from backend.server_timing import (
+    append_server_timing_frame,
+    current_server_timing,
+    server_timing,
+    start_server_timing,
+)
+from backend.tracing import (
+    configure_tracing,
+    end_request_span,
+    inject_httpx_trace_context,
+    span,
+    start_request_span,
+    trace_stream,
+    traced,
+)
 from backend.security.ms_defender_utils import get_msdefender_user_json
-from backend.history.cosmosdbservice import CosmosConversationClient
+from backend.history.cosmosdbservice import (
+    ConversationCache,
+    ConversationListCache,
+    CosmosConversationClient,
+)
+from backend.history.memorystore import InMemoryConversationClient
+from backend.history.store import InvalidContinuationToken, is_stale_deletion_job
 from backend.settings import (
     app_settings,
     MINIMUM_SUPPORTED_AZURE_OPENAI_PREVIEW_API_VERSION
 )
 from backend.utils import (
+    STREAM_MIMETYPE,
+    ClosingStream,
+    close_stream,
+    coalesce_stream_frames,
     format_as_ndjson,
+    format_delta_stream,
+    negotiate_stream_version,
     format_stream_response,
     format_non_streaming_response,
+    format_raw_stream_response,
     convert_to_pf_format,
     format_pf_non_streaming_response,
+    format_pf_stream_response,
+    heuristic_title,
+    iter_sse_data,
+    redact_secrets,
 )
 
 bp = Blueprint("routes", __name__, static_folder="static", template_folder="static")
@@ -41,6 +94,38 @@ bp = Blueprint("routes", __name__, static_folder="static", template_folder="stat
 cosmos_db_ready = asyncio.Event()
 
 
+@bp.before_request
+async def start_request_timer():
+    g.request_start = time.perf_counter()
+    if app_settings.base_settings.server_timing_enabled:
+        start_server_timing(g.request_start)
+    g.request_span, g.trace_token = start_request_span(
+        request.method, request.url_rule.rule if request.url_rule else request.path, request.headers
+    )
+
+
+@bp.after_request
+async def count_error_responses(response):
+    if response.status_code >= 400:
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        count_error(route, response.status_code)
+    return response
+
+
+@bp.after_request
+async def add_server_timing_header(response):
+    timing = current_server_timing()
+    if timing:
+        response.headers["Server-Timing"] = timing.header()
+    return response
+
+
+@bp.after_request
+async def end_request_trace(response):
+    end_request_span(g.pop("request_span", None), g.pop("trace_token", None), response.status_code)
+    return response
+
+
 def create_app():
     app = Quart(__name__)
     app.register_blueprint(bp)
@@ -48,13 +133,96 @@ def create_app():
     
     @app.before_serving
     async def init():
+        app.tracer_provider = configure_tracing(app_settings.tracing)
+
+        # Single Entra ID credential whose tokens are cached and refreshed
+        # in the background for both Azure OpenAI and CosmosDB
+        app.azure_credential = CachedTokenCredential(DefaultAzureCredential())
+        if not app_settings.azure_openai.key:
+            app.azure_credential.warm_up(COGNITIVE_SERVICES_SCOPE)
+
         try:
-            app.cosmos_conversation_client = await init_cosmosdb_client()
+            app.azure_openai_client = await init_openai_client(app.azure_credential)
+            app.deployment_router = await init_deployment_router(
+                app.azure_credential, app.azure_openai_client
+            )
+        except Exception:
+            logging.exception("Failed to initialize Azure OpenAI client")
+            app.azure_openai_client = None
+            app.deployment_router = None
+
+        if app_settings.datasource:
+            app_settings.datasource.compile_payload_configuration()
+
+        app.response_cache = init_response_cache()
+        app.semantic_cache = await init_semantic_cache(
+            app.azure_credential, app.azure_openai_client
+        )
+
+        if app_settings.base_settings.use_promptflow:
+            app.promptflow_client = init_promptflow_client()
+
+        try:
+            app.cosmos_conversation_client = await init_cosmosdb_client(app.azure_credential)
             cosmos_db_ready.set()
         except Exception as e:
             logging.exception("Failed to initialize CosmosDB client")
             app.cosmos_conversation_client = None
             raise e
+
+    @app.after_serving
+    async def shutdown():
+        if getattr(app, "deployment_router", None):
+            for deployment in app.deployment_router.deployments:
+                logging.debug(
+                    f"Admission stats for {deployment.name}: {deployment.admission.stats.snapshot()}"
+                )
+                if deployment.client is not app.azure_openai_client:
+                    await deployment.client.close()
+            app.deployment_router = None
+
+        if getattr(app, "azure_openai_client", None):
+            await app.azure_openai_client.close()
+            app.azure_openai_client = None
+
+        if getattr(app, "cosmos_conversation_client", None):
+            cosmos_client = app.cosmos_conversation_client
+            logging.debug(f"Chat history stats: {cosmos_client.stats.snapshot()}")
+            if getattr(cosmos_client, "conversation_cache", None):
+                logging.debug(
+                    f"Conversation cache: {cosmos_client.conversation_cache.hits} hits, "
+                    f"{cosmos_client.conversation_cache.misses} misses"
+                )
+            if getattr(cosmos_client, "conversation_list_cache", None):
+                list_cache = cosmos_client.conversation_list_cache
+                logging.debug(
+                    f"Conversation list cache: {list_cache.hits} hits, {list_cache.misses} misses, "
+                    f"{list_cache.request_charge_saved:.1f} RU saved"
+                )
+            await cosmos_client.close()
+            app.cosmos_conversation_client = None
+
+        if getattr(app, "response_cache", None):
+            logging.debug(f"Response cache stats: {app.response_cache.stats.snapshot()}")
+
+        if getattr(app, "semantic_cache", None):
+            logging.debug(f"Semantic cache stats: {app.semantic_cache.stats.snapshot()}")
+            await app.semantic_cache.close()
+            app.semantic_cache = None
+
+        if getattr(app, "promptflow_client", None):
+            await app.promptflow_client.aclose()
+            app.promptflow_client = None
+
+        if getattr(app, "azure_credential", None):
+            logging.debug(f"Token cache stats: {app.azure_credential.stats.snapshot()}")
+            await app.azure_credential.close()
+            app.azure_credential = None
+
+        if getattr(app, "tracer_provider", None):
+            # Exports the spans still buffered
+            app.tracer_provider.shutdown()
+            app.tracer_provider = None
     
     return app
 
@@ -85,6 +253,20 @@ if DEBUG.lower() == "true":
 
 USER_AGENT = "GitHubSampleWebApp/AsyncAzureOpenAI/1.0.0"
 
+# How long the end of an answer stream waits for the generated title of a
+# new conversation before leaving it to the history list
+TITLE_FRAME_MAX_WAIT = 5.0
+
+# Conversations per /history/list page; the cursor of the next page is
+# returned in this header
+HISTORY_PAGE_SIZE = 25
+CONTINUATION_TOKEN_HEADER = "X-Continuation-Token"
+INVALID_CONTINUATION_TOKEN_ERROR = "continuation_token is invalid or has expired"
+
+# Deletes of more documents than this run as a background job; the request
+# returns 202 with the job id to poll /history/delete_status with
+BACKGROUND_DELETE_THRESHOLD = 100
+
 
 # Frontend Settings via Environment Variables
 frontend_settings = {
@@ -112,8 +294,10 @@ MS_DEFENDER_ENABLED = os.environ.get("MS_DEFENDER_ENABLED", "true").lower() == "
 
 
 # Initialize Azure OpenAI Client
-async def init_openai_client():
+async def init_openai_client(credential=None, deployment=None):
     azure_openai_client = None
+    # Additional deployments carry their own endpoint, key and model
+    deployment_settings = deployment or app_settings.azure_openai
     
     try:
         # API version check
@@ -127,44 +311,58 @@ async def init_openai_client():
 
         # Endpoint
         if (
-            not app_settings.azure_openai.endpoint and
-            not app_settings.azure_openai.resource
+            not deployment_settings.endpoint and
+            not deployment_settings.resource
         ):
             raise ValueError(
                 "AZURE_OPENAI_ENDPOINT or AZURE_OPENAI_RESOURCE is required"
             )
 
         endpoint = (
-            app_settings.azure_openai.endpoint
-            if app_settings.azure_openai.endpoint
-            else f"https://{app_settings.azure_openai.resource}.openai.azure.com/"
+            deployment_settings.endpoint
+            if deployment_settings.endpoint
+            else f"https://{deployment_settings.resource}.openai.azure.com/"
         )
 
         # Authentication
-        aoai_api_key = app_settings.azure_openai.key
+        aoai_api_key = deployment_settings.key
         ad_token_provider = None
         if not aoai_api_key:
             logging.debug("No AZURE_OPENAI_KEY found, using Azure Entra ID auth")
-            async with DefaultAzureCredential() as credential:
-                ad_token_provider = get_bearer_token_provider(
-                    credential,
-                    "https://cognitiveservices.azure.com/.default"
+            if not credential:
+                raise ValueError(
+                    "An Azure credential is required when AZURE_OPENAI_KEY is not set"
                 )
+            ad_token_provider = credential.bearer_token_provider(
+                COGNITIVE_SERVICES_SCOPE
+            )
 
         # Deployment
-        deployment = app_settings.azure_openai.model
-        if not deployment:
+        if not deployment_settings.model:
             raise ValueError("AZURE_OPENAI_MODEL is required")
 
         # Default Headers
         default_headers = {"x-ms-useragent": USER_AGENT}
 
+        # Connection pool shared by every request served by this worker
+        http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=app_settings.azure_openai.max_connections,
+                max_keepalive_connections=app_settings.azure_openai.max_keepalive_connections,
+                keepalive_expiry=app_settings.azure_openai.keepalive_expiry,
+            ),
+            event_hooks={"request": [inject_httpx_trace_context]},
+        )
+
         azure_openai_client = AsyncAzureOpenAI(
             api_version=app_settings.azure_openai.preview_api_version,
             api_key=aoai_api_key,
             azure_ad_token_provider=ad_token_provider,
             default_headers=default_headers,
             azure_endpoint=endpoint,
+            http_client=http_client,
+            # Retries are handled by the deployment router
+            max_retries=0,
         )
 
         return azure_openai_client
@@ -174,20 +372,155 @@ async def init_openai_client():
         raise e
 
 
-async def init_cosmosdb_client():
+async def get_openai_client():
+    # The client is created once per worker in before_serving; fall back to
+    # creating it lazily when the app is driven without the serving lifecycle
+    # (e.g. the Quart test client).
+    if not getattr(current_app, "azure_openai_client", None):
+        current_app.azure_openai_client = await init_openai_client(
+            get_azure_credential()
+        )
+
+    return current_app.azure_openai_client
+
+
+async def init_deployment_router(credential=None, primary_client=None):
+    deployments = []
+    for index, deployment_settings in enumerate(app_settings.azure_openai.get_deployments()):
+        if index == 0 and primary_client:
+            client = primary_client
+        else:
+            client = await init_openai_client(
+                credential, None if index == 0 else deployment_settings
+            )
+
+        deployments.append(
+            Deployment(
+                name=deployment_settings.name,
+                model=deployment_settings.model,
+                client=client,
+                admission=DeploymentAdmission(
+                    deployment_settings.name,
+                    tokens_per_minute=deployment_settings.tokens_per_minute,
+                    requests_per_minute=deployment_settings.requests_per_minute,
+                    max_wait=app_settings.azure_openai.admission_max_wait,
+                ),
+                max_retries=deployment_settings.max_retries,
+                hedging=deployment_settings.hedging,
+                hedge_min_delay=app_settings.azure_openai.hedge_min_delay,
+            )
+        )
+
+    return DeploymentRouter(deployments)
+
+
+async def get_deployment_router():
+    if not getattr(current_app, "deployment_router", None):
+        current_app.deployment_router = await init_deployment_router(
+            get_azure_credential(), await get_openai_client()
+        )
+
+    return current_app.deployment_router
+
+
+def init_response_cache():
+    if not app_settings.response_cache.enabled:
+        return None
+
+    return ResponseCache(
+        max_entries=app_settings.response_cache.max_entries,
+        ttl=app_settings.response_cache.ttl,
+    )
+
+
+def get_response_cache():
+    if not hasattr(current_app, "response_cache"):
+        current_app.response_cache = init_response_cache()
+
+    return current_app.response_cache
+
+
+async def init_semantic_cache(credential=None, openai_client=None):
+    if not app_settings.semantic_cache.enabled:
+        return None
+
+    azure_openai = app_settings.azure_openai
+    try:
+        if azure_openai.embedding_name:
+            if not openai_client:
+                raise ValueError("The Azure OpenAI client is not available")
+            embedder = AzureOpenAIEmbedder(
+                client=openai_client, deployment=azure_openai.embedding_name
+            )
+        else:
+            async def get_headers():
+                if azure_openai.embedding_key:
+                    return {"api-key": azure_openai.embedding_key}
+                token = await credential.get_token(COGNITIVE_SERVICES_SCOPE)
+                return {"Authorization": f"Bearer {token.token}"}
+
+            embedder = AzureOpenAIEmbedder(
+                endpoint=azure_openai.embedding_endpoint,
+                http_client=httpx.AsyncClient(
+                    timeout=10, event_hooks={"request": [inject_httpx_trace_context]}
+                ) if azure_openai.embedding_endpoint else None,
+                get_headers=get_headers,
+            )
+    except ValueError:
+        logging.exception("Semantic cache disabled")
+        return None
+
+    return SemanticCache(
+        embedder,
+        threshold=app_settings.semantic_cache.threshold,
+        max_entries=app_settings.semantic_cache.max_entries,
+        ttl=app_settings.semantic_cache.ttl,
+    )
+
+
+async def get_semantic_cache():
+    if not hasattr(current_app, "semantic_cache"):
+        current_app.semantic_cache = await init_semantic_cache(
+            get_azure_credential(), await get_openai_client()
+        )
+
+    return current_app.semantic_cache
+
+
+def get_azure_credential():
+    if not getattr(current_app, "azure_credential", None):
+        current_app.azure_credential = CachedTokenCredential(DefaultAzureCredential())
+
+    return current_app.azure_credential
+
+
+async def init_cosmosdb_client(credential=None):
     cosmos_conversation_client = None
-    if app_settings.chat_history:
+    if app_settings.chat_history and app_settings.chat_history.store == "memory":
+        cosmos_conversation_client = InMemoryConversationClient(
+            enable_message_feedback=app_settings.chat_history.enable_feedback
+        )
+    elif app_settings.chat_history and app_settings.chat_history.store == "sqlite":
+        # aiosqlite is only needed (and installed) for local runs
+        from backend.history.sqlitestore import SqliteConversationClient
+
+        cosmos_conversation_client = SqliteConversationClient(
+            app_settings.chat_history.sqlite_path,
+            enable_message_feedback=app_settings.chat_history.enable_feedback,
+        )
+        await cosmos_conversation_client.connect()
+    elif app_settings.chat_history:
         try:
             cosmos_endpoint = (
                 f"https://{app_settings.chat_history.account}.documents.azure.com:443/"
             )
 
-            if not app_settings.chat_history.account_key:
-                async with DefaultAzureCredential() as cred:
-                    credential = cred
-                    
-            else:
+            if app_settings.chat_history.account_key:
                 credential = app_settings.chat_history.account_key
+            elif not credential:
+                raise ValueError(
+                    "An Azure credential is required when AZURE_COSMOSDB_ACCOUNT_KEY is not set"
+                )
 
             cosmos_conversation_client = CosmosConversationClient(
                 cosmosdb_endpoint=cosmos_endpoint,
@@ -195,6 +528,14 @@ async def init_cosmosdb_client():
                 database_name=app_settings.chat_history.database,
                 container_name=app_settings.chat_history.conversations_container,
                 enable_message_feedback=app_settings.chat_history.enable_feedback,
+                conversation_cache=ConversationCache(
+                    max_entries=app_settings.chat_history.conversation_cache_max_entries,
+                    ttl=app_settings.chat_history.conversation_cache_ttl,
+                ),
+                conversation_list_cache=ConversationListCache(
+                    max_users=app_settings.chat_history.conversation_list_cache_max_users,
+                    ttl=app_settings.chat_history.conversation_list_cache_ttl,
+                ),
             )
         except Exception as e:
             logging.exception("Exception in CosmosDB initialization", e)
@@ -206,6 +547,7 @@ async def init_cosmosdb_client():
     return cosmos_conversation_client
 
 
+@traced("prepare_model_args")
 def prepare_model_args(request_body, request_headers):
     request_messages = request_body.get("messages", [])
     messages = []
@@ -255,79 +597,73 @@ def prepare_model_args(request_body, request_headers):
     }
 
     if app_settings.datasource:
-        model_args["extra_body"] = {
-            "data_sources": [
-                app_settings.datasource.construct_payload_configuration(
-                    request=request
-                )
-            ]
-        }
+        # Built once at startup; only per-request fields such as the
+        # security filter are overlaid
+        with server_timing("datasource"):
+            model_args["extra_body"] = {
+                "data_sources": [
+                    app_settings.datasource.get_payload_configuration(request=request)
+                ]
+            }
 
-    model_args_clean = copy.deepcopy(model_args)
-    if model_args_clean.get("extra_body"):
-        secret_params = [
-            "key",
-            "connection_string",
-            "embedding_key",
-            "encoded_api_key",
-            "api_key",
-        ]
-        for secret_param in secret_params:
-            if model_args_clean["extra_body"]["data_sources"][0]["parameters"].get(
-                secret_param
-            ):
-                model_args_clean["extra_body"]["data_sources"][0]["parameters"][
-                    secret_param
-                ] = "*****"
-        authentication = model_args_clean["extra_body"]["data_sources"][0][
-            "parameters"
-        ].get("authentication", {})
-        for field in authentication:
-            if field in secret_params:
-                model_args_clean["extra_body"]["data_sources"][0]["parameters"][
-                    "authentication"
-                ][field] = "*****"
-        embeddingDependency = model_args_clean["extra_body"]["data_sources"][0][
-            "parameters"
-        ].get("embedding_dependency", {})
-        if "authentication" in embeddingDependency:
-            for field in embeddingDependency["authentication"]:
-                if field in secret_params:
-                    model_args_clean["extra_body"]["data_sources"][0]["parameters"][
-                        "embedding_dependency"
-                    ]["authentication"][field] = "*****"
-
-    logging.debug(f"REQUEST BODY: {json.dumps(model_args_clean, indent=4)}")
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug(f"REQUEST BODY: {json.dumps(redact_secrets(model_args), indent=4)}")
 
     return model_args
 
 
+def init_promptflow_client():
+    # HTTP/2 multiplexes concurrent requests over a single connection when
+    # the optional h2 package is installed
+    http2 = find_spec("h2") is not None
+    logging.debug(
+        f"Creating Promptflow client (http2={http2}, timeout={app_settings.promptflow.response_timeout})"
+    )
+    return httpx.AsyncClient(
+        http2=http2,
+        timeout=float(app_settings.promptflow.response_timeout),
+        limits=httpx.Limits(
+            max_connections=app_settings.promptflow.max_connections,
+            max_keepalive_connections=app_settings.promptflow.max_keepalive_connections,
+        ),
+        event_hooks={"request": [inject_httpx_trace_context]},
+    )
+
+
+def get_promptflow_client():
+    if not getattr(current_app, "promptflow_client", None):
+        current_app.promptflow_client = init_promptflow_client()
+
+    return current_app.promptflow_client
+
+
+def prepare_promptflow_request(request):
+    pf_formatted_obj = convert_to_pf_format(
+        request,
+        app_settings.promptflow.request_field_name,
+        app_settings.promptflow.response_field_name
+    )
+    # NOTE: This only support question and chat_history parameters
+    # If you need to add more parameters, you need to modify the request body
+    return {
+        app_settings.promptflow.request_field_name: pf_formatted_obj[-1]["inputs"][app_settings.promptflow.request_field_name],
+        "chat_history": pf_formatted_obj[:-1],
+    }
+
+
+@traced("promptflow_request", SpanKind.CLIENT)
 async def promptflow_request(request):
     try:
         headers = {
             "Content-Type": "application/json",
             "Authorization": f"Bearer {app_settings.promptflow.api_key}",
         }
-        # Adding timeout for scenarios where response takes longer to come back
-        logging.debug(f"Setting timeout to {app_settings.promptflow.response_timeout}")
-        async with httpx.AsyncClient(
-            timeout=float(app_settings.promptflow.response_timeout)
-        ) as client:
-            pf_formatted_obj = convert_to_pf_format(
-                request,
-                app_settings.promptflow.request_field_name,
-                app_settings.promptflow.response_field_name
-            )
-            # NOTE: This only support question and chat_history parameters
-            # If you need to add more parameters, you need to modify the request body
-            response = await client.post(
-                app_settings.promptflow.endpoint,
-                json={
-                    app_settings.promptflow.request_field_name: pf_formatted_obj[-1]["inputs"][app_settings.promptflow.request_field_name],
-                    "chat_history": pf_formatted_obj[:-1],
-                },
-                headers=headers,
-            )
+        client = get_promptflow_client()
+        response = await client.post(
+            app_settings.promptflow.endpoint,
+            json=prepare_promptflow_request(request),
+            headers=headers,
+        )
         resp = response.json()
         resp["id"] = request["messages"][-1]["id"]
         return resp
@@ -335,7 +671,43 @@ async def promptflow_request(request):
         logging.error(f"An error occurred while making promptflow_request: {e}")
 
 
-async def send_chat_request(request_body, request_headers):
+# The span ends once the response headers arrive
+@traced("promptflow_stream_request", SpanKind.CLIENT)
+async def promptflow_stream_request(request):
+    headers = {
+        "Content-Type": "application/json",
+        "Accept": "text/event-stream",
+        "Authorization": f"Bearer {app_settings.promptflow.api_key}",
+    }
+    client = get_promptflow_client()
+    pf_request = client.build_request(
+        "POST",
+        app_settings.promptflow.endpoint,
+        json=prepare_promptflow_request(request),
+        headers=headers,
+    )
+    response = await client.send(pf_request, stream=True)
+    if response.is_error:
+        await response.aread()
+        await response.aclose()
+        response.raise_for_status()
+
+    async def generate():
+        try:
+            if response.headers.get("content-type", "").startswith("text/event-stream"):
+                async for data in iter_sse_data(response.aiter_lines()):
+                    yield json.loads(data)
+            else:
+                # Flows without streaming outputs reply with a single JSON body
+                yield json.loads(await response.aread())
+        finally:
+            await response.aclose()
+
+    return ClosingStream(generate(), response)
+
+
+@traced("send_chat_request")
+async def send_chat_request(request_body, request_headers, raw_stream=False):
     filtered_messages = []
     messages = request_body.get("messages", [])
     for message in messages:
@@ -345,21 +717,84 @@ async def send_chat_request(request_body, request_headers):
     request_body['messages'] = filtered_messages
     model_args = prepare_model_args(request_body, request_headers)
 
+    cached, store_response = await lookup_cached_response(model_args)
+    if cached:
+        if model_args.get("stream"):
+            return (cached.as_raw_stream() if raw_stream else cached.as_stream()), None
+        return cached.as_completion(), None
+
     try:
-        azure_openai_client = await init_openai_client()
-        raw_response = await azure_openai_client.chat.completions.with_raw_response.create(**model_args)
-        response = raw_response.parse()
-        apim_request_id = raw_response.headers.get("apim-request-id") 
+        # Routed to the fastest healthy deployment with quota left, queueing
+        # behind its TPM/RPM budget instead of hitting 429s
+        router = await get_deployment_router()
+        with server_timing("ttft"):
+            response, apim_request_id = await router.create_chat_completion(
+                model_args, raw_stream=raw_stream
+            )
     except Exception as e:
         logging.exception("Exception in send_chat_request")
         raise e
 
+    if store_response:
+        if model_args.get("stream"):
+            response = ClosingStream(record_stream(response, store_response), response)
+        else:
+            entry = cached_completion(response)
+            if entry:
+                store_response(entry)
+
     return response, apim_request_id
 
 
+async def lookup_cached_response(model_args):
+    # Returns a cached answer, or a callback storing the new answer in every
+    # enabled cache
+    stores = []
+
+    response_cache = get_response_cache()
+    if response_cache:
+        cache_key = response_cache_key(model_args)
+        cached = response_cache.get(cache_key)
+        if cached:
+            logging.debug(f"Response cache hit: {cache_key}")
+            return cached, None
+        stores.append(lambda entry: response_cache.put(cache_key, entry))
+
+    semantic_cache = await get_semantic_cache()
+    question = first_question(model_args["messages"]) if semantic_cache else None
+    if question:
+        scope = semantic_scope_key(model_args)
+        try:
+            with span("embed_question", kind=SpanKind.CLIENT):
+                embedding = await semantic_cache.embed(question)
+        except Exception:
+            logging.exception("Failed to embed question for the semantic cache")
+            semantic_cache.stats.embedding_failures += 1
+            embedding = None
+
+        if embedding is not None:
+            cached = await semantic_cache.get(scope, embedding)
+            if cached:
+                logging.debug("Semantic cache hit")
+                if response_cache:
+                    response_cache.put(cache_key, cached)
+                return cached, None
+            stores.append(lambda entry: semantic_cache.put(scope, embedding, entry))
+
+    if not stores:
+        return None, None
+
+    def store_response(entry):
+        for store in stores:
+            store(entry)
+
+    return None, store_response
+
+
 async def complete_chat_request(request_body, request_headers):
     if app_settings.base_settings.use_promptflow:
-        response = await promptflow_request(request_body)
+        with server_timing("ttft"):
+            response = await promptflow_request(request_body)
         history_metadata = request_body.get("history_metadata", {})
         return format_pf_non_streaming_response(
             response,
@@ -374,30 +809,135 @@ async def complete_chat_request(request_body, request_headers):
 
 
 async def stream_chat_request(request_body, request_headers):
-    response, apim_request_id = await send_chat_request(request_body, request_headers)
     history_metadata = request_body.get("history_metadata", {})
+    if app_settings.base_settings.use_promptflow:
+        with server_timing("ttft"):
+            pf_response = await promptflow_stream_request(request_body)
+        message_id = request_body["messages"][-1].get("id")
+
+        async def generate_pf():
+            try:
+                async for pf_chunk in pf_response:
+                    yield format_pf_stream_response(
+                        pf_chunk,
+                        history_metadata,
+                        app_settings.promptflow.response_field_name,
+                        app_settings.promptflow.citations_field_name,
+                        message_id
+                    )
+            finally:
+                await close_stream(pf_response)
+
+        return ClosingStream(generate_pf(), pf_response)
+
+    # The raw stream skips building an SDK object per token
+    raw_stream = app_settings.azure_openai.raw_stream
+    response, apim_request_id = await send_chat_request(
+        request_body, request_headers, raw_stream=raw_stream
+    )
+    format_chunk = format_raw_stream_response if raw_stream else format_stream_response
     
     async def generate():
-        async for completionChunk in response:
-            yield format_stream_response(completionChunk, history_metadata, apim_request_id)
+        # Closed by Quart when the client disconnects; closing the upstream
+        # stream stops the generation and releases its admission budget
+        try:
+            async for completionChunk in response:
+                yield format_chunk(completionChunk, history_metadata, apim_request_id)
+        finally:
+            await close_stream(response)
 
-    return generate()
+    return ClosingStream(generate(), response)
+
+
+async def append_title_frame(frames, title_task, history_metadata):
+    # The generated title follows the answer in a frame carrying only the
+    # history metadata, unless the client went away first
+    try:
+        async for frame in frames:
+            yield frame
+    finally:
+        await close_stream(frames)
+
+    done, _ = await asyncio.wait({title_task}, timeout=TITLE_FRAME_MAX_WAIT)
+    if done:
+        yield {"history_metadata": {**history_metadata, "title": title_task.result()}}
+
+
+async def wait_for_history_write(history_write, result=None):
+    # The answer is only sent once the user message is stored. If storing it
+    # failed, the answer is dropped and the request fails as it did when the
+    # write came first.
+    try:
+        await history_write
+    except Exception as e:
+        await close_stream(result)
+        logging.exception("Exception in /history/generate")
+        return jsonify({"error": str(e)}), 500
 
 
-async def conversation_internal(request_body, request_headers):
+async def conversation_internal(request_body, request_headers, title_task=None, history_write=None):
+    # history_write: task storing the user message (/history/generate), run
+    # alongside the chat completion
     try:
-        if app_settings.azure_openai.stream and not app_settings.base_settings.use_promptflow:
+        if app_settings.azure_openai.stream and (
+            not app_settings.base_settings.use_promptflow
+            or app_settings.promptflow.stream
+        ):
             result = await stream_chat_request(request_body, request_headers)
+            if history_write:
+                error_response = await wait_for_history_write(history_write, result)
+                if error_response:
+                    return error_response
+            result = observe_chat_stream(result, request.url_rule.rule, g.request_start)
+            stream_version = negotiate_stream_version(
+                request_headers.get("Accept"), request.args.get("stream_version")
+            )
+            if title_task and stream_version == 2:
+                # Clients of the original format reject frames without choices;
+                # they see the generated title the next time the history is listed
+                result = append_title_frame(
+                    result, title_task, request_body.get("history_metadata", {})
+                )
+            if app_settings.base_settings.stream_flush_interval > 0:
+                # Fewer, larger frames instead of one NDJSON line per token
+                result = coalesce_stream_frames(
+                    result,
+                    app_settings.base_settings.stream_flush_interval,
+                    app_settings.base_settings.stream_flush_bytes,
+                )
+            if stream_version == 2:
+                result = format_delta_stream(result)
+            timing = current_server_timing()
+            if timing and stream_version == 2:
+                result = append_server_timing_frame(result, timing)
+            # The request span ends with the last frame instead of here
+            result = trace_stream(result, g.pop("request_span", None))
             response = await make_response(format_as_ndjson(result))
             response.timeout = None
-            response.mimetype = "application/json-lines"
+            response.mimetype = STREAM_MIMETYPE
+            if stream_version == 2:
+                response.headers["Content-Type"] = f"{STREAM_MIMETYPE}; v=2"
+            response.vary.add("Accept")
             return response
         else:
             result = await complete_chat_request(request_body, request_headers)
+            if history_write:
+                error_response = await wait_for_history_write(history_write)
+                if error_response:
+                    return error_response
+            observe_chat_completion(request.url_rule.rule, g.request_start)
+            if title_task:
+                done, _ = await asyncio.wait({title_task}, timeout=TITLE_FRAME_MAX_WAIT)
+                if done:
+                    result["history_metadata"]["title"] = title_task.result()
             return jsonify(result)
 
     except Exception as ex:
         logging.exception(ex)
+        if history_write:
+            error_response = await wait_for_history_write(history_write)
+            if error_response:
+                return error_response
         if hasattr(ex, "status_code"):
             return jsonify({"error": str(ex)}), ex.status_code
         else:
@@ -413,6 +953,12 @@ async def conversation():
     return await conversation_internal(request_json, request.headers)
 
 
+@bp.route("/metrics", methods=["GET"])
+async def metrics():
+    body, content_type = render_metrics()
+    return body, 200, {"Content-Type": content_type}
+
+
 @bp.route("/frontend_settings", methods=["GET"])
 def get_frontend_settings():
     try:
@@ -423,6 +969,13 @@ def get_frontend_settings():
 
 
 ## Conversation History API ##
+async def history_call(call):
+    # Awaits a history store call, counting its time towards the "history"
+    # stage of the request's Server-Timing
+    with server_timing("history"):
+        return await call
+
+
 @bp.route("/history/generate", methods=["POST"])
 async def add_conversation():
     await cosmos_db_ready.wait()
@@ -438,47 +991,66 @@ async def add_conversation():
         if not current_app.cosmos_conversation_client:
             raise Exception("CosmosDB is not configured or not working")
 
+        messages = request_json["messages"]
+        if not (len(messages) > 0 and messages[-1]["role"] == "user"):
+            raise Exception("No user message found")
+
         # check for the conversation_id, if the conversation is not set, we will create a new one
-        history_metadata = {}
+        title_task = None
         if not conversation_id:
-            title = await generate_title(request_json["messages"])
-            conversation_dict = await current_app.cosmos_conversation_client.create_conversation(
-                user_id=user_id, title=title
-            )
-            conversation_id = conversation_dict["id"]
-            history_metadata["title"] = title
-            history_metadata["date"] = conversation_dict["createdAt"]
+            # The title is generated alongside the answer instead of before
+            # it; until then the conversation is named after the question
+            title_task = asyncio.create_task(generate_title(messages))
 
-        ## Format the incoming message object in the "chat/completions" messages format
-        ## then write it to the conversation history in cosmos
-        messages = request_json["messages"]
-        if len(messages) > 0 and messages[-1]["role"] == "user":
-            createdMessageValue = await current_app.cosmos_conversation_client.create_message(
-                uuid=str(uuid.uuid4()),
-                conversation_id=conversation_id,
-                user_id=user_id,
-                input_message=messages[-1],
-            )
-            if createdMessageValue == "Conversation not found":
-                raise Exception(
-                    "Conversation not found for the given conversation ID: "
-                    + conversation_id
-                    + "."
-                )
-        else:
-            raise Exception("No user message found")
+        # The history is written while the chat completion is already
+        # running; it fills in the history metadata of the response
+        history_metadata = {}
+        history_write = asyncio.create_task(
+            save_user_message(user_id, conversation_id, messages, history_metadata, title_task)
+        )
 
         # Submit request to Chat Completions for response
         request_body = await request.get_json()
-        history_metadata["conversation_id"] = conversation_id
         request_body["history_metadata"] = history_metadata
-        return await conversation_internal(request_body, request.headers)
+        return await conversation_internal(
+            request_body, request.headers, title_task, history_write
+        )
 
     except Exception as e:
         logging.exception("Exception in /history/generate")
         return jsonify({"error": str(e)}), 500
 
 
+async def save_user_message(user_id, conversation_id, messages, history_metadata, title_task=None):
+    if not conversation_id:
+        title = heuristic_title(messages)
+        conversation_dict = await history_call(current_app.cosmos_conversation_client.create_conversation(
+            user_id=user_id, title=title
+        ))
+        conversation_id = conversation_dict["id"]
+        history_metadata["title"] = title
+        history_metadata["date"] = conversation_dict["createdAt"]
+        current_app.add_background_task(
+            save_generated_title, user_id, conversation_id, title, title_task
+        )
+    history_metadata["conversation_id"] = conversation_id
+
+    ## Format the incoming message object in the "chat/completions" messages format
+    ## then write it to the conversation history in cosmos
+    createdMessageValue = await history_call(current_app.cosmos_conversation_client.create_message(
+        uuid=str(uuid.uuid4()),
+        conversation_id=conversation_id,
+        user_id=user_id,
+        input_message=messages[-1],
+    ))
+    if createdMessageValue == "Conversation not found":
+        raise Exception(
+            "Conversation not found for the given conversation ID: "
+            + conversation_id
+            + "."
+        )
+
+
 @bp.route("/history/update", methods=["POST"])
 async def update_conversation():
     await cosmos_db_ready.wait()
@@ -504,19 +1076,19 @@ async def update_conversation():
         if len(messages) > 0 and messages[-1]["role"] == "assistant":
             if len(messages) > 1 and messages[-2].get("role", None) == "tool":
                 # write the tool message first
-                await current_app.cosmos_conversation_client.create_message(
+                await history_call(current_app.cosmos_conversation_client.create_message(
                     uuid=str(uuid.uuid4()),
                     conversation_id=conversation_id,
                     user_id=user_id,
                     input_message=messages[-2],
-                )
+                ))
             # write the assistant message
-            await current_app.cosmos_conversation_client.create_message(
+            await history_call(current_app.cosmos_conversation_client.create_message(
                 uuid=messages[-1]["id"],
                 conversation_id=conversation_id,
                 user_id=user_id,
                 input_message=messages[-1],
-            )
+            ))
         else:
             raise Exception("No bot messages found")
 
@@ -547,9 +1119,9 @@ async def update_message():
             return jsonify({"error": "message_feedback is required"}), 400
 
         ## update the message in cosmos
-        updated_message = await current_app.cosmos_conversation_client.update_message_feedback(
+        updated_message = await history_call(current_app.cosmos_conversation_client.update_message_feedback(
             user_id, message_id, message_feedback
-        )
+        ))
         if updated_message:
             return (
                 jsonify(
@@ -594,15 +1166,22 @@ async def delete_conversation():
         if not current_app.cosmos_conversation_client:
             raise Exception("CosmosDB is not configured or not working")
 
-        ## delete the conversation messages from cosmos first
-        deleted_messages = await current_app.cosmos_conversation_client.delete_messages(
-            conversation_id, user_id
-        )
-
-        ## Now delete the conversation
-        deleted_conversation = await current_app.cosmos_conversation_client.delete_conversation(
+        ## delete the conversation and its messages in batches
+        item_ids = await history_call(current_app.cosmos_conversation_client.get_deletion_ids(
             user_id, conversation_id
-        )
+        ))
+        job = await delete_history_items(user_id, item_ids)
+        if job:
+            return (
+                jsonify(
+                    {
+                        "message": "Deleting conversation and messages",
+                        "conversation_id": conversation_id,
+                        "job_id": job["id"],
+                    }
+                ),
+                202,
+            )
 
         return (
             jsonify(
@@ -621,7 +1200,7 @@ async def delete_conversation():
 @bp.route("/history/list", methods=["GET"])
 async def list_conversations():
     await cosmos_db_ready.wait()
-    offset = request.args.get("offset", 0)
+    continuation_token = request.args.get("continuation_token")
     authenticated_user = get_authenticated_user_details(request_headers=request.headers)
     user_id = authenticated_user["user_principal_id"]
 
@@ -629,16 +1208,32 @@ async def list_conversations():
     if not current_app.cosmos_conversation_client:
         raise Exception("CosmosDB is not configured or not working")
 
+    ## clients built before continuation tokens page with ?offset=
+    offset = request.args.get("offset")
+    if offset is not None and (not offset.isdigit() or continuation_token):
+        return jsonify({"error": "offset must be a non-negative integer and cannot be combined with continuation_token"}), 400
+
     ## get the conversations from cosmos
-    conversations = await current_app.cosmos_conversation_client.get_conversations(
-        user_id, offset=offset, limit=25
-    )
+    if offset and int(offset) > 0:
+        conversations = await history_call(current_app.cosmos_conversation_client.get_conversations(
+            user_id, limit=HISTORY_PAGE_SIZE, offset=int(offset)
+        ))
+    else:
+        try:
+            conversations, continuation_token = await history_call(current_app.cosmos_conversation_client.get_conversations_page(
+                user_id, limit=HISTORY_PAGE_SIZE, continuation_token=continuation_token
+            ))
+        except InvalidContinuationToken:
+            return jsonify({"error": INVALID_CONTINUATION_TOKEN_ERROR}), 400
     if not isinstance(conversations, list):
         return jsonify({"error": f"No conversations for {user_id} were found"}), 404
 
-    ## return the conversation ids
+    ## return the conversation ids, and the cursor of the next page in a header
 
-    return jsonify(conversations), 200
+    response = jsonify(conversations)
+    if continuation_token:
+        response.headers[CONTINUATION_TOKEN_HEADER] = continuation_token
+    return response, 200
 
 
 @bp.route("/history/read", methods=["POST"])
@@ -654,14 +1249,20 @@ async def get_conversation():
     if not conversation_id:
         return jsonify({"error": "conversation_id is required"}), 400
 
+    limit = request_json.get("limit")
+    if limit is not None and (type(limit) is not int or limit < 1):
+        return jsonify({"error": "limit must be a positive integer"}), 400
+    if not isinstance(request_json.get("continuation_token") or "", str):
+        return jsonify({"error": INVALID_CONTINUATION_TOKEN_ERROR}), 400
+
     ## make sure cosmos is configured
     if not current_app.cosmos_conversation_client:
         raise Exception("CosmosDB is not configured or not working")
 
     ## get the conversation object and the related messages from cosmos
-    conversation = await current_app.cosmos_conversation_client.get_conversation(
+    conversation = await history_call(current_app.cosmos_conversation_client.get_conversation(
         user_id, conversation_id
-    )
+    ))
     ## return the conversation id and the messages in the bot frontend format
     if not conversation:
         return (
@@ -673,10 +1274,25 @@ async def get_conversation():
             404,
         )
 
-    # get the messages for the conversation from cosmos
-    conversation_messages = await current_app.cosmos_conversation_client.get_messages(
-        user_id, conversation_id
-    )
+    # get the messages for the conversation from cosmos: all of them, or one page
+    # when a limit is given, optionally only those created after "since"
+    limit = request_json.get("limit")
+    continuation_token = None
+    if limit or request_json.get("since"):
+        try:
+            conversation_messages, continuation_token = await history_call(current_app.cosmos_conversation_client.get_messages_page(
+                user_id,
+                conversation_id,
+                limit=limit,
+                continuation_token=request_json.get("continuation_token"),
+                since=request_json.get("since"),
+            ))
+        except InvalidContinuationToken:
+            return jsonify({"error": INVALID_CONTINUATION_TOKEN_ERROR}), 400
+    else:
+        conversation_messages = await history_call(current_app.cosmos_conversation_client.get_messages(
+            user_id, conversation_id
+        ))
 
     ## format the messages in the bot frontend format
     messages = [
@@ -690,7 +1306,13 @@ async def get_conversation():
         for msg in conversation_messages
     ]
 
-    return jsonify({"conversation_id": conversation_id, "messages": messages}), 200
+    return jsonify(
+        {
+            "conversation_id": conversation_id,
+            "messages": messages,
+            "continuation_token": continuation_token,
+        }
+    ), 200
 
 
 @bp.route("/history/rename", methods=["POST"])
@@ -711,9 +1333,9 @@ async def rename_conversation():
         raise Exception("CosmosDB is not configured or not working")
 
     ## get the conversation from cosmos
-    conversation = await current_app.cosmos_conversation_client.get_conversation(
+    conversation = await history_call(current_app.cosmos_conversation_client.get_conversation(
         user_id, conversation_id
-    )
+    ))
     if not conversation:
         return (
             jsonify(
@@ -728,10 +1350,11 @@ async def rename_conversation():
     title = request_json.get("title", None)
     if not title:
         return jsonify({"error": "title is required"}), 400
-    conversation["title"] = title
-    updated_conversation = await current_app.cosmos_conversation_client.upsert_conversation(
-        conversation
-    )
+    # Partial update: the conversation may come from the metadata cache, so
+    # writing the whole document back could undo a newer updatedAt
+    updated_conversation = await history_call(current_app.cosmos_conversation_client.update_conversation_title(
+        user_id, conversation_id, title
+    ))
 
     return jsonify(updated_conversation), 200
 
@@ -749,23 +1372,23 @@ async def delete_all_conversations():
         if not current_app.cosmos_conversation_client:
             raise Exception("CosmosDB is not configured or not working")
 
-        conversations = await current_app.cosmos_conversation_client.get_conversations(
-            user_id, offset=0, limit=None
-        )
-        if not conversations:
+        item_ids = await history_call(current_app.cosmos_conversation_client.get_deletion_ids(user_id))
+        if not item_ids:
             return jsonify({"error": f"No conversations for {user_id} were found"}), 404
 
-        # delete each conversation
-        for conversation in conversations:
-            ## delete the conversation messages from cosmos first
-            deleted_messages = await current_app.cosmos_conversation_client.delete_messages(
-                conversation["id"], user_id
+        # delete all conversations and messages of the user's partition in batches
+        job = await delete_history_items(user_id, item_ids)
+        if job:
+            return (
+                jsonify(
+                    {
+                        "message": f"Deleting conversation and messages for user {user_id}",
+                        "job_id": job["id"],
+                    }
+                ),
+                202,
             )
 
-            ## Now delete the conversation
-            deleted_conversation = await current_app.cosmos_conversation_client.delete_conversation(
-                user_id, conversation["id"]
-            )
         return (
             jsonify(
                 {
@@ -800,9 +1423,21 @@ async def clear_messages():
             raise Exception("CosmosDB is not configured or not working")
 
         ## delete the conversation messages from cosmos
-        deleted_messages = await current_app.cosmos_conversation_client.delete_messages(
-            conversation_id, user_id
-        )
+        item_ids = await history_call(current_app.cosmos_conversation_client.get_deletion_ids(
+            user_id, conversation_id, messages_only=True
+        ))
+        job = await delete_history_items(user_id, item_ids)
+        if job:
+            return (
+                jsonify(
+                    {
+                        "message": "Deleting messages in conversation",
+                        "conversation_id": conversation_id,
+                        "job_id": job["id"],
+                    }
+                ),
+                202,
+            )
 
         return (
             jsonify(
@@ -818,6 +1453,65 @@ async def clear_messages():
         return jsonify({"error": str(e)}), 500
 
 
+@bp.route("/history/delete_status", methods=["GET"])
+async def deletion_status():
+    await cosmos_db_ready.wait()
+    authenticated_user = get_authenticated_user_details(request_headers=request.headers)
+    user_id = authenticated_user["user_principal_id"]
+
+    job_id = request.args.get("job_id")
+    if not job_id:
+        return jsonify({"error": "job_id is required"}), 400
+
+    ## make sure cosmos is configured
+    if not current_app.cosmos_conversation_client:
+        raise Exception("CosmosDB is not configured or not working")
+
+    job = await history_call(current_app.cosmos_conversation_client.get_deletion_job(user_id, job_id))
+    if not job:
+        return jsonify({"error": f"Deletion job {job_id} was not found"}), 404
+
+    status, error = job["status"], job.get("error")
+    if is_stale_deletion_job(job):
+        status, error = "failed", "The deletion was interrupted before it finished, please retry"
+
+    return jsonify(
+        {
+            "job_id": job["id"],
+            "status": status,
+            "item_count": job["itemCount"],
+            "deleted": job["deleted"],
+            "error": error,
+        }
+    ), 200
+
+
+async def delete_history_items(user_id, item_ids):
+    # Small deletes finish within the request; larger ones return the job
+    # that deletes them in the background
+    cosmos_conversation_client = current_app.cosmos_conversation_client
+    if len(item_ids) <= BACKGROUND_DELETE_THRESHOLD:
+        await history_call(cosmos_conversation_client.delete_items(user_id, item_ids))
+        return None
+
+    job = await history_call(cosmos_conversation_client.create_deletion_job(user_id, len(item_ids)))
+    current_app.add_background_task(run_deletion_job, user_id, job["id"], item_ids)
+    return job
+
+
+async def run_deletion_job(user_id, job_id, item_ids):
+    cosmos_conversation_client = current_app.cosmos_conversation_client
+    try:
+        deleted = await cosmos_conversation_client.delete_items(user_id, item_ids)
+        await cosmos_conversation_client.update_deletion_job(user_id, job_id, "succeeded", deleted)
+    except Exception as e:
+        logging.exception("Exception in deletion job %s", job_id)
+        try:
+            await cosmos_conversation_client.update_deletion_job(user_id, job_id, "failed", error=str(e))
+        except Exception:
+            logging.exception("Could not record the failure of deletion job %s", job_id)
+
+
 @bp.route("/history/ensure", methods=["GET"])
 async def ensure_cosmos():
     await cosmos_db_ready.wait()
@@ -859,6 +1553,7 @@ async def ensure_cosmos():
             return jsonify({"error": "CosmosDB is not working"}), 500
 
 
+@traced("generate_title")
 async def generate_title(conversation_messages) -> str:
     ## make sure the messages are sorted by _ts descending
     title_prompt = "Summarize the conversation so far into a 4-word or less title. Do not use any quotation marks or punctuation. Do not include any other commentary or description."
@@ -870,16 +1565,36 @@ async def generate_title(conversation_messages) -> str:
     messages.append({"role": "user", "content": title_prompt})
 
     try:
-        azure_openai_client = await init_openai_client()
-        response = await azure_openai_client.chat.completions.create(
-            model=app_settings.azure_openai.model, messages=messages, temperature=1, max_tokens=64
-        )
+        model_args = {"messages": messages, "temperature": 1, "max_tokens": 64}
+        if app_settings.azure_openai.title_model:
+            # Dedicated deployment for titles on the primary resource
+            azure_openai_client = await get_openai_client()
+            response = await azure_openai_client.chat.completions.create(
+                model=app_settings.azure_openai.title_model, **model_args
+            )
+        else:
+            router = await get_deployment_router()
+            response, _ = await router.create_chat_completion(model_args)
 
         title = response.choices[0].message.content
-        return title
+        return title or heuristic_title(conversation_messages)
     except Exception as e:
         logging.exception("Exception while generating title", e)
-        return messages[-2]["content"]
+        return heuristic_title(conversation_messages)
+
+
+async def save_generated_title(user_id, conversation_id, heuristic, title_task):
+    # Runs once the response is sent; the conversation was created with the
+    # heuristic title
+    title = await title_task
+    if title == heuristic:
+        return
+    try:
+        await current_app.cosmos_conversation_client.update_conversation_title(
+            user_id, conversation_id, title
+        )
+    except Exception:
+        logging.exception("Failed to save the generated conversation title")
 
 
 app = create_app()
@@ -0,0 +1,265 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+from backend.aoai.raw_stream import delta_content
+from backend.metrics import ADMISSION_QUEUE_DEPTH, CANCELLED_STREAM_TOKENS, CANCELLED_STREAMS
+
+# Rough characters-per-token ratio used to estimate prompt size without a
+# tokenizer, and the per-message overhead of the chat completions format.
+CHARS_PER_TOKEN = 4
+TOKENS_PER_MESSAGE = 4
+TOKENS_PER_IMAGE = 765
+
+
+class AdmissionTimeoutError(Exception):
+    status_code = 429
+
+
+def estimate_prompt_tokens(messages) -> int:
+    tokens = 0
+    for message in messages:
+        tokens += TOKENS_PER_MESSAGE
+        content = message.get("content") or ""
+        if isinstance(content, str):
+            tokens += len(content) // CHARS_PER_TOKEN
+        else:
+            for part in content:
+                if part.get("type") == "text":
+                    tokens += len(part.get("text", "")) // CHARS_PER_TOKEN
+                else:
+                    tokens += TOKENS_PER_IMAGE
+    return tokens
+
+
+class TokenBucket:
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.tokens = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def time_until(self, amount: float) -> float:
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount: float):
+        self._refill()
+        self.tokens -= min(amount, self.capacity)
+
+    def refund(self, amount: float):
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+@dataclass
+class AdmissionStats:
+    admitted: int = 0
+    rejected: int = 0
+    queued: int = 0
+    in_flight: int = 0
+    wait_seconds_total: float = 0.0
+    tokens_refunded: int = 0
+    # Streams closed before the service finished, e.g. because the client
+    # disconnected, and the completion tokens they had streamed until then
+    cancelled: int = 0
+    cancelled_tokens: int = 0
+
+    def snapshot(self) -> dict:
+        return {
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "queued": self.queued,
+            "in_flight": self.in_flight,
+            "wait_seconds_total": self.wait_seconds_total,
+            "tokens_refunded": self.tokens_refunded,
+            "cancelled": self.cancelled,
+            "cancelled_tokens": self.cancelled_tokens,
+        }
+
+
+class AdmissionTicket:
+    def __init__(self, admission: "DeploymentAdmission", cost: int, prompt_tokens: int):
+        self._admission = admission
+        self.cost = cost
+        self.prompt_tokens = prompt_tokens
+        self._released = False
+
+    def release(self, completion_tokens: Optional[int] = None):
+        if self._released:
+            return
+        self._released = True
+        self._admission._release(self, completion_tokens)
+
+    def track_stream(self, stream) -> "TrackedStream":
+        return TrackedStream(self, stream)
+
+
+class TrackedStream:
+    """
+    Counts the streamed content deltas (one token each) of an admitted
+    request and gives unused budget back once the stream ends, however it
+    ends. Unlike an async generator, closing it before it was read still
+    releases the ticket and closes the upstream stream.
+    """
+
+    def __init__(self, ticket: AdmissionTicket, stream):
+        self._ticket = ticket
+        self._stream = stream
+        self._finished = False
+        self.completion_tokens = 0
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._finished:
+            raise StopAsyncIteration
+        try:
+            chunk = await self._stream.__anext__()
+        except asyncio.CancelledError:
+            await self.aclose()
+            raise
+        except BaseException:
+            await self._finish()
+            raise
+        if delta_content(chunk):
+            self.completion_tokens += 1
+        return chunk
+
+    async def aclose(self):
+        # Closed before the service finished, e.g. because the client disconnected
+        if not self._finished:
+            admission = self._ticket._admission
+            admission.stats.cancelled += 1
+            admission.stats.cancelled_tokens += self.completion_tokens
+            CANCELLED_STREAMS.labels(admission.name).inc()
+            CANCELLED_STREAM_TOKENS.labels(admission.name).inc(self.completion_tokens)
+        await self._finish()
+
+    async def _finish(self):
+        if self._finished:
+            return
+        self._finished = True
+        self._ticket.release(self.completion_tokens)
+        if hasattr(self._stream, "aclose"):
+            await self._stream.aclose()
+
+
+class DeploymentAdmission:
+    """
+    Token-bucket admission control for a single Azure OpenAI deployment.
+
+    Requests wait in FIFO order until both the tokens-per-minute and the
+    requests-per-minute budgets allow them through, or fail with
+    AdmissionTimeoutError once max_wait seconds have passed.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        tokens_per_minute: Optional[int] = None,
+        requests_per_minute: Optional[int] = None,
+        max_wait: float = 10.0,
+    ):
+        self.name = name
+        self.max_wait = max_wait
+        self._tpm = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self._rpm = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self._lock = asyncio.Lock()
+        self.stats = AdmissionStats()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self._tpm or self._rpm)
+
+    @property
+    def tokens_per_minute(self) -> Optional[float]:
+        return self._tpm.capacity if self._tpm else None
+
+    @property
+    def remaining_tokens(self) -> Optional[float]:
+        if not self._tpm:
+            return None
+        self._tpm._refill()
+        return self._tpm.tokens
+
+    def _wait_time(self, cost: int) -> float:
+        wait = 0.0
+        if self._tpm:
+            wait = max(wait, self._tpm.time_until(cost))
+        if self._rpm:
+            wait = max(wait, self._rpm.time_until(1))
+        return wait
+
+    async def acquire(self, model_args: dict, max_wait: Optional[float] = None) -> AdmissionTicket:
+        max_wait = self.max_wait if max_wait is None else max_wait
+        prompt_tokens = estimate_prompt_tokens(model_args.get("messages", []))
+        cost = prompt_tokens + (model_args.get("max_tokens") or 0)
+        if not self.enabled:
+            self.stats.admitted += 1
+            self.stats.in_flight += 1
+            return AdmissionTicket(self, cost, prompt_tokens)
+
+        start = time.monotonic()
+        deadline = start + max_wait
+        self.stats.queued += 1
+        ADMISSION_QUEUE_DEPTH.labels(self.name).inc()
+        try:
+            # The lock hands out the head of the queue in arrival order
+            if max_wait > 0:
+                await asyncio.wait_for(self._lock.acquire(), timeout=max_wait)
+            elif self._lock.locked():
+                raise asyncio.TimeoutError()
+            else:
+                await self._lock.acquire()
+            try:
+                while True:
+                    wait = self._wait_time(cost)
+                    if wait == 0:
+                        break
+                    if time.monotonic() + wait > deadline:
+                        raise asyncio.TimeoutError()
+                    await asyncio.sleep(wait)
+
+                if self._tpm:
+                    self._tpm.consume(cost)
+                if self._rpm:
+                    self._rpm.consume(1)
+            finally:
+                self._lock.release()
+        except asyncio.TimeoutError:
+            self.stats.rejected += 1
+            logging.warning(
+                f"Admission to deployment {self.name} timed out after {max_wait}s"
+            )
+            raise AdmissionTimeoutError(
+                f"Deployment {self.name} is over its token or request budget, please retry later"
+            )
+        finally:
+            self.stats.queued -= 1
+            ADMISSION_QUEUE_DEPTH.labels(self.name).dec()
+
+        self.stats.wait_seconds_total += time.monotonic() - start
+        self.stats.admitted += 1
+        self.stats.in_flight += 1
+        return AdmissionTicket(self, cost, prompt_tokens)
+
+    def _release(self, ticket: AdmissionTicket, completion_tokens: Optional[int]):
+        self.stats.in_flight -= 1
+        if completion_tokens is None or not self._tpm:
+            return
+        unused = ticket.cost - (ticket.prompt_tokens + completion_tokens)
+        if unused > 0:
+            self._tpm.refund(unused)
+            self.stats.tokens_refunded += unused
@@ -0,0 +1,257 @@
+import hashlib
+import json
+import re
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass
+from types import SimpleNamespace
+from typing import Callable, Optional
+
+# Model arguments that do not change the answer
+_UNCACHED_ARGS = {"messages", "stream", "user", "extra_body", "model"}
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_content(content):
+    if isinstance(content, str):
+        return _WHITESPACE.sub(" ", content).strip()
+    return content
+
+
+def normalize_messages(messages) -> list:
+    # Only role and content matter: ids, dates and the citations of earlier
+    # answers do not change what the model is asked.
+    return [
+        {"role": message["role"], "content": normalize_content(message.get("content"))}
+        for message in messages
+        if message and message.get("role") != "tool"
+    ]
+
+
+def response_cache_key(model_args: dict) -> str:
+    extra_body = model_args.get("extra_body") or {}
+    key = {
+        "messages": normalize_messages(model_args.get("messages", [])),
+        "data_sources": extra_body.get("data_sources"),
+        "params": {k: v for k, v in model_args.items() if k not in _UNCACHED_ARGS},
+    }
+    serialized = json.dumps(key, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+
+@dataclass
+class CachedCompletion:
+    id: str
+    model: str
+    created: int
+    object: str
+    content: str
+    context: Optional[dict] = None
+    stored_at: float = 0.0
+
+    def _replay_id(self):
+        # Every replay is a new answer: the frontend saves the assistant message
+        # under the completion id, so reusing the cached one would overwrite the
+        # message of an earlier hit
+        return f"chatcmpl-{uuid.uuid4()}"
+
+    def _message(self):
+        message = SimpleNamespace(role="assistant", content=self.content)
+        if self.context is not None:
+            message.context = self.context
+        return message
+
+    def as_completion(self):
+        return SimpleNamespace(
+            id=self._replay_id(),
+            model=self.model,
+            created=self.created,
+            object="chat.completion",
+            choices=[SimpleNamespace(index=0, message=self._message(), finish_reason="stop")],
+            usage=None,
+        )
+
+    async def as_stream(self):
+        # Same chunk shapes as the service: the citations first, then the answer
+        replay_id = self._replay_id()
+
+        def chunk(delta, finish_reason=None):
+            return SimpleNamespace(
+                id=replay_id,
+                model=self.model,
+                created=self.created,
+                object="chat.completion.chunk",
+                choices=[SimpleNamespace(index=0, delta=delta, finish_reason=finish_reason)],
+            )
+
+        if self.context is not None:
+            yield chunk(SimpleNamespace(role="assistant", content=None, context=self.context))
+        yield chunk(SimpleNamespace(role="assistant", content=self.content), "stop")
+
+    async def as_raw_stream(self):
+        # Chunks as decoded from the service's server-sent events (RawChatStream)
+        replay_id = self._replay_id()
+
+        def chunk(delta, finish_reason=None):
+            return {
+                "id": replay_id,
+                "model": self.model,
+                "created": self.created,
+                "object": "chat.completion.chunk",
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }
+
+        if self.context is not None:
+            yield chunk({"role": "assistant", "content": None, "context": self.context})
+        yield chunk({"role": "assistant", "content": self.content}, "stop")
+
+
+@dataclass
+class ResponseCacheStats:
+    hits: int = 0
+    misses: int = 0
+    stores: int = 0
+    evictions: int = 0
+    expirations: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def snapshot(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+class ResponseCache:
+    """
+    Per-worker LRU cache of chat completions keyed on the normalized
+    conversation, the datasource payload and the model parameters.
+    """
+
+    def __init__(self, max_entries: int = 1000, ttl: float = 3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, CachedCompletion]" = OrderedDict()
+        self.stats = ResponseCacheStats()
+
+    def get(self, key: str) -> Optional[CachedCompletion]:
+        entry = self._entries.get(key)
+        if entry and time.monotonic() - entry.stored_at > self.ttl:
+            del self._entries[key]
+            self.stats.expirations += 1
+            entry = None
+
+        if not entry:
+            self.stats.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.stats.hits += 1
+        return entry
+
+    def put(self, key: str, entry: CachedCompletion):
+        entry.stored_at = time.monotonic()
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        self.stats.stores += 1
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+
+
+def cached_completion(completion) -> Optional[CachedCompletion]:
+    if not completion.choices:
+        return None
+    choice = completion.choices[0]
+    message = choice.message
+    if not message or not message.content or choice.finish_reason == "content_filter":
+        return None
+
+    return CachedCompletion(
+        id=completion.id,
+        model=completion.model,
+        created=completion.created,
+        object=completion.object,
+        content=message.content,
+        context=getattr(message, "context", None),
+    )
+
+
+async def record_stream(stream, store: Callable[[CachedCompletion], None]):
+    """
+    Pass the chunks of a streamed completion through and hand the answer to
+    `store` once the stream completed, so cancelled, failed or filtered
+    answers are never cached.
+    """
+    first = None
+    context = None
+    content = []
+    finish_reason = None
+    try:
+        async for chunk in stream:
+            yield chunk
+            if isinstance(chunk, dict):
+                # Raw chunk from RawChatStream
+                chunk = _RawChunkView(chunk)
+            first = first or chunk
+            if not chunk.choices:
+                continue
+            choice = chunk.choices[0]
+            finish_reason = getattr(choice, "finish_reason", None) or finish_reason
+            delta = choice.delta
+            if not delta:
+                continue
+            if hasattr(delta, "context"):
+                # format_stream_response only forwards the citations of such a chunk
+                context = delta.context
+            elif delta.content:
+                content.append(delta.content)
+    finally:
+        if hasattr(stream, "aclose"):
+            await stream.aclose()
+
+    if first and content and finish_reason != "content_filter":
+        store(
+            CachedCompletion(
+                id=first.id,
+                model=first.model,
+                created=first.created,
+                object=first.object,
+                content="".join(content),
+                context=context,
+            )
+        )
+
+
+class _RawChunkView:
+    # Attribute access to a raw chunk dict with the SDK's defaults: declared
+    # fields are None when absent, extra fields (context) raise AttributeError
+    _FIELDS = {"id", "model", "created", "object", "choices", "delta", "role", "content", "finish_reason"}
+
+    def __init__(self, data: dict):
+        self._data = data
+
+    def __getattr__(self, name):
+        if name in self._data:
+            value = self._data[name]
+        elif name in self._FIELDS:
+            value = None
+        else:
+            raise AttributeError(name)
+        if isinstance(value, list):
+            return [_RawChunkView(item) if isinstance(item, dict) else item for item in value]
+        if isinstance(value, dict) and name != "context":
+            return _RawChunkView(value)
+        return value
@@ -0,0 +1,51 @@
+import json
+from typing import Optional
+
+import openai
+
+from backend.utils import iter_sse_data
+
+
+def delta_content(chunk) -> Optional[str]:
+    # Content delta of an SDK chunk or a raw (dict) chunk
+    if isinstance(chunk, dict):
+        choices = chunk.get("choices")
+        return (choices[0].get("delta") or {}).get("content") if choices else None
+    if not chunk.choices:
+        return None
+    return getattr(chunk.choices[0].delta, "content", None)
+
+
+class RawChatStream:
+    """
+    Streamed chat completion read straight from the service's server-sent
+    events, yielding each chunk as the dict decoded from its JSON instead of
+    an SDK ChatCompletionChunk.
+    """
+
+    def __init__(self, response):
+        self.response = response
+        self._events = iter_sse_data(response.aiter_lines())
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> dict:
+        data = await self._events.__anext__()
+        chunk = json.loads(data)
+        if chunk.get("error"):
+            # Same as the SDK stream: an error event ends the stream
+            error = chunk["error"]
+            message = error.get("message") if isinstance(error, dict) else None
+            raise openai.APIError(
+                message or "An error occurred during streaming",
+                request=self.response.request,
+                body=error,
+            )
+        return chunk
+
+    async def aclose(self):
+        await self._events.aclose()
+        await self.response.aclose()
+
+    close = aclose
@@ -0,0 +1,77 @@
+import random
+import re
+import time
+from email.utils import parsedate_to_datetime
+from typing import Optional, Sequence
+
+BASE_RETRY_DELAY = 0.5
+MAX_BACKOFF_DELAY = 8.0
+
+_DURATION_PATTERN = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def parse_duration(value: str) -> Optional[float]:
+    # Accepts plain seconds ("6"), Go-style durations ("1m30s", "120ms") and
+    # epoch timestamps.
+    value = value.strip()
+    try:
+        seconds = float(value)
+    except ValueError:
+        matches = _DURATION_PATTERN.findall(value)
+        if not matches:
+            return None
+        return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in matches)
+
+    if seconds > 1e9:
+        return max(seconds - time.time(), 0.0)
+    return seconds
+
+
+def parse_retry_after(headers) -> Optional[float]:
+    """
+    Seconds the service asked us to wait, from the retry-after-ms,
+    retry-after or x-ratelimit-reset* response headers.
+    """
+    if not headers:
+        return None
+
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+
+    retry_after = headers.get("retry-after")
+    if retry_after:
+        seconds = parse_duration(retry_after)
+        if seconds is not None:
+            return seconds
+        try:
+            return max(parsedate_to_datetime(retry_after).timestamp() - time.time(), 0.0)
+        except (TypeError, ValueError):
+            pass
+
+    resets = [
+        parse_duration(headers[name])
+        for name in ("x-ratelimit-reset", "x-ratelimit-reset-requests", "x-ratelimit-reset-tokens")
+        if headers.get(name)
+    ]
+    resets = [reset for reset in resets if reset is not None]
+    return max(resets) if resets else None
+
+
+def backoff_delay(attempt: int) -> float:
+    # Exponential backoff with full jitter for retries without a hint
+    if attempt <= 0:
+        return 0.0
+    return random.uniform(0, min(BASE_RETRY_DELAY * 2 ** (attempt - 1), MAX_BACKOFF_DELAY))
+
+
+def percentile(samples: Sequence[float], pct: float) -> Optional[float]:
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    index = min(int(round(pct / 100 * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
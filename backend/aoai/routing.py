@@ -0,0 +1,354 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Dict, List, Optional
+
+import openai
+from opentelemetry.trace import SpanKind
+
+from backend.aoai.admission import AdmissionTimeoutError, DeploymentAdmission
+from backend.aoai.raw_stream import RawChatStream, delta_content
+from backend.aoai.retry import backoff_delay, parse_retry_after, percentile
+from backend.metrics import observe_upstream_latency
+from backend.tracing import set_span_attributes, span
+
+RETRYABLE_STATUS_CODES = {408, 409, 429}
+DEFAULT_THROTTLE_COOLDOWN = 5.0
+BASE_FAILURE_COOLDOWN = 1.0
+MAX_FAILURE_COOLDOWN = 30.0
+MAX_RETRY_DELAY = 30.0
+MIN_QUOTA_RATIO = 0.05
+LATENCY_SAMPLES = 200
+HEDGE_PERCENTILE = 95
+MIN_HEDGE_SAMPLES = 20
+
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, (AdmissionTimeoutError, openai.APIConnectionError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in RETRYABLE_STATUS_CODES or error.status_code >= 500
+    # Errors raised while reading a stream (e.g. an "error" SSE event)
+    return isinstance(error, openai.APIError) and getattr(error, "status_code", None) is None
+
+
+def has_content(chunk) -> bool:
+    return bool(delta_content(chunk))
+
+
+async def discard_response(response):
+    # Give back the admission budget and connection of a response that lost
+    # a hedging race
+    if hasattr(response, "aclose"):
+        await response.aclose()
+
+
+class PrefetchedStream:
+    # Replays the chunks read ahead by _prefetch_first_token, then the rest of
+    # the stream. Closing it closes the upstream response even before it was
+    # read, which an async generator that never started would not do.
+    def __init__(self, buffered, stream):
+        self._buffered = deque(buffered)
+        self._stream = stream
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._buffered:
+            return self._buffered.popleft()
+        try:
+            return await self._stream.__anext__()
+        except BaseException:
+            await self._stream.close()
+            raise
+
+    async def aclose(self):
+        await self._stream.close()
+
+
+class Deployment:
+    def __init__(
+        self,
+        name: str,
+        model: str,
+        client,
+        admission: DeploymentAdmission,
+        max_retries: int = 2,
+        hedging: bool = False,
+        hedge_min_delay: float = 1.0,
+        latency_alpha: float = 0.3,
+    ):
+        self.name = name
+        self.model = model
+        self.client = client
+        self.admission = admission
+        self.max_retries = max_retries
+        self.hedging = hedging
+        self.hedge_min_delay = hedge_min_delay
+        self.latency_alpha = latency_alpha
+        # Streamed calls are timed to their first token, the others to the
+        # whole completion; kept apart so that neither skews the other
+        self.latency_ewma: Optional[float] = None
+        self.latency_samples = deque(maxlen=LATENCY_SAMPLES)
+        self.completion_latency_ewma: Optional[float] = None
+        self.completion_latency_samples = deque(maxlen=LATENCY_SAMPLES)
+        self.unhealthy_until = 0.0
+        self.consecutive_failures = 0
+        self.remaining_tokens: Optional[int] = None
+        self.max_remaining_tokens: Optional[int] = None
+
+    @property
+    def healthy(self) -> bool:
+        return time.monotonic() >= self.unhealthy_until
+
+    def quota_ratio(self) -> float:
+        # Prefer the local admission budget; fall back to the rate limit
+        # headers reported by the service.
+        if self.admission.tokens_per_minute:
+            return self.admission.remaining_tokens / self.admission.tokens_per_minute
+        if self.remaining_tokens is not None and self.max_remaining_tokens:
+            return self.remaining_tokens / self.max_remaining_tokens
+        return 1.0
+
+    def score(self, stream: bool = True) -> float:
+        # Deployments without latency samples score 0 so they get explored
+        latency = (self.latency_ewma if stream else self.completion_latency_ewma) or 0.0
+        return latency / max(self.quota_ratio(), MIN_QUOTA_RATIO)
+
+    def hedge_delay(self, stream: bool = True) -> Optional[float]:
+        # Time to first token (or to the whole completion) after which a
+        # hedged request is sent elsewhere
+        samples = self.latency_samples if stream else self.completion_latency_samples
+        if not self.hedging or len(samples) < MIN_HEDGE_SAMPLES:
+            return None
+        return max(percentile(samples, HEDGE_PERCENTILE), self.hedge_min_delay)
+
+    def retry_delay(self, attempt: int) -> float:
+        delay = max(self.unhealthy_until - time.monotonic(), 0.0)
+        return max(delay, backoff_delay(attempt))
+
+    def record_success(self, latency: float, headers=None, stream: bool = True):
+        self.consecutive_failures = 0
+        self.unhealthy_until = 0.0
+        if stream:
+            self.latency_samples.append(latency)
+            self.latency_ewma = self._moving_average(self.latency_ewma, latency)
+        else:
+            self.completion_latency_samples.append(latency)
+            self.completion_latency_ewma = self._moving_average(self.completion_latency_ewma, latency)
+
+        remaining = headers.get("x-ratelimit-remaining-tokens") if headers else None
+        if remaining and remaining.isdigit():
+            self.remaining_tokens = int(remaining)
+            self.max_remaining_tokens = max(self.max_remaining_tokens or 0, self.remaining_tokens)
+
+    def _moving_average(self, average: Optional[float], latency: float) -> float:
+        if average is None:
+            return latency
+        return average + self.latency_alpha * (latency - average)
+
+    def record_failure(self, error: Exception):
+        if isinstance(error, AdmissionTimeoutError) or not is_retryable(error):
+            return
+
+        self.consecutive_failures += 1
+        response = getattr(error, "response", None)
+        cooldown = parse_retry_after(response.headers if response is not None else None)
+        if cooldown is None:
+            if getattr(error, "status_code", None) == 429:
+                cooldown = DEFAULT_THROTTLE_COOLDOWN
+            else:
+                cooldown = min(
+                    BASE_FAILURE_COOLDOWN * 2 ** (self.consecutive_failures - 1),
+                    MAX_FAILURE_COOLDOWN,
+                )
+        self.unhealthy_until = time.monotonic() + cooldown
+        logging.warning(
+            f"Deployment {self.name} marked unhealthy for {cooldown:.1f}s: {error}"
+        )
+
+
+class DeploymentRouter:
+    """
+    Routes chat completions across one or more Azure OpenAI deployments.
+
+    Healthy deployments are tried in order of observed latency weighted by
+    remaining quota. Throttling, server errors and streams that fail before
+    emitting any content are retried, on another deployment when one is
+    available, otherwise on the same one once its retry-after has passed.
+    Deployments with hedging enabled send a second request to another
+    deployment when the first token takes longer than their p95 latency.
+    """
+
+    def __init__(self, deployments: List[Deployment], max_retry_delay: float = MAX_RETRY_DELAY):
+        if not deployments:
+            raise ValueError("At least one Azure OpenAI deployment is required")
+        self.deployments = deployments
+        self.max_retry_delay = max_retry_delay
+
+    @property
+    def primary(self) -> Deployment:
+        return self.deployments[0]
+
+    def candidates(self, stream: bool = True) -> List[Deployment]:
+        healthy = sorted(
+            (d for d in self.deployments if d.healthy), key=lambda d: d.score(stream)
+        )
+        # Unhealthy deployments are kept as a last resort, soonest to recover first
+        unhealthy = sorted(
+            (d for d in self.deployments if not d.healthy),
+            key=lambda d: d.unhealthy_until,
+        )
+        return healthy + unhealthy
+
+    async def create_chat_completion(self, model_args: dict, raw_stream: bool = False):
+        # raw_stream: yield streamed chunks as decoded dicts (RawChatStream)
+        # instead of SDK ChatCompletionChunk objects
+        stream = bool(model_args.get("stream"))
+        attempts: Dict[str, int] = {}
+        last_error = None
+        while True:
+            candidates = [
+                d for d in self.candidates(stream) if attempts.get(d.name, 0) <= d.max_retries
+            ]
+            if not candidates:
+                raise last_error
+
+            deployment = candidates[0]
+            untried = [d for d in candidates[1:] if d.name not in attempts]
+            delay = deployment.retry_delay(attempts.get(deployment.name, 0))
+            if delay > self.max_retry_delay and last_error:
+                # Waiting this long would outlast the request
+                attempts[deployment.name] = deployment.max_retries + 1
+                continue
+            if delay > 0:
+                logging.debug(f"Retrying deployment {deployment.name} in {delay:.2f}s")
+                await asyncio.sleep(delay)
+
+            attempts[deployment.name] = attempts.get(deployment.name, 0) + 1
+            hedge_delay = deployment.hedge_delay(stream)
+            backup = next((d for d in untried if d.healthy), None)
+            try:
+                if hedge_delay is not None and backup:
+                    return await self._create_hedged(
+                        deployment, backup, model_args, hedge_delay, attempts, raw_stream
+                    )
+                # Queue in the admission budget only when there is nowhere
+                # else to go; otherwise fail over immediately
+                return await self._create(
+                    deployment, model_args, max_wait=0 if untried else None, raw_stream=raw_stream
+                )
+            except Exception as e:
+                if not is_retryable(e):
+                    raise
+                if isinstance(e, AdmissionTimeoutError) and not untried:
+                    # Already waited the full admission time
+                    raise
+                last_error = e
+                logging.warning(f"Deployment {deployment.name} failed, retrying: {e}")
+
+    async def _create_hedged(self, deployment, backup, model_args, hedge_delay, attempts, raw_stream):
+        primary_task = asyncio.create_task(
+            self._create(deployment, model_args, raw_stream=raw_stream)
+        )
+        done, _ = await asyncio.wait({primary_task}, timeout=hedge_delay)
+        if done:
+            return primary_task.result()
+
+        logging.debug(
+            f"No first token from {deployment.name} after {hedge_delay:.2f}s, hedging to {backup.name}"
+        )
+        attempts[backup.name] = attempts.get(backup.name, 0) + 1
+        hedge_task = asyncio.create_task(
+            self._create(backup, model_args, max_wait=0, raw_stream=raw_stream)
+        )
+        pending = {primary_task, hedge_task}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winner = None
+                for task in done:
+                    if task.exception():
+                        error = task.exception()
+                    elif winner is None:
+                        winner = task.result()
+                    else:
+                        await discard_response(task.result()[0])
+                if winner:
+                    return winner
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+            # Let the loser release its admission ticket and connection; it may
+            # have finished while a response was being discarded
+            for result in await asyncio.gather(*pending, return_exceptions=True):
+                if isinstance(result, tuple):
+                    await discard_response(result[0])
+
+    async def _create(self, deployment: Deployment, model_args: dict, max_wait=None, raw_stream=False):
+        args = {**model_args, "model": deployment.model}
+        attributes = {
+            "gen_ai.system": "az.ai.openai",
+            "gen_ai.operation.name": "chat",
+            "gen_ai.request.model": deployment.model,
+            "azure_openai.deployment": deployment.name,
+            "azure_openai.stream": bool(args.get("stream")),
+        }
+        # For streams the span ends with the first token
+        with span(f"chat {deployment.model}", attributes, SpanKind.CLIENT):
+            queued_at = time.monotonic()
+            ticket = await deployment.admission.acquire(args, max_wait=max_wait)
+            start = time.monotonic()
+            set_span_attributes({"azure_openai.admission_wait_seconds": start - queued_at})
+            try:
+                raw_response = await deployment.client.chat.completions.with_raw_response.create(**args)
+                if args.get("stream") and raw_stream:
+                    response = RawChatStream(raw_response.http_response)
+                else:
+                    response = raw_response.parse()
+                if args.get("stream"):
+                    response = await self._prefetch_first_token(response)
+            except Exception as e:
+                ticket.release()
+                deployment.record_failure(e)
+                raise
+            except BaseException:
+                # Cancelled, e.g. the losing side of a hedged request
+                ticket.release()
+                raise
+
+            latency = time.monotonic() - start
+            deployment.record_success(latency, raw_response.headers, stream=bool(args.get("stream")))
+            observe_upstream_latency(deployment.name, latency)
+            if args.get("stream"):
+                response = ticket.track_stream(response)
+            else:
+                ticket.release(response.usage.completion_tokens if response.usage else None)
+                set_span_attributes({
+                    "gen_ai.usage.input_tokens": response.usage.prompt_tokens if response.usage else None,
+                    "gen_ai.usage.output_tokens": response.usage.completion_tokens if response.usage else None,
+                })
+
+            return response, raw_response.headers.get("apim-request-id")
+
+    async def _prefetch_first_token(self, stream):
+        # Read ahead until the first content delta so that a stream failing
+        # before it produced any tokens can still be retried elsewhere.
+        buffered = []
+        try:
+            while True:
+                chunk = await stream.__anext__()
+                buffered.append(chunk)
+                if has_content(chunk):
+                    break
+        except StopAsyncIteration:
+            pass
+        except BaseException:
+            await stream.close()
+            raise
+
+        return PrefetchedStream(buffered, stream)
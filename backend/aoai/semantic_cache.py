@@ -0,0 +1,247 @@
+import asyncio
+import time
+from dataclasses import dataclass
+from typing import Awaitable, Callable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from backend.aoai.cache import CachedCompletion, normalize_content, response_cache_key
+
+INITIAL_CAPACITY = 1024
+# Above this many entries the similarity search runs off the event loop
+OFFLOAD_THRESHOLD = 10000
+
+
+def first_question(messages) -> Optional[str]:
+    # Only opening questions are matched semantically: the answer to a
+    # follow-up depends on the whole conversation.
+    turns = [message for message in messages if message.get("role") not in ("system", "tool")]
+    if len(turns) != 1 or turns[0].get("role") != "user":
+        return None
+    content = normalize_content(turns[0].get("content"))
+    return content if isinstance(content, str) and content else None
+
+
+def semantic_scope_key(model_args: dict) -> int:
+    # Answers are only shared between requests with the same system message,
+    # data source (including permission filters) and model parameters.
+    scope_args = {
+        **model_args,
+        "messages": [m for m in model_args.get("messages", []) if m.get("role") == "system"],
+    }
+    return int(response_cache_key(scope_args)[:16], 16)
+
+
+def _best_match(vectors, scopes, scope: int, vector) -> Tuple[int, float]:
+    scores = vectors @ vector
+    scores[scopes != np.uint64(scope)] = -1.0
+    slot = int(np.argmax(scores))
+    return slot, float(scores[slot])
+
+
+class AzureOpenAIEmbedder:
+    """
+    Embeds text with the AZURE_OPENAI_EMBEDDING_NAME deployment on the chat
+    client's resource, or by calling AZURE_OPENAI_EMBEDDING_ENDPOINT directly.
+    """
+
+    def __init__(
+        self,
+        client=None,
+        deployment: Optional[str] = None,
+        endpoint: Optional[str] = None,
+        http_client=None,
+        get_headers: Optional[Callable[[], Awaitable[dict]]] = None,
+    ):
+        if not (client and deployment) and not (endpoint and http_client):
+            raise ValueError(
+                "AZURE_OPENAI_EMBEDDING_NAME or AZURE_OPENAI_EMBEDDING_ENDPOINT is required"
+            )
+        self._client = client
+        self._deployment = deployment
+        self._endpoint = endpoint
+        self._http_client = http_client
+        self._get_headers = get_headers
+
+    async def __call__(self, text: str) -> List[float]:
+        if self._client and self._deployment:
+            response = await self._client.embeddings.create(model=self._deployment, input=[text])
+            return response.data[0].embedding
+
+        headers = await self._get_headers() if self._get_headers else {}
+        response = await self._http_client.post(
+            self._endpoint, json={"input": [text]}, headers=headers
+        )
+        response.raise_for_status()
+        return response.json()["data"][0]["embedding"]
+
+    async def close(self):
+        if self._http_client:
+            await self._http_client.aclose()
+
+
+@dataclass
+class SemanticCacheStats:
+    hits: int = 0
+    misses: int = 0
+    stores: int = 0
+    evictions: int = 0
+    expirations: int = 0
+    embedding_failures: int = 0
+    search_seconds_total: float = 0.0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def snapshot(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "embedding_failures": self.embedding_failures,
+            "search_avg_seconds": self.search_seconds_total / lookups if lookups else 0.0,
+        }
+
+
+class SemanticCache:
+    """
+    Per-worker cache of answers to opening questions, matched by cosine
+    similarity of their embeddings.
+
+    Embeddings are kept L2-normalized in a float32 matrix that grows up to
+    `max_entries` rows, so the index needs at most max_entries x dimensions x
+    4 bytes. Once full, the least recently used entry is replaced.
+    """
+
+    def __init__(
+        self,
+        embed: Callable[[str], Awaitable[Sequence[float]]],
+        threshold: float = 0.95,
+        max_entries: int = 10000,
+        ttl: float = 3600,
+    ):
+        self._embed = embed
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._vectors: Optional[np.ndarray] = None
+        self._scopes = np.zeros(0, dtype=np.uint64)
+        self._last_used = np.zeros(0, dtype=np.float64)
+        self._stored_at = np.zeros(0, dtype=np.float64)
+        self._entries: List[Optional[CachedCompletion]] = []
+        self._size = 0
+        self.stats = SemanticCacheStats()
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    async def embed(self, text: str) -> np.ndarray:
+        vector = np.asarray(await self._embed(text), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def search(self, scope: int, vector: np.ndarray) -> Tuple[Optional[int], float]:
+        if not self._size or vector.shape[0] != self._vectors.shape[1]:
+            return None, 0.0
+        return _best_match(self._vectors[: self._size], self._scopes[: self._size], scope, vector)
+
+    async def get(self, scope: int, vector: np.ndarray) -> Optional[CachedCompletion]:
+        start = time.perf_counter()
+        if self._size >= OFFLOAD_THRESHOLD and vector.shape[0] == self._vectors.shape[1]:
+            # Search views taken on the event loop so growing the index
+            # concurrently cannot tear them
+            slot, score = await asyncio.to_thread(
+                _best_match,
+                self._vectors[: self._size],
+                self._scopes[: self._size],
+                scope,
+                vector,
+            )
+        else:
+            slot, score = self.search(scope, vector)
+        self.stats.search_seconds_total += time.perf_counter() - start
+
+        if slot is not None and score >= self.threshold:
+            # The slot may have been reused while the search ran in a thread
+            if (
+                slot < self._size
+                and self._scopes[slot] == np.uint64(scope)
+                and float(self._vectors[slot] @ vector) >= self.threshold
+            ):
+                now = time.monotonic()
+                if now - self._stored_at[slot] > self.ttl:
+                    self._free(slot)
+                    self.stats.expirations += 1
+                else:
+                    self._last_used[slot] = now
+                    self.stats.hits += 1
+                    return self._entries[slot]
+
+        self.stats.misses += 1
+        return None
+
+    def put(self, scope: int, vector: np.ndarray, entry: CachedCompletion):
+        if self._vectors is not None and vector.shape[0] != self._vectors.shape[1]:
+            # The embedding model changed; earlier vectors are not comparable
+            self.clear()
+        if self._vectors is None:
+            self._allocate(min(INITIAL_CAPACITY, self.max_entries), vector.shape[0])
+
+        if self._size < self.max_entries:
+            if self._size == self._vectors.shape[0]:
+                self._allocate(min(self._size * 2, self.max_entries), vector.shape[0])
+            slot = self._size
+            self._size += 1
+            self._entries.append(None)
+        else:
+            slot = int(np.argmin(self._last_used[: self._size]))
+            if self._entries[slot] is not None:
+                self.stats.evictions += 1
+
+        now = time.monotonic()
+        self._vectors[slot] = vector
+        self._scopes[slot] = np.uint64(scope)
+        self._last_used[slot] = now
+        self._stored_at[slot] = now
+        self._entries[slot] = entry
+        self.stats.stores += 1
+
+    async def close(self):
+        if hasattr(self._embed, "close"):
+            await self._embed.close()
+
+    def clear(self):
+        self._vectors = None
+        self._scopes = np.zeros(0, dtype=np.uint64)
+        self._last_used = np.zeros(0, dtype=np.float64)
+        self._stored_at = np.zeros(0, dtype=np.float64)
+        self._entries = []
+        self._size = 0
+
+    def _free(self, slot: int):
+        # Zeroed rows never reach the threshold and are reused first
+        self._vectors[slot] = 0.0
+        self._last_used[slot] = -np.inf
+        self._entries[slot] = None
+
+    def _allocate(self, capacity: int, dimensions: int):
+        vectors = np.zeros((capacity, dimensions), dtype=np.float32)
+        scopes = np.zeros(capacity, dtype=np.uint64)
+        last_used = np.zeros(capacity, dtype=np.float64)
+        stored_at = np.zeros(capacity, dtype=np.float64)
+        if self._vectors is not None:
+            vectors[: self._size] = self._vectors[: self._size]
+            scopes[: self._size] = self._scopes[: self._size]
+            last_used[: self._size] = self._last_used[: self._size]
+            stored_at[: self._size] = self._stored_at[: self._size]
+        self._vectors = vectors
+        self._scopes = scopes
+        self._last_used = last_used
+        self._stored_at = stored_at
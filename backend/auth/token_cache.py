@@ -0,0 +1,218 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+from azure.core.credentials import AccessToken
+
+from backend.metrics import (
+    TOKEN_BACKGROUND_REFRESHES,
+    TOKEN_CACHE_LOOKUPS,
+    TOKEN_FETCH_FAILURES,
+    TOKEN_FETCH_SECONDS,
+)
+
+COGNITIVE_SERVICES_SCOPE = "https://cognitiveservices.azure.com/.default"
+
+
+@dataclass
+class TokenCacheStats:
+    hits: int = 0
+    misses: int = 0
+    fetches: int = 0
+    fetch_failures: int = 0
+    background_refreshes: int = 0
+    fetch_latency_total: float = 0.0
+    fetch_latency_max: float = 0.0
+    fetch_latency_last: float = 0.0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    @property
+    def fetch_latency_avg(self) -> float:
+        return self.fetch_latency_total / self.fetches if self.fetches else 0.0
+
+    def record_lookup(self, hit: bool):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        TOKEN_CACHE_LOOKUPS.labels("hit" if hit else "miss").inc()
+
+    def record_fetch(self, latency: float):
+        self.fetches += 1
+        self.fetch_latency_total += latency
+        self.fetch_latency_last = latency
+        self.fetch_latency_max = max(self.fetch_latency_max, latency)
+        TOKEN_FETCH_SECONDS.observe(latency)
+
+    def record_fetch_failure(self):
+        self.fetch_failures += 1
+        TOKEN_FETCH_FAILURES.inc()
+
+    def record_background_refresh(self):
+        self.background_refreshes += 1
+        TOKEN_BACKGROUND_REFRESHES.inc()
+
+    def snapshot(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate,
+            "fetches": self.fetches,
+            "fetch_failures": self.fetch_failures,
+            "background_refreshes": self.background_refreshes,
+            "fetch_latency_avg_seconds": self.fetch_latency_avg,
+            "fetch_latency_max_seconds": self.fetch_latency_max,
+            "fetch_latency_last_seconds": self.fetch_latency_last,
+        }
+
+
+@dataclass
+class _CachedToken:
+    token: AccessToken
+    refresh_task: Optional[asyncio.Task] = None
+
+
+class CachedTokenCredential:
+    """
+    Async token credential shared by the Azure OpenAI and CosmosDB clients.
+
+    Tokens are cached per scope and refreshed in the background ahead of
+    their expiry, so request handlers only block on the very first fetch.
+    """
+
+    def __init__(
+        self,
+        credential,
+        refresh_margin: float = 300,
+        retry_interval: float = 30,
+        min_validity: float = 60,
+    ):
+        self._credential = credential
+        self._refresh_margin = refresh_margin
+        self._retry_interval = retry_interval
+        self._min_validity = min_validity
+        self._entries: Dict[Tuple, _CachedToken] = {}
+        self._fetch_locks: Dict[Tuple, asyncio.Lock] = {}
+        self._warm_up_tasks = set()
+        self._closed = False
+        self.stats = TokenCacheStats()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def get_token(self, *scopes: str, **kwargs) -> AccessToken:
+        # Claims challenges (CAE) must always go to the identity provider
+        if kwargs.get("claims"):
+            self.stats.record_lookup(hit=False)
+            return await self._fetch(scopes, kwargs)
+
+        key = (scopes, kwargs.get("tenant_id"))
+        entry = self._entries.get(key)
+        if entry and self._is_valid(entry.token):
+            self.stats.record_lookup(hit=True)
+            return entry.token
+
+        self.stats.record_lookup(hit=False)
+        lock = self._fetch_locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            # Another request may have fetched the token while we waited
+            entry = self._entries.get(key)
+            if entry and self._is_valid(entry.token):
+                return entry.token
+
+            token = await self._fetch(scopes, kwargs)
+            self._store(key, token, kwargs)
+            return token
+
+    def bearer_token_provider(self, *scopes: str):
+        async def wrapper() -> str:
+            token = await self.get_token(*scopes)
+            return token.token
+
+        return wrapper
+
+    def warm_up(self, *scopes: str) -> asyncio.Task:
+        async def fetch():
+            try:
+                await self.get_token(*scopes)
+            except Exception:
+                logging.exception(f"Failed to prefetch token for {scopes}")
+
+        task = asyncio.create_task(fetch())
+        self._warm_up_tasks.add(task)
+        task.add_done_callback(self._warm_up_tasks.discard)
+        return task
+
+    async def close(self):
+        self._closed = True
+        for entry in self._entries.values():
+            if entry.refresh_task:
+                entry.refresh_task.cancel()
+        self._entries.clear()
+        await self._credential.close()
+
+    def _is_valid(self, token: AccessToken) -> bool:
+        return token.expires_on - time.time() > self._min_validity
+
+    async def _fetch(self, scopes, kwargs) -> AccessToken:
+        start = time.perf_counter()
+        try:
+            token = await self._credential.get_token(*scopes, **kwargs)
+        except Exception:
+            self.stats.record_fetch_failure()
+            raise
+        self.stats.record_fetch(time.perf_counter() - start)
+        logging.debug(
+            f"Fetched token for {scopes} in {self.stats.fetch_latency_last:.3f}s"
+        )
+        return token
+
+    def _store(self, key, token: AccessToken, kwargs):
+        entry = self._entries.get(key)
+        if entry:
+            entry.token = token
+        else:
+            entry = self._entries[key] = _CachedToken(token=token)
+
+        if not self._closed and (not entry.refresh_task or entry.refresh_task.done()):
+            entry.refresh_task = asyncio.create_task(
+                self._refresh_loop(key, dict(kwargs))
+            )
+
+    async def _refresh_loop(self, key, kwargs):
+        scopes = key[0]
+        while not self._closed:
+            entry = self._entries.get(key)
+            if not entry:
+                return
+
+            remaining = entry.token.expires_on - time.time()
+            if remaining > 2 * self._refresh_margin:
+                delay = remaining - self._refresh_margin
+            else:
+                # Short-lived token: refresh halfway through its lifetime
+                delay = max(remaining / 2, 1)
+            await asyncio.sleep(delay)
+
+            try:
+                token = await self._fetch(scopes, kwargs)
+            except Exception:
+                logging.exception(f"Background token refresh failed for {scopes}")
+                # Keep serving the current token and retry while it is valid
+                if not self._is_valid(entry.token):
+                    self._entries.pop(key, None)
+                    return
+                await asyncio.sleep(self._retry_interval)
+                continue
+
+            entry.token = token
+            self.stats.record_background_refresh()
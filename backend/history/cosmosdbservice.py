@@ -1,16 +1,145 @@
-import uuid
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
 from datetime import datetime
 from azure.cosmos.aio import CosmosClient
 from azure.cosmos import exceptions
-  
-class CosmosConversationClient():
+from opentelemetry.trace import SpanKind
+from backend.history.store import HistoryStore, InvalidContinuationToken
+from backend.metrics import count_cache_lookup
+from backend.tracing import set_span_attributes, span
+
+# Cosmos DB accepts at most 100 operations in one transactional batch
+DELETE_BATCH_SIZE = 100
+# Batches of one bulk delete in flight at the same time
+DELETE_CONCURRENCY = 4
+
+# Response headers recorded for every operation, summed over the pages of a query
+REQUEST_CHARGE_HEADER = 'x-ms-request-charge'
+REQUEST_DURATION_HEADER = 'x-ms-request-duration-ms'
+RETRY_COUNT_HEADER = 'x-ms-throttle-retry-count'
+
+
+class ConversationCache:
+    """
+    Per-worker read-through cache of conversation documents. Writes made by
+    this worker invalidate their entry; writes made by other workers become
+    visible after `ttl` seconds.
+    """
+
+    def __init__(self, max_entries: int = 1000, ttl: float = 30):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, user_id, conversation_id):
+        entry = self._entries.get((user_id, conversation_id))
+        if not entry or time.monotonic() - entry[0] > self.ttl:
+            self.misses += 1
+            count_cache_lookup("conversation", hit=False)
+            return None
+        self._entries.move_to_end((user_id, conversation_id))
+        self.hits += 1
+        count_cache_lookup("conversation", hit=True)
+        return dict(entry[1])
+
+    def put(self, user_id, conversation_id, conversation):
+        if self.ttl <= 0 or self.max_entries <= 0:
+            return
+        self._entries[(user_id, conversation_id)] = (time.monotonic(), dict(conversation))
+        self._entries.move_to_end((user_id, conversation_id))
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, user_id, conversation_id):
+        self._entries.pop((user_id, conversation_id), None)
+
+
+class ConversationListCache:
+    """
+    Per-worker LRU cache of the first pages of users' conversation lists,
+    newest first. Writes made by this worker update or invalidate the user's
+    pages; writes made by other workers become visible after `ttl` seconds.
+    """
+
+    def __init__(self, max_users: int = 1000, ttl: float = 30, max_pages: int = 2):
+        self.max_users = max_users
+        self.ttl = ttl
+        self.max_pages = max_pages
+        self.hits = 0
+        self.misses = 0
+        ## request charge of the queries the hits did not have to run
+        self.request_charge_saved = 0.0
+        self._users = OrderedDict()
+
+    def get(self, user_id, limit, continuation_token):
+        pages = self._users.get(user_id, {})
+        page = pages.get((limit, continuation_token))
+        if not page or time.monotonic() - page['cached_at'] > self.ttl:
+            self.misses += 1
+            count_cache_lookup("conversation_list", hit=False)
+            return None
+        self._users.move_to_end(user_id)
+        self.hits += 1
+        self.request_charge_saved += page['request_charge']
+        count_cache_lookup("conversation_list", hit=True, request_charge_saved=page['request_charge'])
+        return [dict(item) for item in page['items']], page['continuation_token']
+
+    def put(self, user_id, limit, continuation_token, items, next_token, request_charge):
+        if self.ttl <= 0 or self.max_users <= 0:
+            return
+        pages = self._users.setdefault(user_id, {})
+        if (limit, continuation_token) not in pages and len(pages) >= self.max_pages:
+            return
+        pages[(limit, continuation_token)] = {
+            'cached_at': time.monotonic(),
+            'items': [dict(item) for item in items],
+            'continuation_token': next_token,
+            'request_charge': request_charge
+        }
+        self._users.move_to_end(user_id)
+        while len(self._users) > self.max_users:
+            self._users.popitem(last=False)
+
+    def update(self, user_id, conversation_id, **fields):
+        ## a change that keeps the list order, e.g. a new title
+        for page in self._users.get(user_id, {}).values():
+            for item in page['items']:
+                if item['id'] == conversation_id:
+                    item.update(fields)
+
+    def touch(self, user_id, conversation_id, updated_at):
+        ## a conversation on a first page moves to its top, which leaves the following
+        ## pages as they are; anywhere else it changes their boundaries
+        pages = self._users.get(user_id, {})
+        for (limit, continuation_token), page in pages.items():
+            if continuation_token is None:
+                moved = [item for item in page['items'] if item['id'] == conversation_id]
+                if not moved:
+                    return self.invalidate(user_id)
+                moved[0]['updatedAt'] = max(moved[0]['updatedAt'], updated_at)
+                page['items'].remove(moved[0])
+                page['items'].insert(0, moved[0])
+
+    def invalidate(self, user_id):
+        self._users.pop(user_id, None)
+
+
+class CosmosConversationClient(HistoryStore):
     
-    def __init__(self, cosmosdb_endpoint: str, credential: any, database_name: str, container_name: str, enable_message_feedback: bool = False):
+    def __init__(self, cosmosdb_endpoint: str, credential: any, database_name: str, container_name: str, enable_message_feedback: bool = False, conversation_cache: ConversationCache = None, conversation_list_cache: ConversationListCache = None):
+        super().__init__()
         self.cosmosdb_endpoint = cosmosdb_endpoint
         self.credential = credential
         self.database_name = database_name
         self.container_name = container_name
         self.enable_message_feedback = enable_message_feedback
+        self.conversation_cache = conversation_cache or ConversationCache(ttl=0)
+        self.conversation_list_cache = conversation_list_cache or ConversationListCache(ttl=0)
         try:
             self.cosmosdb_client = CosmosClient(self.cosmosdb_endpoint, credential=credential)
         except exceptions.CosmosHttpResponseError as e:
@@ -30,6 +159,9 @@ class CosmosConversationClient():
             raise ValueError("Invalid CosmosDB container name") 
         
 
+    async def close(self):
+        await self.cosmosdb_client.close()
+
     async def ensure(self):
         if not self.cosmosdb_client or not self.database_client or not self.container_client:
             return False, "CosmosDB client not initialized correctly"
@@ -46,46 +178,140 @@ class CosmosConversationClient():
         return True, "CosmosDB client initialized successfully"
 
     async def create_conversation(self, user_id, title = ''):
-        conversation = {
-            'id': str(uuid.uuid4()),  
-            'type': 'conversation',
-            'createdAt': datetime.utcnow().isoformat(),  
-            'updatedAt': datetime.utcnow().isoformat(),  
-            'userId': user_id,
-            'title': title
-        }
+        conversation = self._new_conversation(user_id, title)
         ## TODO: add some error handling based on the output of the upsert_item call
-        resp = await self.container_client.upsert_item(conversation)  
+        resp = await self._call('create_conversation', self.container_client.upsert_item, body=conversation)
+        self.conversation_list_cache.invalidate(user_id)
         if resp:
             return resp
         else:
             return False
     
     async def upsert_conversation(self, conversation):
-        resp = await self.container_client.upsert_item(conversation)
+        self.conversation_cache.invalidate(conversation['userId'], conversation['id'])
+        resp = await self._call('upsert_conversation', self.container_client.upsert_item, body=conversation)
+        self.conversation_list_cache.invalidate(conversation['userId'])
+        if resp:
+            return resp
+        else:
+            return False
+
+    async def update_conversation_title(self, user_id, conversation_id, title):
+        ## partial update, so it cannot overwrite a concurrent updatedAt change
+        self.conversation_cache.invalidate(user_id, conversation_id)
+        resp = await self._call(
+            'update_title',
+            self.container_client.patch_item,
+            item=conversation_id,
+            partition_key=user_id,
+            patch_operations=[{'op': 'set', 'path': '/title', 'value': title}]
+        )
+        self.conversation_list_cache.update(user_id, conversation_id, title=title)
         if resp:
             return resp
         else:
             return False
 
     async def delete_conversation(self, user_id, conversation_id):
-        conversation = await self.container_client.read_item(item=conversation_id, partition_key=user_id)        
+        self.conversation_cache.invalidate(user_id, conversation_id)
+        conversation = await self._call('read_conversation', self.container_client.read_item, item=conversation_id, partition_key=user_id)
         if conversation:
-            resp = await self.container_client.delete_item(item=conversation_id, partition_key=user_id)
+            resp = await self._call('delete_item', self.container_client.delete_item, item=conversation_id, partition_key=user_id)
+            self.conversation_list_cache.invalidate(user_id)
             return resp
         else:
             return True
 
         
-    async def delete_messages(self, conversation_id, user_id):
-        ## get a list of all the messages in the conversation
-        messages = await self.get_messages(user_id, conversation_id)
-        response_list = []
-        if messages:
-            for message in messages:
-                resp = await self.container_client.delete_item(item=message['id'], partition_key=user_id)
-                response_list.append(resp)
-            return response_list
+    async def get_deletion_ids(self, user_id, conversation_id=None, messages_only=False):
+        ## conversations come first, so they leave the history list before their messages are gone
+        parameters = [
+            {
+                'name': '@userId',
+                'value': user_id
+            }
+        ]
+        if conversation_id:
+            parameters.append({'name': '@conversationId', 'value': conversation_id})
+            query = "SELECT VALUE c.id FROM c WHERE c.userId = @userId AND c.type='message' AND c.conversationId = @conversationId"
+        else:
+            query = "SELECT c.id, c.type FROM c WHERE c.userId = @userId AND (c.type='conversation' OR c.type='message')"
+
+        items = await self._query_all('list_deletion_ids', query, parameters, user_id)
+
+        if conversation_id:
+            return items if messages_only else [conversation_id] + items
+        conversations = [item['id'] for item in items if item['type'] == 'conversation']
+        messages = [item['id'] for item in items if item['type'] != 'conversation']
+        return conversations + messages
+
+    async def delete_items(self, user_id, item_ids):
+        ## deletes documents of one partition in transactional batches, a few batches at a
+        ## time; returns the number of documents deleted
+        semaphore = asyncio.Semaphore(DELETE_CONCURRENCY)
+
+        async def delete_batch(batch_ids):
+            async with semaphore:
+                try:
+                    return await self._delete_batch(user_id, batch_ids)
+                finally:
+                    self.conversation_list_cache.invalidate(user_id)
+
+        batches = [item_ids[i:i + DELETE_BATCH_SIZE] for i in range(0, len(item_ids), DELETE_BATCH_SIZE)]
+        return sum(await asyncio.gather(*(delete_batch(batch) for batch in batches)))
+
+    async def _delete_batch(self, user_id, batch_ids):
+        for item_id in batch_ids:
+            self.conversation_cache.invalidate(user_id, item_id)
+        try:
+            await self._execute_batch(
+                'delete_items', [('delete', (item_id,)) for item_id in batch_ids], user_id
+            )
+            return len(batch_ids)
+        except exceptions.CosmosBatchOperationError as e:
+            if int(e.operation_responses[e.error_index]['statusCode']) != 404:
+                raise
+        ## a document of the batch is already gone (e.g. a concurrent delete),
+        ## which fails the whole batch: delete the rest one by one
+        deleted = 0
+        for item_id in batch_ids:
+            try:
+                await self._call('delete_item', self.container_client.delete_item, item=item_id, partition_key=user_id)
+                deleted += 1
+            except exceptions.CosmosResourceNotFoundError:
+                pass
+        return deleted
+
+    async def create_deletion_job(self, user_id, item_count):
+        ## the status of a background delete is kept in the user's partition, so any
+        ## worker can answer for it; it expires as TTL is enabled on the container (infra/db.bicep)
+        job = self._new_deletion_job(user_id, item_count)
+        return await self._call('create_deletion_job', self.container_client.create_item, body=job)
+
+    async def update_deletion_job(self, user_id, job_id, status, deleted=0, error=None):
+        patch_operations = [
+            {'op': 'set', 'path': '/status', 'value': status},
+            {'op': 'set', 'path': '/deleted', 'value': deleted},
+            {'op': 'set', 'path': '/updatedAt', 'value': datetime.utcnow().isoformat()}
+        ]
+        if error:
+            patch_operations.append({'op': 'set', 'path': '/error', 'value': error})
+        return await self._call(
+            'update_deletion_job',
+            self.container_client.patch_item,
+            item=job_id,
+            partition_key=user_id,
+            patch_operations=patch_operations
+        )
+
+    async def get_deletion_job(self, user_id, job_id):
+        try:
+            job = await self._call('read_deletion_job', self.container_client.read_item, item=job_id, partition_key=user_id)
+        except exceptions.CosmosResourceNotFoundError:
+            return None
+        if job.get('type') != 'deletion_job':
+            return None
+        return job
 
 
     async def get_conversations(self, user_id, limit, sort_order = 'DESC', offset = 0):
@@ -99,66 +325,148 @@ class CosmosConversationClient():
         if limit is not None:
             query += f" offset {offset} limit {limit}" 
         
-        conversations = []
-        async for item in self.container_client.query_items(query=query, parameters=parameters):
-            conversations.append(item)
-        
-        return conversations
+        return await self._query_all('list_conversations', query, parameters, user_id)
+
+    async def get_conversations_page(self, user_id, limit, continuation_token=None, sort_order = 'DESC'):
+        ## one page of conversations and the continuation token of the next one (None on the last
+        ## page); unlike OFFSET, the cost of a page does not grow with its position
+        cacheable = sort_order == 'DESC'
+        if cacheable:
+            page = self.conversation_list_cache.get(user_id, limit, continuation_token)
+            if page:
+                return page
 
-    async def get_conversation(self, user_id, conversation_id):
         parameters = [
-            {
-                'name': '@conversationId',
-                'value': conversation_id
-            },
             {
                 'name': '@userId',
                 'value': user_id
             }
         ]
-        query = f"SELECT * FROM c where c.id = @conversationId and c.type='conversation' and c.userId = @userId"
-        conversations = []
-        async for item in self.container_client.query_items(query=query, parameters=parameters):
-            conversations.append(item)
+        query = f"SELECT * FROM c where c.userId = @userId and c.type='conversation' order by c.updatedAt {sort_order}"
+        conversations, next_token, request_charge = await self._query_page(
+            'list_conversations', query, parameters, user_id, limit, continuation_token
+        )
+        if cacheable:
+            self.conversation_list_cache.put(user_id, limit, continuation_token, conversations, next_token, request_charge)
+        return conversations, next_token
+
+    async def get_conversation(self, user_id, conversation_id):
+        conversation = self.conversation_cache.get(user_id, conversation_id)
+        if conversation:
+            return conversation
+
+        ## point read: the id and the partition key (userId) are both known
+        try:
+            item = await self._call(
+                'read_conversation',
+                self.container_client.read_item,
+                item=conversation_id,
+                partition_key=user_id
+            )
+        except exceptions.CosmosResourceNotFoundError:
+            return None
 
         ## if no conversations are found, return None
-        if len(conversations) == 0:
+        if item.get('type') != 'conversation':
             return None
-        else:
-            return conversations[0]
+        self.conversation_cache.put(user_id, conversation_id, item)
+        return item
  
     async def create_message(self, uuid, conversation_id, user_id, input_message: dict):
-        message = {
-            'id': uuid,
-            'type': 'message',
-            'userId' : user_id,
-            'createdAt': datetime.utcnow().isoformat(),
-            'updatedAt': datetime.utcnow().isoformat(),
-            'conversationId' : conversation_id,
-            'role': input_message['role'],
-            'content': input_message['content']
-        }
+        message = self._new_message(uuid, conversation_id, user_id, input_message)
 
-        if self.enable_message_feedback:
-            message['feedback'] = ''
-        
-        resp = await self.container_client.upsert_item(message)  
-        if resp:
-            ## update the parent conversations's updatedAt field with the current message's createdAt datetime value
-            conversation = await self.get_conversation(user_id, conversation_id)
-            if not conversation:
+        ## store the message and update the parent conversation's updatedAt field in one
+        ## transactional batch on the user's partition. The patch only applies while
+        ## updatedAt is older than the message, so concurrent appends never move it back.
+        update_conversation = (
+            'patch',
+            (conversation_id, [{'op': 'set', 'path': '/updatedAt', 'value': message['createdAt']}]),
+            {'filter_predicate': f"from c where c.updatedAt < '{message['createdAt']}'"}
+        )
+        self.conversation_cache.invalidate(user_id, conversation_id)
+        try:
+            results = await self._execute_batch(
+                'append_message', [('upsert', (message,)), update_conversation], user_id
+            )
+        except exceptions.CosmosBatchOperationError as e:
+            if e.error_index != 1:
+                raise
+            status_code = int(e.operation_responses[1]['statusCode'])
+            if status_code == 404:
                 return "Conversation not found"
-            conversation['updatedAt'] = message['createdAt']
-            await self.upsert_conversation(conversation)
-            return resp
-        else:
-            return False
+            if status_code != 412:
+                raise
+            ## a newer message already moved updatedAt forward
+            results = await self._execute_batch('append_message', [('upsert', (message,))], user_id)
+
+        self.conversation_list_cache.touch(user_id, conversation_id, message['createdAt'])
+        return results[0].get('resourceBody', message)
+
+    async def _execute_batch(self, operation, batch_operations, partition_key):
+        return await self._call(
+            operation,
+            self.container_client.execute_item_batch,
+            batch_operations=batch_operations,
+            partition_key=partition_key
+        )
+
+    async def _call(self, operation, method, **kwargs):
+        ## records the request charge, server duration, retries and latency of a single container call
+        with self._span(operation):
+            start = time.perf_counter()
+            headers = {}
+            failed = False
+            try:
+                return await method(response_hook=self._response_hook(headers), **kwargs)
+            except (exceptions.CosmosHttpResponseError, exceptions.CosmosBatchOperationError) as e:
+                self._response_hook(headers)(e.headers or {}, None)
+                failed = True
+                raise
+            finally:
+                self._record(operation, start, headers, failed)
+
+    def _span(self, operation):
+        return span(
+            f"cosmosdb {operation}",
+            {"db.system": "cosmosdb", "db.operation.name": operation, "db.collection.name": self.container_name},
+            SpanKind.CLIENT,
+        )
+
+    def _response_hook(self, headers):
+        def response_hook(response_headers, _):
+            for header in (REQUEST_CHARGE_HEADER, REQUEST_DURATION_HEADER, RETRY_COUNT_HEADER):
+                if response_headers.get(header) is not None:
+                    headers[header] = headers.get(header, 0) + float(response_headers[header])
+        return response_hook
+
+    def _record(self, operation, start, headers, failed):
+        seconds = time.perf_counter() - start
+        server_seconds = headers[REQUEST_DURATION_HEADER] / 1000 if REQUEST_DURATION_HEADER in headers else None
+        retries = int(headers.get(RETRY_COUNT_HEADER, 0))
+        self.stats.record(
+            operation, seconds, headers.get(REQUEST_CHARGE_HEADER), failed, server_seconds, retries
+        )
+        set_span_attributes({
+            "db.cosmosdb.request_charge": headers.get(REQUEST_CHARGE_HEADER),
+            "db.cosmosdb.server_duration_seconds": server_seconds,
+            "db.cosmosdb.retries": retries,
+        })
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug(json.dumps({
+                "event": "cosmosdb_operation",
+                "operation": operation,
+                "seconds": round(seconds, 6),
+                "server_seconds": server_seconds,
+                "request_charge": headers.get(REQUEST_CHARGE_HEADER),
+                "retries": retries,
+                "failed": failed
+            }))
     
     async def update_message_feedback(self, user_id, message_id, feedback):
-        message = await self.container_client.read_item(item=message_id, partition_key=user_id)
+        message = await self._call('read_message', self.container_client.read_item, item=message_id, partition_key=user_id)
         if message:
             message['feedback'] = feedback
-            resp = await self.container_client.upsert_item(message)
+            resp = await self._call('update_feedback', self.container_client.upsert_item, body=message)
             return resp
         else:
             return False
@@ -174,10 +482,68 @@ class CosmosConversationClient():
                 'value': user_id
             }
         ]
-        query = f"SELECT * FROM c WHERE c.conversationId = @conversationId AND c.type='message' AND c.userId = @userId ORDER BY c.timestamp ASC"
-        messages = []
-        async for item in self.container_client.query_items(query=query, parameters=parameters):
-            messages.append(item)
+        query = f"SELECT * FROM c WHERE c.conversationId = @conversationId AND c.type='message' AND c.userId = @userId ORDER BY c.createdAt ASC"
+        return await self._query_all('list_messages', query, parameters, user_id)
+
+    async def get_messages_page(self, user_id, conversation_id, limit, continuation_token=None, since=None):
+        ## one page of messages in creation order, optionally only those created after `since`
+        parameters = [
+            {
+                'name': '@conversationId',
+                'value': conversation_id
+            },
+            {
+                'name': '@userId',
+                'value': user_id
+            }
+        ]
+        query = "SELECT * FROM c WHERE c.conversationId = @conversationId AND c.type='message' AND c.userId = @userId"
+        if since:
+            query += " AND c.createdAt > @since"
+            parameters.append({'name': '@since', 'value': since})
+        query += " ORDER BY c.createdAt ASC"
+        messages, next_token, _ = await self._query_page(
+            'list_messages', query, parameters, user_id, limit, continuation_token
+        )
+        return messages, next_token
 
-        return messages
+    async def _query_all(self, operation, query, parameters, partition_key):
+        items, _, _ = await self._query_page(operation, query, parameters, partition_key, None, None, all_pages=True)
+        return items
 
+    async def _query_page(self, operation, query, parameters, partition_key, limit, continuation_token, all_pages=False):
+        ## returns the items of one page (or of all of them), the continuation token and the request charge
+        with self._span(operation):
+            start = time.perf_counter()
+            headers = {}
+            failed = False
+            try:
+                pages = self.container_client.query_items(
+                    query=query,
+                    parameters=parameters,
+                    partition_key=partition_key,
+                    max_item_count=limit,
+                    response_hook=self._response_hook(headers)
+                ).by_page(continuation_token)
+                ## query_items already called the hook with the headers of the client's previous request
+                headers.clear()
+                items = []
+                async for page in pages:
+                    async for item in page:
+                        items.append(item)
+                    if not all_pages:
+                        break
+                return items, pages.continuation_token, headers.get(REQUEST_CHARGE_HEADER, 0.0)
+            except exceptions.CosmosHttpResponseError as e:
+                failed = True
+                if continuation_token and e.status_code == 400:
+                    raise InvalidContinuationToken(continuation_token) from e
+                raise
+            except ValueError as e:
+                ## tokens the SDK cannot parse before sending them
+                if continuation_token:
+                    failed = True
+                    raise InvalidContinuationToken(continuation_token) from e
+                raise
+            finally:
+                self._record(operation, start, headers, failed)
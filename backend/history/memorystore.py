@@ -0,0 +1,153 @@
+from datetime import datetime
+from backend.history.store import HistoryStore, parse_offset_token
+
+
+class InMemoryConversationClient(HistoryStore):
+    """
+    Chat history kept in the memory of one app worker, for local runs and
+    benchmarks. Documents are lost on restart and not shared between workers.
+    """
+
+    def __init__(self, enable_message_feedback: bool = False):
+        super().__init__()
+        self.enable_message_feedback = enable_message_feedback
+        self.partitions = {}
+
+    async def ensure(self):
+        return True, "In-memory chat history store initialized successfully"
+
+    async def create_conversation(self, user_id, title = ''):
+        with self.stats.timed('create_conversation'):
+            return self._put(self._new_conversation(user_id, title))
+
+    async def upsert_conversation(self, conversation):
+        with self.stats.timed('upsert_conversation'):
+            return self._put(conversation)
+
+    async def update_conversation_title(self, user_id, conversation_id, title):
+        with self.stats.timed('update_title'):
+            conversation = self._get(user_id, conversation_id, 'conversation')
+            if not conversation:
+                return False
+            conversation['title'] = title
+            return dict(conversation)
+
+    async def delete_conversation(self, user_id, conversation_id):
+        await self.delete_items(user_id, [conversation_id])
+        return True
+
+    async def get_deletion_ids(self, user_id, conversation_id=None, messages_only=False):
+        with self.stats.timed('list_deletion_ids'):
+            items = self.partitions.get(user_id, {}).values()
+            if conversation_id:
+                message_ids = [
+                    item['id'] for item in items
+                    if item['type'] == 'message' and item['conversationId'] == conversation_id
+                ]
+                return message_ids if messages_only else [conversation_id] + message_ids
+            return (
+                [item['id'] for item in items if item['type'] == 'conversation'] +
+                [item['id'] for item in items if item['type'] == 'message']
+            )
+
+    async def delete_items(self, user_id, item_ids):
+        with self.stats.timed('delete_items'):
+            partition = self.partitions.get(user_id, {})
+            return sum(partition.pop(item_id, None) is not None for item_id in item_ids)
+
+    async def create_deletion_job(self, user_id, item_count):
+        with self.stats.timed('create_deletion_job'):
+            return self._put(self._new_deletion_job(user_id, item_count))
+
+    async def update_deletion_job(self, user_id, job_id, status, deleted=0, error=None):
+        with self.stats.timed('update_deletion_job'):
+            job = self._get(user_id, job_id, 'deletion_job')
+            if not job:
+                return False
+            job.update(status=status, deleted=deleted, updatedAt=datetime.utcnow().isoformat())
+            if error:
+                job['error'] = error
+            return dict(job)
+
+    async def get_deletion_job(self, user_id, job_id):
+        with self.stats.timed('read_deletion_job'):
+            job = self._get(user_id, job_id, 'deletion_job')
+            return dict(job) if job else None
+
+    async def get_conversations(self, user_id, limit, sort_order = 'DESC', offset = 0):
+        with self.stats.timed('list_conversations'):
+            conversations = self._conversations(user_id, sort_order)
+            if limit is not None:
+                conversations = conversations[offset:offset + limit]
+            return conversations
+
+    async def get_conversations_page(self, user_id, limit, continuation_token=None, sort_order = 'DESC'):
+        with self.stats.timed('list_conversations'):
+            return self._page(self._conversations(user_id, sort_order), limit, continuation_token)
+
+    async def get_conversation(self, user_id, conversation_id):
+        with self.stats.timed('read_conversation'):
+            conversation = self._get(user_id, conversation_id, 'conversation')
+            return dict(conversation) if conversation else None
+
+    async def create_message(self, uuid, conversation_id, user_id, input_message: dict):
+        with self.stats.timed('append_message'):
+            conversation = self._get(user_id, conversation_id, 'conversation')
+            if not conversation:
+                return "Conversation not found"
+            message = self._put(self._new_message(uuid, conversation_id, user_id, input_message))
+            ## updatedAt only moves forward, as with the conditional patch in CosmosDB
+            conversation['updatedAt'] = max(conversation['updatedAt'], message['createdAt'])
+            return message
+
+    async def update_message_feedback(self, user_id, message_id, feedback):
+        with self.stats.timed('update_feedback'):
+            message = self._get(user_id, message_id, 'message')
+            if not message:
+                return False
+            message['feedback'] = feedback
+            return dict(message)
+
+    async def get_messages(self, user_id, conversation_id):
+        with self.stats.timed('list_messages'):
+            return self._messages(user_id, conversation_id)
+
+    async def get_messages_page(self, user_id, conversation_id, limit, continuation_token=None, since=None):
+        with self.stats.timed('list_messages'):
+            messages = self._messages(user_id, conversation_id)
+            if since:
+                messages = [message for message in messages if message['createdAt'] > since]
+            return self._page(messages, limit, continuation_token)
+
+    def _put(self, item):
+        ## documents are copied in and out, so callers never share them with the store
+        self.partitions.setdefault(item['userId'], {})[item['id']] = dict(item)
+        return dict(item)
+
+    def _get(self, user_id, item_id, item_type):
+        item = self.partitions.get(user_id, {}).get(item_id)
+        if item and item['type'] == item_type:
+            return item
+        return None
+
+    def _conversations(self, user_id, sort_order):
+        conversations = [
+            dict(item) for item in self.partitions.get(user_id, {}).values()
+            if item['type'] == 'conversation'
+        ]
+        conversations.sort(key=lambda item: item['updatedAt'], reverse=sort_order.upper() == 'DESC')
+        return conversations
+
+    def _messages(self, user_id, conversation_id):
+        messages = [
+            dict(item) for item in self.partitions.get(user_id, {}).values()
+            if item['type'] == 'message' and item['conversationId'] == conversation_id
+        ]
+        messages.sort(key=lambda item: item['createdAt'])
+        return messages
+
+    def _page(self, items, limit, continuation_token):
+        ## the continuation token is the offset of the next page
+        start = parse_offset_token(continuation_token)
+        end = start + limit if limit else len(items)
+        return items[start:end], str(end) if end < len(items) else None
@@ -0,0 +1,236 @@
+import asyncio
+import json
+from datetime import datetime
+import aiosqlite
+from backend.history.store import HistoryStore, parse_offset_token
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+    user_id TEXT NOT NULL,
+    id TEXT NOT NULL,
+    type TEXT NOT NULL,
+    conversation_id TEXT,
+    created_at TEXT,
+    updated_at TEXT,
+    document TEXT NOT NULL,
+    PRIMARY KEY (user_id, id)
+);
+CREATE INDEX IF NOT EXISTS conversations_by_update ON items (user_id, type, updated_at);
+CREATE INDEX IF NOT EXISTS messages_by_conversation ON items (user_id, conversation_id, type, created_at);
+"""
+
+# Ids bound in one DELETE statement
+DELETE_BATCH_SIZE = 500
+
+
+class SqliteConversationClient(HistoryStore):
+    """
+    Chat history in a SQLite database file, for local runs and benchmarks.
+    Documents are stored as JSON next to the columns the queries filter and
+    sort on. Call `connect()` before use.
+    """
+
+    def __init__(self, path: str, enable_message_feedback: bool = False):
+        super().__init__()
+        self.path = path
+        self.enable_message_feedback = enable_message_feedback
+        self.db = None
+        ## one connection is shared by all requests of the worker, so a write and its
+        ## commit must not interleave with another write
+        self.write_lock = asyncio.Lock()
+
+    async def connect(self):
+        self.db = await aiosqlite.connect(self.path)
+        ## WAL lets the workers of one app read while another one writes
+        await self.db.execute("PRAGMA journal_mode=WAL")
+        await self.db.executescript(SCHEMA)
+        await self.db.commit()
+
+    async def close(self):
+        if self.db:
+            await self.db.close()
+            self.db = None
+
+    async def ensure(self):
+        if not self.db:
+            return False, "SQLite chat history store not connected"
+        try:
+            await self.db.execute("SELECT 1 FROM items LIMIT 1")
+        except Exception:
+            return False, f"SQLite chat history database {self.path} is not readable"
+        return True, "SQLite chat history store initialized successfully"
+
+    async def create_conversation(self, user_id, title = ''):
+        with self.stats.timed('create_conversation'):
+            conversation = self._new_conversation(user_id, title)
+            async with self.write_lock:
+                await self._put(conversation)
+                await self.db.commit()
+            return conversation
+
+    async def upsert_conversation(self, conversation):
+        with self.stats.timed('upsert_conversation'):
+            async with self.write_lock:
+                await self._put(conversation)
+                await self.db.commit()
+            return conversation
+
+    async def update_conversation_title(self, user_id, conversation_id, title):
+        with self.stats.timed('update_title'):
+            return await self._patch(user_id, conversation_id, 'conversation', {'title': title})
+
+    async def delete_conversation(self, user_id, conversation_id):
+        await self.delete_items(user_id, [conversation_id])
+        return True
+
+    async def get_deletion_ids(self, user_id, conversation_id=None, messages_only=False):
+        with self.stats.timed('list_deletion_ids'):
+            if conversation_id:
+                message_ids = await self._column(
+                    "SELECT id FROM items WHERE user_id = ? AND type = 'message' AND conversation_id = ?",
+                    (user_id, conversation_id)
+                )
+                return message_ids if messages_only else [conversation_id] + message_ids
+            return await self._column(
+                "SELECT id FROM items WHERE user_id = ? AND type IN ('conversation', 'message') "
+                "ORDER BY type = 'message'",
+                (user_id,)
+            )
+
+    async def delete_items(self, user_id, item_ids):
+        with self.stats.timed('delete_items'):
+            deleted = 0
+            async with self.write_lock:
+                for i in range(0, len(item_ids), DELETE_BATCH_SIZE):
+                    batch_ids = item_ids[i:i + DELETE_BATCH_SIZE]
+                    cursor = await self.db.execute(
+                        f"DELETE FROM items WHERE user_id = ? AND id IN ({', '.join('?' * len(batch_ids))})",
+                        (user_id, *batch_ids)
+                    )
+                    deleted += cursor.rowcount
+                await self.db.commit()
+            return deleted
+
+    async def create_deletion_job(self, user_id, item_count):
+        with self.stats.timed('create_deletion_job'):
+            job = self._new_deletion_job(user_id, item_count)
+            async with self.write_lock:
+                await self._put(job)
+                await self.db.commit()
+            return job
+
+    async def update_deletion_job(self, user_id, job_id, status, deleted=0, error=None):
+        with self.stats.timed('update_deletion_job'):
+            fields = {'status': status, 'deleted': deleted, 'updatedAt': datetime.utcnow().isoformat()}
+            if error:
+                fields['error'] = error
+            return await self._patch(user_id, job_id, 'deletion_job', fields)
+
+    async def get_deletion_job(self, user_id, job_id):
+        with self.stats.timed('read_deletion_job'):
+            return await self._get(user_id, job_id, 'deletion_job')
+
+    async def get_conversations(self, user_id, limit, sort_order = 'DESC', offset = 0):
+        with self.stats.timed('list_conversations'):
+            query = f"SELECT document FROM items WHERE user_id = ? AND type = 'conversation' ORDER BY updated_at {self._order(sort_order)}"
+            parameters = (user_id,)
+            if limit is not None:
+                query += " LIMIT ? OFFSET ?"
+                parameters += (limit, offset)
+            return await self._documents(query, parameters)
+
+    async def get_conversations_page(self, user_id, limit, continuation_token=None, sort_order = 'DESC'):
+        with self.stats.timed('list_conversations'):
+            query = f"SELECT document FROM items WHERE user_id = ? AND type = 'conversation' ORDER BY updated_at {self._order(sort_order)}"
+            return await self._page(query, (user_id,), limit, continuation_token)
+
+    async def get_conversation(self, user_id, conversation_id):
+        with self.stats.timed('read_conversation'):
+            return await self._get(user_id, conversation_id, 'conversation')
+
+    async def create_message(self, uuid, conversation_id, user_id, input_message: dict):
+        with self.stats.timed('append_message'):
+            message = self._new_message(uuid, conversation_id, user_id, input_message)
+            async with self.write_lock:
+                if not await self._get(user_id, conversation_id, 'conversation'):
+                    return "Conversation not found"
+                await self._put(message)
+                ## updatedAt only moves forward, as with the conditional patch in CosmosDB
+                await self.db.execute(
+                    "UPDATE items SET updated_at = ?, document = json_set(document, '$.updatedAt', ?) "
+                    "WHERE user_id = ? AND id = ? AND updated_at < ?",
+                    (message['createdAt'], message['createdAt'], user_id, conversation_id, message['createdAt'])
+                )
+                await self.db.commit()
+            return message
+
+    async def update_message_feedback(self, user_id, message_id, feedback):
+        with self.stats.timed('update_feedback'):
+            return await self._patch(user_id, message_id, 'message', {'feedback': feedback})
+
+    async def get_messages(self, user_id, conversation_id):
+        with self.stats.timed('list_messages'):
+            return await self._documents(
+                "SELECT document FROM items WHERE user_id = ? AND type = 'message' AND conversation_id = ? ORDER BY created_at ASC",
+                (user_id, conversation_id)
+            )
+
+    async def get_messages_page(self, user_id, conversation_id, limit, continuation_token=None, since=None):
+        with self.stats.timed('list_messages'):
+            query = "SELECT document FROM items WHERE user_id = ? AND type = 'message' AND conversation_id = ?"
+            parameters = (user_id, conversation_id)
+            if since:
+                query += " AND created_at > ?"
+                parameters += (since,)
+            query += " ORDER BY created_at ASC"
+            return await self._page(query, parameters, limit, continuation_token)
+
+    async def _put(self, item):
+        await self.db.execute(
+            "INSERT OR REPLACE INTO items (user_id, id, type, conversation_id, created_at, updated_at, document) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                item['userId'], item['id'], item['type'], item.get('conversationId'),
+                item.get('createdAt'), item.get('updatedAt'), json.dumps(item)
+            )
+        )
+
+    async def _get(self, user_id, item_id, item_type):
+        async with self.db.execute(
+            "SELECT document FROM items WHERE user_id = ? AND id = ? AND type = ?",
+            (user_id, item_id, item_type)
+        ) as cursor:
+            row = await cursor.fetchone()
+        return json.loads(row[0]) if row else None
+
+    async def _patch(self, user_id, item_id, item_type, fields):
+        async with self.write_lock:
+            item = await self._get(user_id, item_id, item_type)
+            if not item:
+                return False
+            item.update(fields)
+            await self._put(item)
+            await self.db.commit()
+        return item
+
+    async def _documents(self, query, parameters):
+        async with self.db.execute(query, parameters) as cursor:
+            return [json.loads(row[0]) for row in await cursor.fetchall()]
+
+    async def _column(self, query, parameters):
+        async with self.db.execute(query, parameters) as cursor:
+            return [row[0] for row in await cursor.fetchall()]
+
+    async def _page(self, query, parameters, limit, continuation_token):
+        ## the continuation token is the offset of the next page; one extra row tells
+        ## whether there is a next page
+        start = parse_offset_token(continuation_token)
+        if not limit:
+            return await self._documents(query, parameters), None
+        items = await self._documents(f"{query} LIMIT ? OFFSET ?", parameters + (limit + 1, start))
+        if len(items) > limit:
+            return items[:limit], str(start + limit)
+        return items, None
+
+    def _order(self, sort_order):
+        return 'ASC' if sort_order.upper() == 'ASC' else 'DESC'
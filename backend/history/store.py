@@ -0,0 +1,223 @@
+import time
+import uuid
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+
+from backend.metrics import observe_history_operation
+
+# Seconds a finished deletion job document is kept
+DELETION_JOB_TTL = 24 * 60 * 60
+# Seconds after which a job still marked running is taken for one whose worker
+# exited (e.g. recycled by gunicorn) before it finished
+DELETION_JOB_STALE_AFTER = 10 * 60
+
+
+def is_stale_deletion_job(job, now=None) -> bool:
+    if job['status'] != 'running':
+        return False
+    now = now or datetime.utcnow()
+    return now - datetime.fromisoformat(job['updatedAt']) > timedelta(seconds=DELETION_JOB_STALE_AFTER)
+
+
+class InvalidContinuationToken(ValueError):
+    """A continuation token the store did not issue, or one that expired"""
+
+
+def parse_offset_token(continuation_token) -> int:
+    ## the continuation tokens of the memory and SQLite stores are offsets
+    if continuation_token is None:
+        return 0
+    if not str(continuation_token).isdigit():
+        raise InvalidContinuationToken(continuation_token)
+    return int(continuation_token)
+
+
+@dataclass
+class HistoryOperationStats:
+    count: int = 0
+    failures: int = 0
+    retries: int = 0
+    request_charge: float = 0.0
+    seconds_total: float = 0.0
+    server_seconds_total: float = 0.0
+    server_timed: int = 0
+
+
+@dataclass
+class HistoryStats:
+    operations: dict = field(default_factory=dict)
+
+    def record(self, operation, seconds, request_charge=None, failed=False, server_seconds=None, retries=0):
+        stats = self.operations.setdefault(operation, HistoryOperationStats())
+        stats.count += 1
+        stats.failures += int(failed)
+        stats.retries += retries
+        stats.request_charge += float(request_charge or 0)
+        stats.seconds_total += seconds
+        if server_seconds is not None:
+            stats.server_seconds_total += server_seconds
+            stats.server_timed += 1
+        observe_history_operation(operation, seconds, request_charge, failed, server_seconds, retries)
+
+    @contextmanager
+    def timed(self, operation):
+        start = time.perf_counter()
+        failed = False
+        try:
+            yield
+        except Exception:
+            failed = True
+            raise
+        finally:
+            self.record(operation, time.perf_counter() - start, failed=failed)
+
+    def snapshot(self) -> dict:
+        return {
+            operation: {
+                "count": stats.count,
+                "failures": stats.failures,
+                "retries": stats.retries,
+                "request_charge": stats.request_charge,
+                "avg_seconds": stats.seconds_total / stats.count,
+                "avg_server_seconds": (
+                    stats.server_seconds_total / stats.server_timed
+                    if stats.server_timed else None
+                ),
+            }
+            for operation, stats in self.operations.items()
+        }
+
+
+class HistoryStore(ABC):
+    """
+    Conversation history storage behind the /history routes. Conversations,
+    messages and deletion jobs are JSON documents partitioned by user id,
+    shaped as they are stored in CosmosDB.
+    """
+
+    enable_message_feedback: bool = False
+
+    def __init__(self):
+        self.stats = HistoryStats()
+
+    async def close(self):
+        pass
+
+    @abstractmethod
+    async def ensure(self):
+        """Returns (ok, message) describing whether the store is usable"""
+
+    @abstractmethod
+    async def create_conversation(self, user_id, title = ''):
+        pass
+
+    @abstractmethod
+    async def upsert_conversation(self, conversation):
+        pass
+
+    @abstractmethod
+    async def update_conversation_title(self, user_id, conversation_id, title):
+        pass
+
+    @abstractmethod
+    async def delete_conversation(self, user_id, conversation_id):
+        pass
+
+    async def delete_messages(self, conversation_id, user_id):
+        message_ids = await self.get_deletion_ids(user_id, conversation_id, messages_only=True)
+        await self.delete_items(user_id, message_ids)
+        return message_ids
+
+    @abstractmethod
+    async def get_deletion_ids(self, user_id, conversation_id=None, messages_only=False):
+        """
+        Ids of a conversation and its messages (or only its messages), or of all
+        the user's conversations and messages, conversations first
+        """
+
+    @abstractmethod
+    async def delete_items(self, user_id, item_ids):
+        """Deletes documents of one user, returning how many existed"""
+
+    @abstractmethod
+    async def create_deletion_job(self, user_id, item_count):
+        pass
+
+    @abstractmethod
+    async def update_deletion_job(self, user_id, job_id, status, deleted=0, error=None):
+        pass
+
+    @abstractmethod
+    async def get_deletion_job(self, user_id, job_id):
+        pass
+
+    @abstractmethod
+    async def get_conversations(self, user_id, limit, sort_order = 'DESC', offset = 0):
+        pass
+
+    @abstractmethod
+    async def get_conversations_page(self, user_id, limit, continuation_token=None, sort_order = 'DESC'):
+        """One page of conversations and the token of the next page (None on the last one)"""
+
+    @abstractmethod
+    async def get_conversation(self, user_id, conversation_id):
+        pass
+
+    @abstractmethod
+    async def create_message(self, uuid, conversation_id, user_id, input_message: dict):
+        """
+        Stores a message and moves the conversation's updatedAt forward to it;
+        returns "Conversation not found" without storing it otherwise
+        """
+
+    @abstractmethod
+    async def update_message_feedback(self, user_id, message_id, feedback):
+        pass
+
+    @abstractmethod
+    async def get_messages(self, user_id, conversation_id):
+        pass
+
+    @abstractmethod
+    async def get_messages_page(self, user_id, conversation_id, limit, continuation_token=None, since=None):
+        """One page of messages in creation order and the token of the next page"""
+
+    def _new_conversation(self, user_id, title):
+        return {
+            'id': str(uuid.uuid4()),
+            'type': 'conversation',
+            'createdAt': datetime.utcnow().isoformat(),
+            'updatedAt': datetime.utcnow().isoformat(),
+            'userId': user_id,
+            'title': title
+        }
+
+    def _new_message(self, uuid, conversation_id, user_id, input_message):
+        message = {
+            'id': uuid,
+            'type': 'message',
+            'userId' : user_id,
+            'createdAt': datetime.utcnow().isoformat(),
+            'updatedAt': datetime.utcnow().isoformat(),
+            'conversationId' : conversation_id,
+            'role': input_message['role'],
+            'content': input_message['content']
+        }
+        if self.enable_message_feedback:
+            message['feedback'] = ''
+        return message
+
+    def _new_deletion_job(self, user_id, item_count):
+        return {
+            'id': str(uuid.uuid4()),
+            'type': 'deletion_job',
+            'userId': user_id,
+            'createdAt': datetime.utcnow().isoformat(),
+            'updatedAt': datetime.utcnow().isoformat(),
+            'status': 'running',
+            'itemCount': item_count,
+            'deleted': 0,
+            'ttl': DELETION_JOB_TTL
+        }
@@ -0,0 +1,204 @@
+"""
+Prometheus metrics of the chat request path and of the chat history store,
+served on /metrics.
+
+Each worker process keeps its own samples. When PROMETHEUS_MULTIPROC_DIR
+points to a directory shared by the gunicorn workers, every worker writes its
+samples there and /metrics serves the sum over all of them, whichever worker
+answers the scrape (see gunicorn.conf.py).
+"""
+import os
+import time
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+from backend.utils import close_stream
+
+CHAT_REQUEST_SECONDS = Histogram(
+    "chat_request_duration_seconds",
+    "Time from the chat request until its answer was complete",
+    ["route"],
+    buckets=(0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 230),
+)
+CHAT_TIME_TO_FIRST_TOKEN = Histogram(
+    "chat_time_to_first_token_seconds",
+    "Time from the chat request until the first answer token was ready to stream",
+    ["route"],
+    buckets=(0.1, 0.25, 0.5, 0.75, 1, 1.5, 2, 3, 5, 10, 30),
+)
+CHAT_TOKENS_PER_SECOND = Histogram(
+    "chat_completion_tokens_per_second",
+    "Answer tokens streamed per second after the first one",
+    ["route"],
+    buckets=(5, 10, 20, 30, 40, 60, 80, 100, 150, 250),
+)
+CHAT_STREAMS_IN_FLIGHT = Gauge(
+    "chat_streams_in_flight",
+    "Answers currently streaming",
+    ["route"],
+    multiprocess_mode="livesum",
+)
+UPSTREAM_SECONDS = Histogram(
+    "aoai_upstream_latency_seconds",
+    "Time until an Azure OpenAI deployment returned the first token (or the whole completion)",
+    ["deployment"],
+    buckets=(0.1, 0.25, 0.5, 0.75, 1, 1.5, 2, 3, 5, 10, 30, 60),
+)
+ADMISSION_QUEUE_DEPTH = Gauge(
+    "aoai_admission_queue_depth",
+    "Requests waiting for the token or request budget of an Azure OpenAI deployment",
+    ["deployment"],
+    multiprocess_mode="livesum",
+)
+CANCELLED_STREAMS = Counter(
+    "aoai_cancelled_streams_total",
+    "Completions streamed from an Azure OpenAI deployment that were closed before they finished, e.g. because the client disconnected",
+    ["deployment"],
+)
+CANCELLED_STREAM_TOKENS = Counter(
+    "aoai_cancelled_stream_tokens_total",
+    "Completion tokens streamed until the completion was closed before it finished",
+    ["deployment"],
+)
+HTTP_ERRORS = Counter(
+    "http_errors_total",
+    "Responses with an error status code",
+    ["route", "status_code"],
+)
+HISTORY_OPERATION_SECONDS = Histogram(
+    "chat_history_operation_duration_seconds",
+    "Time of a chat history store operation, all pages and retries included",
+    ["operation"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+HISTORY_SERVER_SECONDS = Histogram(
+    "cosmosdb_server_duration_seconds",
+    "Time CosmosDB reported spending on a chat history operation",
+    ["operation"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1),
+)
+HISTORY_REQUEST_CHARGE = Histogram(
+    "cosmosdb_request_charge",
+    "Request units charged for a chat history operation",
+    ["operation"],
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000),
+)
+HISTORY_RETRIES = Counter(
+    "cosmosdb_throttle_retries_total",
+    "Throttled CosmosDB requests retried by the SDK",
+    ["operation"],
+)
+HISTORY_FAILURES = Counter(
+    "chat_history_operation_failures_total",
+    "Chat history store operations that raised",
+    ["operation"],
+)
+HISTORY_CACHE_LOOKUPS = Counter(
+    "chat_history_cache_lookups_total",
+    "Lookups in the per-worker conversation caches",
+    ["cache", "result"],
+)
+TOKEN_CACHE_LOOKUPS = Counter(
+    "token_cache_lookups_total",
+    "Access token requests of the Azure OpenAI and CosmosDB clients, by whether the cached token was used",
+    ["result"],
+)
+TOKEN_FETCH_SECONDS = Histogram(
+    "token_fetch_duration_seconds",
+    "Time to fetch an access token from the identity provider",
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+TOKEN_FETCH_FAILURES = Counter(
+    "token_fetch_failures_total",
+    "Access token fetches that failed",
+)
+TOKEN_BACKGROUND_REFRESHES = Counter(
+    "token_background_refreshes_total",
+    "Cached access tokens replaced ahead of their expiry",
+)
+HISTORY_CACHE_REQUEST_CHARGE_SAVED = Counter(
+    "chat_history_cache_request_charge_saved_total",
+    "Request units of the conversation list queries answered from the cache",
+)
+
+
+def _has_content(frame) -> bool:
+    choices = frame.get("choices") if isinstance(frame, dict) else None
+    messages = choices[0].get("messages") if choices else None
+    return any(
+        message.get("role") == "assistant" and message.get("content")
+        for message in messages or []
+    )
+
+
+async def observe_chat_stream(frames, route: str, start: float):
+    # Times the answer frames of one chat request started at `start`
+    # (time.perf_counter()); each content frame carries one token
+    first_token_at = None
+    tokens = 0
+    CHAT_STREAMS_IN_FLIGHT.labels(route).inc()
+    try:
+        async for frame in frames:
+            if _has_content(frame):
+                tokens += 1
+                if first_token_at is None:
+                    first_token_at = time.perf_counter()
+                    CHAT_TIME_TO_FIRST_TOKEN.labels(route).observe(first_token_at - start)
+            yield frame
+    finally:
+        CHAT_STREAMS_IN_FLIGHT.labels(route).dec()
+        await close_stream(frames)
+
+    end = time.perf_counter()
+    CHAT_REQUEST_SECONDS.labels(route).observe(end - start)
+    if tokens > 1 and end > first_token_at:
+        CHAT_TOKENS_PER_SECOND.labels(route).observe((tokens - 1) / (end - first_token_at))
+
+
+def observe_chat_completion(route: str, start: float):
+    CHAT_REQUEST_SECONDS.labels(route).observe(time.perf_counter() - start)
+
+
+def observe_upstream_latency(deployment: str, seconds: float):
+    UPSTREAM_SECONDS.labels(deployment).observe(seconds)
+
+
+def observe_history_operation(operation, seconds, request_charge=None, failed=False, server_seconds=None, retries=0):
+    HISTORY_OPERATION_SECONDS.labels(operation).observe(seconds)
+    if request_charge is not None:
+        HISTORY_REQUEST_CHARGE.labels(operation).observe(float(request_charge))
+    if server_seconds is not None:
+        HISTORY_SERVER_SECONDS.labels(operation).observe(server_seconds)
+    if retries:
+        HISTORY_RETRIES.labels(operation).inc(retries)
+    if failed:
+        HISTORY_FAILURES.labels(operation).inc()
+
+
+def count_cache_lookup(cache: str, hit: bool, request_charge_saved: float = 0.0):
+    HISTORY_CACHE_LOOKUPS.labels(cache, "hit" if hit else "miss").inc()
+    if request_charge_saved:
+        HISTORY_CACHE_REQUEST_CHARGE_SAVED.inc(request_charge_saved)
+
+
+def count_error(route: str, status_code: int):
+    HTTP_ERRORS.labels(route, str(status_code)).inc()
+
+
+def render_metrics():
+    # Returns the body and content type of a /metrics response
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
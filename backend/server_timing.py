@@ -0,0 +1,94 @@
+"""
+Per-request latency breakdown sent to the client in the Server-Timing header
+of every response, so that the time of a request can be attributed without
+a tracing backend. A streamed answer starts before its time is known; in the
+v2 stream format it ends with a frame carrying the final breakdown,
+{"server_timing": {...}}, in milliseconds.
+
+The breakdown of the current request is kept in a context variable, so the
+stages add to it from wherever they run, including tasks started by the
+request.
+"""
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Reported stages, in header order
+STAGES = {
+    "auth": "User group lookup",
+    "history": "Chat history store",
+    "datasource": "Data source payload build",
+    "ttft": "Upstream time to first token",
+    "stream": "Streamed answer",
+    "total": "Total",
+}
+
+_current = ContextVar("server_timing", default=None)
+
+
+class ServerTiming:
+    def __init__(self, start: float):
+        # start: time.perf_counter() when the request arrived
+        self.start = start
+        self.seconds = {}
+
+    def add(self, stage, seconds):
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+
+    def milliseconds(self, now=None) -> dict:
+        now = time.perf_counter() if now is None else now
+        seconds = {**self.seconds, "total": now - self.start}
+        return {
+            stage: round(seconds[stage] * 1000, 1) for stage in STAGES if stage in seconds
+        }
+
+    def header(self, now=None) -> str:
+        return ", ".join(
+            f'{stage};dur={duration};desc="{STAGES[stage]}"'
+            for stage, duration in self.milliseconds(now).items()
+        )
+
+
+def start_server_timing(start: float) -> ServerTiming:
+    timing = ServerTiming(start)
+    _current.set(timing)
+    return timing
+
+
+def current_server_timing():
+    return _current.get()
+
+
+def add_server_timing(stage, seconds):
+    timing = _current.get()
+    if timing is not None:
+        timing.add(stage, seconds)
+
+
+@contextmanager
+def server_timing(stage):
+    timing = _current.get()
+    if timing is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timing.add(stage, time.perf_counter() - start)
+
+
+async def append_server_timing_frame(frames, timing: ServerTiming):
+    # Times the streaming of the frames and follows them with the breakdown,
+    # unless the client went away first
+    start = time.perf_counter()
+    try:
+        async for frame in frames:
+            yield frame
+    finally:
+        if hasattr(frames, "aclose"):
+            await frames.aclose()
+
+    now = time.perf_counter()
+    timing.add("stream", now - start)
+    yield {"server_timing": timing.milliseconds(now)}
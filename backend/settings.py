@@ -19,7 +19,8 @@ from pydantic_settings import BaseSettings, SettingsConfigDict
 from typing import List, Literal, Optional
 from typing_extensions import Self
 from quart import Request
-from backend.utils import parse_multi_columns, generateFilterString
+from backend.server_timing import server_timing
+from backend.utils import FrozenDict, freeze, parse_multi_columns, generateFilterString
 
 DOTENV_PATH = os.environ.get(
     "DOTENV_PATH",
@@ -59,11 +60,31 @@ class _ChatHistorySettings(BaseSettings):
         env_ignore_empty=True
     )
 
-    database: str
-    account: str
+    store: Literal["cosmosdb", "memory", "sqlite"] = Field(
+        default="cosmosdb",
+        validation_alias="CHAT_HISTORY_STORE"
+    )
+    sqlite_path: str = Field(
+        default="chat_history.sqlite3",
+        validation_alias="CHAT_HISTORY_SQLITE_PATH"
+    )
+    database: Optional[str] = None
+    account: Optional[str] = None
     account_key: Optional[str] = None
-    conversations_container: str
+    conversations_container: Optional[str] = None
     enable_feedback: bool = False
+    conversation_cache_max_entries: conint(ge=0) = 1000
+    conversation_cache_ttl: float = 30.0
+    conversation_list_cache_max_users: conint(ge=0) = 1000
+    conversation_list_cache_ttl: float = 30.0
+
+    @model_validator(mode="after")
+    def require_cosmosdb_settings(self) -> Self:
+        # The local stores keep chat history without any CosmosDB resources
+        if self.store == "cosmosdb" and not (self.database and self.account and self.conversations_container):
+            raise ValueError("AZURE_COSMOSDB_ACCOUNT, AZURE_COSMOSDB_DATABASE and AZURE_COSMOSDB_CONVERSATIONS_CONTAINER are required")
+
+        return self
 
 
 class _PromptflowSettings(BaseSettings):
@@ -80,6 +101,9 @@ class _PromptflowSettings(BaseSettings):
     request_field_name: str = "query"
     response_field_name: str = "reply"
     citations_field_name: str = "documents"
+    stream: bool = True
+    max_connections: conint(ge=1) = 100
+    max_keepalive_connections: conint(ge=0) = 20
 
 
 class _AzureOpenAIFunction(BaseModel):
@@ -93,6 +117,30 @@ class _AzureOpenAITool(BaseModel):
     function: _AzureOpenAIFunction
     
 
+class _AzureOpenAIDeployment(BaseModel):
+    name: Optional[str] = None
+    endpoint: Optional[str] = None
+    resource: Optional[str] = None
+    model: str = Field(..., min_length=1)
+    key: Optional[str] = None
+    tokens_per_minute: Optional[conint(ge=1)] = None
+    requests_per_minute: Optional[conint(ge=1)] = None
+    max_retries: Optional[conint(ge=0)] = None
+    hedging: Optional[bool] = None
+
+    @model_validator(mode="after")
+    def ensure_endpoint(self) -> Self:
+        if not self.endpoint:
+            if not self.resource:
+                raise ValueError("endpoint or resource is required for each deployment")
+            self.endpoint = f"https://{self.resource}.openai.azure.com"
+
+        if not self.name:
+            self.name = f"{self.endpoint.split('://')[-1].rstrip('/')}/{self.model}"
+
+        return self
+
+
 class _AzureOpenAISettings(BaseSettings):
     model_config = SettingsConfigDict(
         env_prefix="AZURE_OPENAI_",
@@ -123,6 +171,18 @@ class _AzureOpenAISettings(BaseSettings):
     embedding_endpoint: Optional[str] = None
     embedding_key: Optional[str] = None
     embedding_name: Optional[str] = None
+    max_connections: conint(ge=1) = 100
+    max_keepalive_connections: conint(ge=0) = 20
+    keepalive_expiry: float = 30.0
+    tokens_per_minute: Optional[conint(ge=1)] = None
+    requests_per_minute: Optional[conint(ge=1)] = None
+    admission_max_wait: float = 10.0
+    deployments: Optional[List[_AzureOpenAIDeployment]] = None
+    max_retries: conint(ge=0) = 2
+    hedging: bool = False
+    hedge_min_delay: float = 1.0
+    raw_stream: bool = False
+    title_model: Optional[str] = None
     
     @field_validator('tools', mode='before')
     @classmethod
@@ -150,6 +210,18 @@ class _AzureOpenAISettings(BaseSettings):
                 
         return None
         
+    @field_validator('deployments', mode='before')
+    @classmethod
+    def deserialize_deployments(cls, deployments_json_str: str) -> List[dict]:
+        if isinstance(deployments_json_str, str):
+            try:
+                return json.loads(deployments_json_str)
+            except json.JSONDecodeError as e:
+                logging.warning(f"An error occurred while deserializing the deployments string -- {str(e)}")
+                return None
+        
+        return deployments_json_str
+        
     @field_validator('stop_sequence', mode='before')
     @classmethod
     def split_contexts(cls, comma_separated_string: str) -> List[str]:
@@ -169,6 +241,25 @@ class _AzureOpenAISettings(BaseSettings):
         
         raise ValidationError("AZURE_OPENAI_ENDPOINT or AZURE_OPENAI_RESOURCE is required")
         
+    def get_deployments(self) -> List[_AzureOpenAIDeployment]:
+        primary = _AzureOpenAIDeployment(
+            endpoint=self.endpoint or f"https://{self.resource}.openai.azure.com/",
+            model=self.model,
+            key=self.key,
+            tokens_per_minute=self.tokens_per_minute,
+            requests_per_minute=self.requests_per_minute,
+        )
+        deployments = [primary] + (self.deployments or [])
+        
+        # Retry and hedging options default to the AZURE_OPENAI_* settings
+        return [
+            deployment.model_copy(update={
+                "max_retries": self.max_retries if deployment.max_retries is None else deployment.max_retries,
+                "hedging": self.hedging if deployment.hedging is None else deployment.hedging,
+            })
+            for deployment in deployments
+        ]
+        
     def extract_embedding_dependency(self) -> Optional[dict]:
         if self.embedding_name:
             return {
@@ -222,8 +313,47 @@ class _SearchCommonSettings(BaseSettings):
         return cls.model_fields[info.field_name].get_default()
 
 
+class _ResponseCacheSettings(BaseSettings):
+    model_config = SettingsConfigDict(
+        env_prefix="RESPONSE_CACHE_",
+        env_file=DOTENV_PATH,
+        extra="ignore",
+        env_ignore_empty=True
+    )
+    enabled: bool = False
+    ttl: confloat(gt=0) = 3600
+    max_entries: conint(ge=1) = 1000
+
+
+class _SemanticCacheSettings(BaseSettings):
+    model_config = SettingsConfigDict(
+        env_prefix="SEMANTIC_CACHE_",
+        env_file=DOTENV_PATH,
+        extra="ignore",
+        env_ignore_empty=True
+    )
+    enabled: bool = False
+    threshold: confloat(gt=0, le=1) = 0.95
+    ttl: confloat(gt=0) = 3600
+    max_entries: conint(ge=1) = 10000
+
+
+class _TracingSettings(BaseSettings):
+    model_config = SettingsConfigDict(
+        env_prefix="TRACING_",
+        env_file=DOTENV_PATH,
+        extra="ignore",
+        env_ignore_empty=True
+    )
+    exporter: Literal["none", "console", "otlp"] = "none"
+    otlp_endpoint: Optional[str] = None
+    service_name: str = "sample-app-aoai-chatgpt"
+    sample_ratio: confloat(ge=0, le=1) = 1.0
+
+
 class DatasourcePayloadConstructor(BaseModel, ABC):
     _settings: '_AppSettings' = PrivateAttr()
+    _compiled_payload: Optional[FrozenDict] = PrivateAttr(default=None)
     
     def __init__(self, settings: '_AppSettings', **data):
         super().__init__(**data)
@@ -237,6 +367,28 @@ class DatasourcePayloadConstructor(BaseModel, ABC):
     ):
         pass
 
+    def compile_payload_configuration(self) -> FrozenDict:
+        # The request-independent payload, built once and shared read-only
+        if self._compiled_payload is None:
+            self._compiled_payload = freeze(self.construct_payload_configuration())
+        
+        return self._compiled_payload
+
+    def request_parameters(self, request: Request) -> Optional[dict]:
+        # Parameters that depend on the request, e.g. security filters
+        return None
+
+    def get_payload_configuration(self, request: Optional[Request] = None) -> dict:
+        payload = self.compile_payload_configuration()
+        overlay = self.request_parameters(request) if request else None
+        if not overlay:
+            return payload
+        
+        return {
+            "type": payload["type"],
+            "parameters": {**payload["parameters"], **overlay}
+        }
+
 
 class _AzureSearchSettings(BaseSettings, DatasourcePayloadConstructor):
     model_config = SettingsConfigDict(
@@ -324,7 +476,8 @@ class _AzureSearchSettings(BaseSettings, DatasourcePayloadConstructor):
                     "Document-level access control is enabled, but user access token could not be fetched."
                 )
 
-            filter_string = generateFilterString(user_token)
+            with server_timing("auth"):
+                filter_string = generateFilterString(user_token)
             logging.debug(f"FILTER: {filter_string}")
             return filter_string
         
@@ -336,19 +489,25 @@ class _AzureSearchSettings(BaseSettings, DatasourcePayloadConstructor):
         **kwargs
     ):
         request = kwargs.pop('request', None)
-        if request and self.permitted_groups_column:
-            self.filter = self._set_filter_string(request)
-            
         self.embedding_dependency = \
             self._settings.azure_openai.extract_embedding_dependency()
         parameters = self.model_dump(exclude_none=True, by_alias=True)
         parameters.update(self._settings.search.model_dump(exclude_none=True, by_alias=True))
+        if request:
+            parameters.update(self.request_parameters(request) or {})
         
         return {
             "type": self._type,
             "parameters": parameters
         }
 
+    def request_parameters(self, request: Request) -> Optional[dict]:
+        # Computed per request instead of stored on the shared settings object
+        if self.permitted_groups_column:
+            return {"filter": self._set_filter_string(request)}
+        
+        return None
+
 
 class _AzureCosmosDbMongoVcoreSettings(
     BaseSettings,
@@ -756,6 +915,9 @@ class _BaseSettings(BaseSettings):
     auth_enabled: bool = True
     sanitize_answer: bool = False
     use_promptflow: bool = False
+    stream_flush_interval: confloat(ge=0) = 0.05
+    stream_flush_bytes: conint(ge=1) = 1024
+    server_timing_enabled: bool = True
 
 
 class _AppSettings(BaseModel):
@@ -763,6 +925,9 @@ class _AppSettings(BaseModel):
     azure_openai: _AzureOpenAISettings = _AzureOpenAISettings()
     search: _SearchCommonSettings = _SearchCommonSettings()
     ui: Optional[_UiSettings] = _UiSettings()
+    response_cache: _ResponseCacheSettings = _ResponseCacheSettings()
+    semantic_cache: _SemanticCacheSettings = _SemanticCacheSettings()
+    tracing: _TracingSettings = _TracingSettings()
     
     # Constructed properties
     chat_history: Optional[_ChatHistorySettings] = None
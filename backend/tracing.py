@@ -0,0 +1,166 @@
+"""
+OpenTelemetry spans of the chat request path: a server span per request to
+the blueprint, with child spans for the handler stages and for every outbound
+call to Azure OpenAI, CosmosDB, Microsoft Graph and Prompt Flow. Outbound
+HTTP requests carry the W3C trace context of the current span (traceparent),
+and an incoming traceparent is continued.
+
+Tracing is off unless TRACING_EXPORTER is set. Then span() returns a shared
+no-op context manager and the other helpers return right away, without
+touching OpenTelemetry (see tools/benchmarks/tracing_overhead.py).
+"""
+import functools
+import inspect
+import logging
+from contextlib import nullcontext
+
+from opentelemetry import context, propagate, trace
+from opentelemetry.trace import SpanKind, Status, StatusCode
+
+TRACER_NAME = "sample-app-aoai-chatgpt"
+
+_NO_SPAN = nullcontext()
+_tracer = None
+
+
+def configure_tracing(settings):
+    # Sets up the tracer provider of this worker from the TRACING_* settings;
+    # returns it, or None when tracing is off
+    global _tracer
+    if settings.exporter == "none":
+        _tracer = None
+        return None
+
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+    from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
+
+    if settings.exporter == "otlp":
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+
+        # Without an endpoint the exporter reads OTEL_EXPORTER_OTLP_* from the environment
+        exporter = OTLPSpanExporter(endpoint=settings.otlp_endpoint)
+    else:
+        exporter = ConsoleSpanExporter()
+
+    provider = TracerProvider(
+        resource=Resource.create({"service.name": settings.service_name}),
+        sampler=ParentBased(TraceIdRatioBased(settings.sample_ratio)),
+    )
+    provider.add_span_processor(BatchSpanProcessor(exporter))
+    trace.set_tracer_provider(provider)
+    _tracer = provider.get_tracer(TRACER_NAME)
+    logging.debug(f"Tracing enabled ({settings.exporter} exporter)")
+    return provider
+
+
+def tracing_enabled() -> bool:
+    return _tracer is not None
+
+
+def span(name, attributes=None, kind=SpanKind.INTERNAL):
+    # Context manager running the block in a child span of the current one
+    if _tracer is None:
+        return _NO_SPAN
+    return _tracer.start_as_current_span(name, kind=kind, attributes=attributes)
+
+
+def set_span_attributes(attributes):
+    if _tracer is None:
+        return
+    trace.get_current_span().set_attributes(
+        {key: value for key, value in attributes.items() if value is not None}
+    )
+
+
+def traced(name, kind=SpanKind.INTERNAL):
+    # Decorator running a function (sync or async) in a span
+    def decorator(function):
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                with span(name, kind=kind):
+                    return await function(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name, kind=kind):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def inject_trace_context(headers):
+    # Adds the traceparent (and tracestate) of the current span to the
+    # headers of an outbound request
+    if _tracer is not None:
+        propagate.inject(headers)
+    return headers
+
+
+async def inject_httpx_trace_context(request):
+    # httpx request event hook
+    inject_trace_context(request.headers)
+
+
+def start_request_span(method, route, headers):
+    # Starts the server span of a request and makes it current; returns it
+    # with the token to detach it by (end_request_span)
+    if _tracer is None:
+        return None, None
+    parent = propagate.extract(headers)
+    request_span = _tracer.start_span(
+        f"{method} {route}",
+        context=parent,
+        kind=SpanKind.SERVER,
+        attributes={"http.request.method": method, "http.route": route},
+    )
+    return request_span, context.attach(trace.set_span_in_context(request_span, parent))
+
+
+def end_request_span(request_span, token, status_code=None):
+    # The span is None when a streamed response took it over (trace_stream)
+    if token is not None:
+        context.detach(token)
+    if request_span is None:
+        return
+    if status_code is not None:
+        request_span.set_attribute("http.response.status_code", status_code)
+        if status_code >= 500:
+            request_span.set_status(Status(StatusCode.ERROR))
+    request_span.end()
+
+
+def trace_stream(frames, request_span=None, name="emit_stream"):
+    # Span from the first to the last frame of a streamed answer. The request
+    # span handed over ends with it instead of when the handler returns.
+    if _tracer is None:
+        return frames
+    if not trace.get_current_span().is_recording():
+        # Sampled out; ending the span is all there is to do
+        if request_span is not None:
+            request_span.end()
+        return frames
+    return _traced_stream(frames, request_span, name, context.get_current())
+
+
+async def _traced_stream(frames, request_span, name, parent):
+    stream_span = _tracer.start_span(name, context=parent)
+    count = 0
+    try:
+        async for frame in frames:
+            count += 1
+            yield frame
+    except Exception as e:
+        stream_span.record_exception(e)
+        stream_span.set_status(Status(StatusCode.ERROR))
+        raise
+    finally:
+        stream_span.set_attribute("chat.stream.frames", count)
+        stream_span.end()
+        if request_span is not None:
+            request_span.end()
+        if hasattr(frames, "aclose"):
+            await frames.aclose()
@@ -1,10 +1,15 @@
 import os
+import re
 import json
+import asyncio
 import logging
 import requests
 import dataclasses
 
 from typing import List
+from opentelemetry.trace import SpanKind
+
+from backend.tracing import inject_trace_context, set_span_attributes, span
 
 DEBUG = os.environ.get("DEBUG", "false")
 if DEBUG.lower() == "true":
@@ -14,6 +19,10 @@ AZURE_SEARCH_PERMITTED_GROUPS_COLUMN = os.environ.get(
     "AZURE_SEARCH_PERMITTED_GROUPS_COLUMN"
 )
 
+STREAM_MIMETYPE = "application/json-lines"
+HEURISTIC_TITLE_WORDS = 6
+_TITLE_WORD = re.compile(r"[\w'-]+")
+
 
 class JSONEncoder(json.JSONEncoder):
     def default(self, o):
@@ -22,6 +31,86 @@ class JSONEncoder(json.JSONEncoder):
         return super().default(o)
 
 
+class FrozenDict(dict):
+    """
+    Read-only dict for structures shared between requests. Still a dict, so
+    it serializes to JSON like one.
+    """
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("FrozenDict is read-only")
+
+    __setitem__ = __delitem__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+    def __ior__(self, other):
+        self._readonly()
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return (FrozenDict, (dict(self),))
+
+
+def freeze(value):
+    # Recursively convert dicts and lists to FrozenDicts and tuples
+    if isinstance(value, dict):
+        return FrozenDict((key, freeze(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+SECRET_PARAMS = {"key", "connection_string", "embedding_key", "encoded_api_key", "api_key"}
+
+
+def redact_secrets(value):
+    # Copy of value with every secret parameter masked, at any depth
+    if isinstance(value, dict):
+        return {
+            key: "*****" if key in SECRET_PARAMS and item else redact_secrets(item)
+            for key, item in value.items()
+        }
+    if isinstance(value, (list, tuple)):
+        return [redact_secrets(item) for item in value]
+    return value
+
+
+async def close_stream(stream):
+    # Closing an async generator does not close the iterator it is reading
+    # from; close it explicitly so that a client disconnect reaches the
+    # upstream response right away instead of whenever it is collected.
+    if hasattr(stream, "aclose"):
+        await stream.aclose()
+
+
+class ClosingStream:
+    """
+    Async iterator over `frames`, an async generator reading `upstream`.
+    Closing it also closes `upstream`, even before iteration started: an
+    async generator closed before it started skips its finally blocks, which
+    would leave the upstream response and its admission ticket open.
+    """
+
+    def __init__(self, frames, upstream):
+        self._frames = frames
+        self._upstream = upstream
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self._frames.__anext__()
+
+    async def aclose(self):
+        await close_stream(self._frames)
+        await close_stream(self._upstream)
+
+
 async def format_as_ndjson(r):
     try:
         async for event in r:
@@ -29,6 +118,155 @@ async def format_as_ndjson(r):
     except Exception as error:
         logging.exception("Exception while generating response stream: %s", error)
         yield json.dumps({"error": str(error)})
+    finally:
+        await close_stream(r)
+
+
+def _stream_frame_content(frame):
+    # Content of a frame carrying nothing but an assistant content delta
+    choices = frame.get("choices") if isinstance(frame, dict) else None
+    if not choices or len(choices[0].get("messages", [])) != 1:
+        return None
+    message = choices[0]["messages"][0]
+    if message.get("role") != "assistant" or len(message) != 2:
+        return None
+    content = message.get("content")
+    return content if isinstance(content, str) else None
+
+
+async def coalesce_stream_frames(frames, flush_interval: float, flush_bytes: int):
+    """
+    Merge consecutive assistant content frames into one frame per
+    `flush_interval` seconds or `flush_bytes` bytes of content, whichever
+    comes first. Tool, error and other frames are passed through unchanged
+    and in order.
+    """
+    loop = asyncio.get_running_loop()
+    iterator = frames.__aiter__()
+    next_frame = None
+    buffered = None
+    parts = []
+    size = 0
+    deadline = 0.0
+
+    def flush():
+        buffered["choices"][0]["messages"][0]["content"] = "".join(parts)
+        return buffered
+
+    try:
+        while True:
+            if buffered is None and next_frame is None:
+                try:
+                    frame = await iterator.__anext__()
+                except StopAsyncIteration:
+                    break
+            else:
+                # Wait for the next frame without losing it when the window closes
+                if next_frame is None:
+                    next_frame = asyncio.ensure_future(iterator.__anext__())
+                timeout = max(deadline - loop.time(), 0) if buffered is not None else None
+                done, _ = await asyncio.wait({next_frame}, timeout=timeout)
+                if not done:
+                    yield flush()
+                    buffered = None
+                    continue
+                task, next_frame = next_frame, None
+                try:
+                    frame = task.result()
+                except StopAsyncIteration:
+                    break
+
+            content = _stream_frame_content(frame)
+            if buffered is not None and (content is None or frame.get("id") != buffered.get("id")):
+                yield flush()
+                buffered = None
+
+            if content is None:
+                yield frame
+                continue
+
+            if buffered is None:
+                buffered, parts, size = frame, [], 0
+                deadline = loop.time() + flush_interval
+            parts.append(content)
+            size += len(content.encode("utf-8"))
+            if size >= flush_bytes or flush_interval <= 0:
+                yield flush()
+                buffered = None
+
+        if buffered is not None:
+            yield flush()
+    finally:
+        if next_frame is not None:
+            next_frame.cancel()
+            await asyncio.gather(next_frame, return_exceptions=True)
+        await close_stream(iterator)
+
+
+def negotiate_stream_version(accept: str = None, stream_version: str = None) -> int:
+    # Clients opt into the compact format with "Accept: application/json-lines; v=2"
+    # or the stream_version=2 query parameter
+    if stream_version == "2":
+        return 2
+    for media_range in (accept or "").split(","):
+        mimetype, *params = [part.strip() for part in media_range.split(";")]
+        if mimetype == STREAM_MIMETYPE and "v=2" in params:
+            return 2
+    return 1
+
+
+def _same_envelope(frame, envelope) -> bool:
+    return len(frame) == len(envelope) and all(
+        key == "choices" or envelope.get(key) == value for key, value in frame.items()
+    )
+
+
+async def format_delta_stream(frames):
+    """
+    Stream format v2: a frame whose only change from the previous full frame
+    is its assistant content is sent as {"d": "<content>"}; every other frame
+    (tool, error, metadata changes) is sent in full and becomes the envelope
+    for the deltas that follow it.
+    """
+    envelope = None
+    try:
+        async for frame in frames:
+            if not frame:
+                continue
+            content = _stream_frame_content(frame)
+            if content is not None and envelope is not None and _same_envelope(frame, envelope):
+                yield {"d": content}
+                continue
+            if frame.get("choices"):
+                envelope = frame
+            yield frame
+    finally:
+        await close_stream(frames)
+
+
+async def iter_sse_data(lines):
+    # Yield the payload of every "data:" line of a server-sent events stream
+    async for line in lines:
+        if not line.startswith("data:"):
+            continue
+        data = line[5:].strip()
+        if not data or data == "[DONE]":
+            continue
+        yield data
+
+
+def heuristic_title(messages) -> str:
+    # Title made of the first words of the latest user question, used until
+    # (or instead of) the title generated by the model
+    question = next(
+        (m.get("content") for m in reversed(messages) if m.get("role") == "user"), ""
+    )
+    if isinstance(question, list):
+        question = " ".join(
+            part.get("text", "") for part in question if part.get("type") == "text"
+        )
+    words = _TITLE_WORD.findall(question or "")
+    return " ".join(words[:HEURISTIC_TITLE_WORDS]) or "New conversation"
 
 
 def parse_multi_columns(columns: str) -> list:
@@ -45,9 +283,11 @@ def fetchUserGroups(userToken, nextLink=None):
     else:
         endpoint = "https://graph.microsoft.com/v1.0/me/transitiveMemberOf?$select=id"
 
-    headers = {"Authorization": "bearer " + userToken}
+    headers = inject_trace_context({"Authorization": "bearer " + userToken})
     try:
-        r = requests.get(endpoint, headers=headers)
+        with span("GET graph transitiveMemberOf", {"server.address": "graph.microsoft.com"}, SpanKind.CLIENT):
+            r = requests.get(endpoint, headers=headers)
+            set_span_attributes({"http.response.status_code": r.status_code})
         if r.status_code != 200:
             logging.error(f"Error fetching user groups: {r.status_code} {r.text}")
             return []
@@ -143,6 +383,31 @@ def format_stream_response(chatCompletionChunk, history_metadata, apim_request_i
     return {}
 
 
+def format_raw_stream_response(chunk, history_metadata, apim_request_id):
+    # format_stream_response for chunks decoded straight from the service's
+    # server-sent events (RawChatStream)
+    choices = chunk.get("choices")
+    delta = choices[0].get("delta") if choices else None
+    if not delta:
+        return {}
+    if "context" in delta:
+        message = {"role": "tool", "content": json.dumps(delta["context"])}
+    elif delta.get("content"):
+        message = {"role": "assistant", "content": delta["content"]}
+    else:
+        return {}
+
+    return {
+        "id": chunk.get("id"),
+        "model": chunk.get("model"),
+        "created": chunk.get("created"),
+        "object": chunk.get("object"),
+        "choices": [{"messages": [message]}],
+        "history_metadata": history_metadata,
+        "apim-request-id": apim_request_id,
+    }
+
+
 def format_pf_non_streaming_response(
     chatCompletion, history_metadata, response_field_name, citations_field_name, message_uuid=None
 ):
@@ -190,6 +455,43 @@ def format_pf_non_streaming_response(
         return {}
 
 
+def format_pf_stream_response(
+    chunk, history_metadata, response_field_name, citations_field_name, message_uuid=None
+):
+    if "error" in chunk:
+        logging.error(f"Error in promptflow response api: {chunk['error']}")
+        return {"error": chunk["error"]}
+
+    messages = []
+    if chunk.get(citations_field_name):
+        citation_content = {"citations": chunk[citations_field_name]}
+        messages.append({
+            "role": "tool",
+            "content": json.dumps(citation_content)
+        })
+    if chunk.get(response_field_name):
+        messages.append({
+            "role": "assistant",
+            "content": chunk[response_field_name]
+        })
+
+    if not messages:
+        return {}
+
+    return {
+        "id": message_uuid,
+        "model": "",
+        "created": "",
+        "object": "",
+        "history_metadata": history_metadata,
+        "choices": [
+            {
+                "messages": messages,
+            }
+        ]
+    }
+
+
 def convert_to_pf_format(input_json, request_field_name, response_field_name):
     output_json = []
     logging.debug(f"Input json: {input_json}")
@@ -5,14 +5,39 @@
 
 import { chatHistorySampleData } from '../constants/chatHistory'
 
-import { ChatMessage, Conversation, ConversationRequest, CosmosDBHealth, CosmosDBStatus, UserInfo } from './models'
+import {
+  ChatMessage,
+  ChatResponse,
+  Conversation,
+  ConversationRequest,
+  CosmosDBHealth,
+  CosmosDBStatus,
+  UserInfo
+} from './models'
+
+//Kompaktný formát streamu: prvý rámec nesie celú obálku odpovede, ďalšie rámce
+//len nový text odpovede v tvare {"d": "..."}
+export const STREAM_ACCEPT = 'application/json-lines; v=2, application/json-lines;q=0.9'
+
+//Doplní rámec {"d": "..."} o obálku z posledného úplného rámca;
+//úplné rámce (aj zo staršieho formátu) vráti nezmenené
+export function expandStreamFrame(frame: any, envelope?: ChatResponse): ChatResponse {
+  if (typeof frame?.d === 'string' && envelope) {
+    return {
+      ...envelope,
+      choices: [{ messages: [{ id: envelope.id, role: 'assistant', content: frame.d, date: '' }] }]
+    }
+  }
+  return frame as ChatResponse
+}
 
 //Posiela POST požiadavku na endpoint /conversation s telom obsahujúcim správy z options.messages
 export async function conversationApi(options: ConversationRequest, abortSignal: AbortSignal): Promise<Response> {
   const response = await fetch('/conversation', {
     method: 'POST',
     headers: {
-      'Content-Type': 'application/json'
+      'Content-Type': 'application/json',
+      Accept: STREAM_ACCEPT
     },
     body: JSON.stringify({
       messages: options.messages
@@ -44,11 +69,21 @@ export const fetchChatHistoryInit = (): Conversation[] | null => {
 }
 
 // Posiela GET požiadavku na endpoint /history/list s voliteľným offsetom na získanie zoznamu konverzácií.
-export const historyList = async (offset = 0): Promise<Conversation[] | null> => {
-  const response = await fetch(`/history/list?offset=${offset}`, {
+// Kurzor ďalšej stránky histórie (continuation token z Cosmos DB), null po poslednej stránke
+let historyListCursor: string | null = null
+
+export const hasMoreHistory = (): boolean => historyListCursor !== null
+
+export const historyList = async (nextPage = false): Promise<Conversation[] | null> => {
+  if (nextPage && historyListCursor === null) {
+    return []
+  }
+  const query = nextPage ? `?continuation_token=${encodeURIComponent(historyListCursor as string)}` : ''
+  const response = await fetch(`/history/list${query}`, {
     method: 'GET'
   })
     .then(async res => {
+      historyListCursor = res.headers.get('X-Continuation-Token')
       const payload = await res.json()
       if (!Array.isArray(payload)) {
         console.error('There was an issue fetching your data.')
@@ -86,11 +121,13 @@ export const historyList = async (offset = 0): Promise<Conversation[] | null> =>
 
 //Posiela POST požiadavku na endpoint /history/read s telom obsahujúcim ID konverzácie na získanie 
 //správ z danej konverzácie.
-export const historyRead = async (convId: string): Promise<ChatMessage[]> => {
+// Voliteľný parameter since načíta len správy vytvorené po danom čase (ISO dátum)
+export const historyRead = async (convId: string, since?: string): Promise<ChatMessage[]> => {
   const response = await fetch('/history/read', {
     method: 'POST',
     body: JSON.stringify({
-      conversation_id: convId
+      conversation_id: convId,
+      ...(since && { since })
     }),
     headers: {
       'Content-Type': 'application/json'
@@ -144,7 +181,8 @@ export const historyGenerate = async (
   const response = await fetch('/history/generate', {
     method: 'POST',
     headers: {
-      'Content-Type': 'application/json'
+      'Content-Type': 'application/json',
+      Accept: STREAM_ACCEPT
     },
     body: body,
     signal: abortSignal
@@ -238,6 +276,26 @@ export const historyDeleteAll = async (): Promise<Response> => {
   return response
 }
 
+//Získa stav mazania na pozadí (status, deleted, item_count) podľa job_id z odpovede 202 na /history/delete, /history/delete_all alebo /history/clear.
+export const historyDeleteStatus = async (jobId: string): Promise<Response> => {
+  const response = await fetch(`/history/delete_status?job_id=${encodeURIComponent(jobId)}`, {
+    method: 'GET'
+  })
+    .then(res => {
+      return res
+    })
+    .catch(_err => {
+      console.error('There was an issue fetching your data.')
+      const errRes: Response = {
+        ...new Response(),
+        ok: false,
+        status: 500
+      }
+      return errRes
+    })
+  return response
+}
+
 //Posiela POST požiadavku na endpoint /history/clear s telom obsahujúcim ID konverzácie na vymazanie správ z danej konverzácie.
 export const historyClear = async (convId: string): Promise<Response> => {
   const response = await fetch('/history/clear', {
@@ -107,6 +107,8 @@ export type ChatResponse = {
     date: string
   }
   error?: any
+  //Rozpis času spracovania na serveri v ms, posielaný v poslednom rámci streamu
+  server_timing?: Record<string, number>
 }
 
 //Typ pre požiadavku na konverzáciu, obsahuje správy.
@@ -23,7 +23,7 @@ import {
 } from '@fluentui/react'
 import { useBoolean } from '@fluentui/react-hooks'
 
-import { historyDelete, historyList, historyRename } from '../../api'
+import { hasMoreHistory, historyDelete, historyList, historyRename } from '../../api'
 import { Conversation } from '../../api/models'
 import { AppStateContext } from '../../state/AppProvider'
 
@@ -325,7 +325,6 @@ export const ChatHistoryListItemGroups: React.FC<ChatHistoryListItemGroupsProps>
   const appStateContext = useContext(AppStateContext)
   const observerTarget = useRef(null)
   const [, setSelectedItem] = React.useState<Conversation | null>(null)
-  const [offset, setOffset] = useState<number>(25)
   const [observerCounter, setObserverCounter] = useState(0)
   const [showSpinner, setShowSpinner] = useState(false)
   const firstRender = useRef(true)
@@ -349,17 +348,19 @@ export const ChatHistoryListItemGroups: React.FC<ChatHistoryListItemGroupsProps>
       return
     }
     handleFetchHistory()
-    setOffset(offset => (offset += 25))
   }, [observerCounter])
 
   // Fetch the chat history from the API
   const handleFetchHistory = async () => {
     // Access the chat history state from the AppStateContext
     const currentChatHistory = appStateContext?.state.chatHistory
+    if (!hasMoreHistory()) {
+      return
+    }
     setShowSpinner(true)
 
-    // Fetch the chat history from the API
-    await historyList(offset).then(response => {
+    // Fetch the next page of the chat history from the API
+    await historyList(true).then(response => {
       const concatenatedChatHistory = currentChatHistory && response && currentChatHistory.concat(...response)
       if (response) {
         appStateContext?.dispatch({ type: 'FETCH_CHAT_HISTORY', payload: concatenatedChatHistory || response })
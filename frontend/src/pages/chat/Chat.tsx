@@ -32,6 +32,7 @@ import {
   CosmosDBStatus,
   ErrorMessage,
   ExecResults,
+  expandStreamFrame,
 } from "../../api";
 import { Answer } from "../../components/Answer";
 import { QuestionInput } from "../../components/QuestionInput";
@@ -252,6 +253,7 @@ const Chat = () => {
         const reader = response.body.getReader()
 
         let runningText = ''
+        let envelope: ChatResponse | undefined
         while (true) {
           setProcessMessages(messageStatus.Processing)
           const { done, value } = await reader.read()
@@ -263,8 +265,16 @@ const Chat = () => {
             try {
               if (obj !== '' && obj !== '{}') {
                 runningText += obj
-                result = JSON.parse(runningText)
+                const frame = expandStreamFrame(JSON.parse(runningText), envelope)
+                if (frame.server_timing) {
+                  // Rozpis času spracovania na serveri prichádza po odpovedi
+                  console.debug('Server timing (ms)', frame.server_timing)
+                  runningText = ''
+                  return
+                }
+                result = frame
                 if (result.choices?.length > 0) {
+                  envelope = result
                   result.choices[0].messages.forEach(msg => {
                     msg.id = result.id
                     msg.date = new Date().toISOString()
@@ -408,6 +418,7 @@ const Chat = () => {
         const reader = response.body.getReader()
 
         let runningText = ''
+        let envelope: ChatResponse | undefined
         while (true) {
           setProcessMessages(messageStatus.Processing)
           const { done, value } = await reader.read()
@@ -419,12 +430,26 @@ const Chat = () => {
             try {
               if (obj !== '' && obj !== '{}') {
                 runningText += obj
-                result = JSON.parse(runningText)
+                const frame = expandStreamFrame(JSON.parse(runningText), envelope)
+                if (frame.server_timing) {
+                  // Rozpis času spracovania na serveri prichádza po odpovedi
+                  console.debug('Server timing (ms)', frame.server_timing)
+                  runningText = ''
+                  return
+                }
+                if (!frame.choices && frame.history_metadata) {
+                  // Vygenerovaný názov konverzácie prichádza až po odpovedi
+                  result = { ...result, history_metadata: frame.history_metadata }
+                  runningText = ''
+                  return
+                }
+                result = frame
                 if (!result.choices?.[0]?.messages?.[0].content) {
                   errorResponseMessage = NO_CONTENT_ERROR
                   throw Error()
                 }
                 if (result.choices?.length > 0) {
+                  envelope = result
                   result.choices[0].messages.forEach(msg => {
                     msg.id = result.id
                     msg.date = new Date().toISOString()
@@ -99,8 +99,8 @@ export const AppStateProvider: React.FC<AppStateProviderProps> = ({ children })
   useEffect(() => {
     // Check for cosmosdb config and fetch initial data here
     // Fetch chat history from the backend
-    const fetchChatHistory = async (offset = 0): Promise<Conversation[] | null> => {
-      const result = await historyList(offset)
+    const fetchChatHistory = async (): Promise<Conversation[] | null> => {
+      const result = await historyList()
         .then(response => {
           // If chat history is available, update the chat history
           if (response) {
@@ -1,4 +1,6 @@
+import glob
 import multiprocessing
+import os
 
 max_requests = 1000
 max_requests_jitter = 50
@@ -11,3 +13,23 @@ timeout = 230
 num_cpus = multiprocessing.cpu_count()
 workers = (num_cpus * 2) + 1
 worker_class = "uvicorn.workers.UvicornWorker"
+
+
+# With PROMETHEUS_MULTIPROC_DIR set, the workers write their metrics to that
+# directory and /metrics adds them up. The *.db files of the previous run are
+# removed when gunicorn starts (the directory itself and anything else in it
+# are kept), and the live gauges of exited workers (e.g. recycled by
+# max_requests) are dropped.
+def on_starting(server):
+    multiproc_dir = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if multiproc_dir:
+        os.makedirs(multiproc_dir, exist_ok=True)
+        for path in glob.glob(os.path.join(multiproc_dir, "*.db")):
+            os.remove(path)
+
+
+def child_exit(server, worker):
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(worker.pid)
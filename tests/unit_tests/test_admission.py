@@ -0,0 +1,114 @@
+import asyncio
+import time
+import pytest
+from types import SimpleNamespace
+from prometheus_client import REGISTRY
+from backend.utils import close_stream, format_as_ndjson
+from backend.aoai.admission import (
+    AdmissionTimeoutError,
+    DeploymentAdmission,
+    estimate_prompt_tokens,
+)
+
+
+def model_args(content="x" * 400, max_tokens=100):
+    return {"messages": [{"role": "user", "content": content}], "max_tokens": max_tokens}
+
+
+def test_estimate_prompt_tokens():
+    messages = [
+        {"role": "system", "content": "x" * 40},
+        {"role": "user", "content": [{"type": "text", "text": "x" * 20}, {"type": "image_url"}]},
+    ]
+    assert estimate_prompt_tokens(messages) == 4 + 10 + 4 + 5 + 765
+
+
+@pytest.mark.asyncio
+async def test_admission_disabled_without_budgets():
+    admission = DeploymentAdmission("gpt")
+    tickets = await asyncio.gather(*[admission.acquire(model_args()) for _ in range(50)])
+    assert admission.stats.admitted == 50
+    assert admission.stats.in_flight == 50
+    for ticket in tickets:
+        ticket.release()
+    assert admission.stats.in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_admission_queues_within_budget():
+    # 6000 RPM refills one request every 10ms
+    admission = DeploymentAdmission("gpt", requests_per_minute=6000, max_wait=1)
+    admission._rpm.tokens = 0
+
+    start = time.monotonic()
+    await asyncio.gather(*[admission.acquire(model_args()) for _ in range(5)])
+    assert time.monotonic() - start >= 0.04
+    assert admission.stats.admitted == 5
+    assert admission.stats.rejected == 0
+
+
+@pytest.mark.asyncio
+async def test_admission_times_out():
+    admission = DeploymentAdmission("gpt", tokens_per_minute=60, max_wait=0.1)
+    admission._tpm.tokens = 0
+
+    with pytest.raises(AdmissionTimeoutError) as excinfo:
+        await admission.acquire(model_args())
+    assert excinfo.value.status_code == 429
+    assert admission.stats.rejected == 1
+    assert admission.stats.queued == 0
+
+
+@pytest.mark.asyncio
+async def test_release_refunds_unused_tokens():
+    admission = DeploymentAdmission("gpt", tokens_per_minute=10000)
+    ticket = await admission.acquire(model_args(max_tokens=1000))
+    before = admission.remaining_tokens
+
+    async def stream():
+        for content in ["Hel", "lo", None]:
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=content))])
+
+    chunks = [chunk async for chunk in ticket.track_stream(stream())]
+    assert len(chunks) == 3
+    assert admission.stats.tokens_refunded == 1000 - 2
+    assert admission.remaining_tokens >= before + 998
+
+
+@pytest.mark.asyncio
+async def test_client_disconnect_closes_upstream_stream():
+    admission = DeploymentAdmission("gpt-disconnect", tokens_per_minute=10000)
+    ticket = await admission.acquire(model_args(max_tokens=1000))
+    upstream_closed = asyncio.Event()
+    labels = {"deployment": "gpt-disconnect"}
+    cancelled = REGISTRY.get_sample_value("aoai_cancelled_streams_total", labels) or 0
+
+    async def upstream():
+        try:
+            while True:
+                yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content="x"))])
+                await asyncio.sleep(0)
+        finally:
+            upstream_closed.set()
+
+    async def frames():
+        # Same as stream_chat_request
+        response = ticket.track_stream(upstream())
+        try:
+            async for chunk in response:
+                yield {"content": chunk.choices[0].delta.content}
+        finally:
+            await close_stream(response)
+
+    # Quart closes the response body once the client disconnects
+    body = format_as_ndjson(frames())
+    for _ in range(3):
+        await body.__anext__()
+    await body.aclose()
+
+    assert upstream_closed.is_set()
+    assert admission.stats.in_flight == 0
+    assert admission.stats.cancelled == 1
+    assert admission.stats.cancelled_tokens == 3
+    assert REGISTRY.get_sample_value("aoai_cancelled_streams_total", labels) == cancelled + 1
+    assert admission.stats.tokens_refunded == 1000 - 3
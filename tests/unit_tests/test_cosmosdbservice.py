@@ -0,0 +1,290 @@
+import re
+import pytest
+from azure.cosmos import exceptions
+from prometheus_client import REGISTRY
+from backend.history.cosmosdbservice import ConversationCache, ConversationListCache, CosmosConversationClient
+from backend.history.store import InvalidContinuationToken
+
+
+class FakeContainer:
+    # Transactional batches on a single partition, with conditional patches
+    # limited to the "updatedAt <" predicate used by create_message, and deletes
+    def __init__(self):
+        self.items = {}
+        self.batches = []
+        self.reads = 0
+
+    async def read_item(self, item, partition_key, response_hook=None):
+        self.reads += 1
+        if item not in self.items or self.items[item]["userId"] != partition_key:
+            raise exceptions.CosmosResourceNotFoundError(status_code=404, message="Not found")
+        if response_hook:
+            response_hook({"x-ms-request-charge": "1.0"}, self.items[item])
+        return dict(self.items[item])
+
+    async def delete_item(self, item, partition_key, response_hook=None):
+        if item not in self.items:
+            raise exceptions.CosmosResourceNotFoundError(status_code=404, message="Not found")
+        del self.items[item]
+
+    async def patch_item(self, item, partition_key, patch_operations, response_hook=None):
+        for patch in patch_operations:
+            self.items[item][patch["path"].lstrip("/")] = patch["value"]
+        return dict(self.items[item])
+
+    async def execute_item_batch(self, batch_operations, partition_key, response_hook=None):
+        self.batches.append(batch_operations)
+        items = {key: dict(value) for key, value in self.items.items()}
+        results = []
+        for operation, args, *options in batch_operations:
+            options = options[0] if options else {}
+            if operation == "upsert":
+                items[args[0]["id"]] = args[0]
+                results.append({"statusCode": 200, "resourceBody": args[0]})
+                continue
+            item = items.get(args[0])
+            if operation == "delete" and item:
+                del items[args[0]]
+                results.append({"statusCode": 204})
+                continue
+            predicate = re.search(r"c.updatedAt < '(.*)'", options.get("filter_predicate", ""))
+            if not item:
+                status_code = 404
+            elif predicate and not item["updatedAt"] < predicate.group(1):
+                status_code = 412
+            else:
+                for patch in args[1]:
+                    item[patch["path"].lstrip("/")] = patch["value"]
+                results.append({"statusCode": 200, "resourceBody": item})
+                continue
+            results.append({"statusCode": status_code})
+            raise exceptions.CosmosBatchOperationError(
+                error_index=len(results) - 1,
+                headers={"x-ms-request-charge": "1.0"},
+                status_code=status_code,
+                operation_responses=results,
+            )
+
+        self.items = items
+        if response_hook:
+            response_hook({
+                "x-ms-request-charge": "12.5",
+                "x-ms-request-duration-ms": "4.0",
+                "x-ms-throttle-retry-count": "1",
+            }, results)
+        return results
+
+
+@pytest.fixture
+def cosmos():
+    client = CosmosConversationClient("https://localhost:8081/", "key", "db", "conversations")
+    client.container_client = FakeContainer()
+    client.conversation_cache = ConversationCache(max_entries=10, ttl=30)
+    return client
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+def conversation(updated_at):
+    return {"id": "conv", "type": "conversation", "userId": "user", "updatedAt": updated_at}
+
+
+@pytest.mark.asyncio
+async def test_create_message_appends_in_one_batch(cosmos):
+    cosmos.container_client.items["conv"] = conversation("2000-01-01T00:00:00")
+    retries = sample("cosmosdb_throttle_retries_total", operation="append_message")
+    timed = sample("chat_history_operation_duration_seconds_count", operation="append_message")
+
+    message = await cosmos.create_message("msg", "conv", "user", {"role": "user", "content": "hi"})
+
+    items = cosmos.container_client.items
+    assert message["id"] == "msg"
+    assert items["msg"]["content"] == "hi"
+    assert items["conv"]["updatedAt"] == items["msg"]["createdAt"]
+    assert len(cosmos.container_client.batches) == 1
+    stats = cosmos.stats.snapshot()["append_message"]
+    assert (stats["request_charge"], stats["avg_server_seconds"], stats["retries"]) == (12.5, 0.004, 1)
+    assert sample("cosmosdb_throttle_retries_total", operation="append_message") == retries + 1
+    assert sample("chat_history_operation_duration_seconds_count", operation="append_message") == timed + 1
+
+
+@pytest.mark.asyncio
+async def test_create_message_without_conversation(cosmos):
+    result = await cosmos.create_message("msg", "conv", "user", {"role": "user", "content": "hi"})
+
+    assert result == "Conversation not found"
+    assert "msg" not in cosmos.container_client.items
+    assert cosmos.stats.snapshot()["append_message"]["failures"] == 1
+
+
+@pytest.mark.asyncio
+async def test_create_message_keeps_newer_updated_at(cosmos):
+    # A concurrent append already stored a later message
+    cosmos.container_client.items["conv"] = conversation("9999-01-01T00:00:00")
+
+    await cosmos.create_message("msg", "conv", "user", {"role": "user", "content": "hi"})
+
+    items = cosmos.container_client.items
+    assert items["msg"]["content"] == "hi"
+    assert items["conv"]["updatedAt"] == "9999-01-01T00:00:00"
+
+
+@pytest.mark.asyncio
+async def test_get_conversation_point_read_and_cache(cosmos):
+    cosmos.container_client.items["conv"] = conversation("2000-01-01T00:00:00")
+    cosmos.container_client.items["msg"] = {"id": "msg", "type": "message", "userId": "user"}
+
+    first = await cosmos.get_conversation("user", "conv")
+    first["title"] = "changed by the caller"
+    second = await cosmos.get_conversation("user", "conv")
+    assert second["id"] == "conv" and "title" not in second
+    assert cosmos.container_client.reads == 1
+    assert cosmos.stats.snapshot()["read_conversation"]["request_charge"] == 1.0
+
+    assert await cosmos.get_conversation("other-user", "conv") is None
+    assert await cosmos.get_conversation("user", "msg") is None
+
+    # Appending a message invalidates the cached conversation
+    await cosmos.create_message("msg2", "conv", "user", {"role": "user", "content": "hi"})
+    third = await cosmos.get_conversation("user", "conv")
+    assert third["updatedAt"] != "2000-01-01T00:00:00"
+
+
+class FakePages:
+    # Pages of `page_size` items addressed by their start index as token
+    def __init__(self, items, page_size, continuation_token, response_hook=None):
+        self.items = items
+        self.page_size = page_size or len(items)
+        self.continuation_token = continuation_token
+        self.response_hook = response_hook
+        self.done = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.done:
+            raise StopAsyncIteration
+        start = int(self.continuation_token or 0)
+        end = start + self.page_size
+        self.continuation_token = str(end) if end < len(self.items) else None
+        self.done = self.continuation_token is None
+        if self.response_hook:
+            self.response_hook({"x-ms-request-charge": "3.5", "x-ms-request-duration-ms": "2.0"}, None)
+
+        async def page():
+            for item in self.items[start:end]:
+                yield item
+
+        return page()
+
+
+@pytest.mark.asyncio
+async def test_get_messages_page(cosmos):
+    queries = []
+    messages = [{"id": f"m{i}", "createdAt": f"2024-01-0{i + 1}"} for i in range(5)]
+
+    class QueryResult:
+        def __init__(self, **kwargs):
+            queries.append(kwargs)
+
+        def by_page(self, continuation_token=None):
+            if continuation_token == "expired":
+                return RejectedPages(messages, None, continuation_token)
+            return FakePages(messages, queries[-1]["max_item_count"], continuation_token)
+
+    class RejectedPages(FakePages):
+        async def __anext__(self):
+            raise exceptions.CosmosHttpResponseError(status_code=400, message="Invalid continuation token")
+
+    cosmos.container_client.query_items = QueryResult
+
+    page, token = await cosmos.get_messages_page("user", "conv", limit=2)
+    assert [m["id"] for m in page] == ["m0", "m1"]
+    page, token = await cosmos.get_messages_page("user", "conv", limit=2, continuation_token=token)
+    assert [m["id"] for m in page] == ["m2", "m3"]
+    page, token = await cosmos.get_messages_page("user", "conv", limit=2, continuation_token=token)
+    assert [m["id"] for m in page] == ["m4"] and token is None
+    with pytest.raises(InvalidContinuationToken):
+        await cosmos.get_messages_page("user", "conv", limit=2, continuation_token="expired")
+
+    await cosmos.get_messages_page("user", "conv", limit=2, since="2024-01-03")
+    assert queries[-1]["partition_key"] == "user"
+    assert "c.createdAt > @since ORDER BY c.createdAt ASC" in queries[-1]["query"]
+    assert {"name": "@since", "value": "2024-01-03"} in queries[-1]["parameters"]
+
+
+@pytest.mark.asyncio
+async def test_delete_items_in_batches(cosmos):
+    items = cosmos.container_client.items
+    for i in range(250):
+        items[f"m{i}"] = {"id": f"m{i}", "type": "message", "userId": "user"}
+    # Already deleted by a concurrent request: its batch falls back to single deletes
+    ids = list(items) + ["gone"]
+
+    deleted = await cosmos.delete_items("user", ids)
+
+    assert deleted == 250 and not cosmos.container_client.items
+    batches = cosmos.container_client.batches
+    assert [len(batch) for batch in batches] == [100, 100, 51]
+    assert all(operation == "delete" for batch in batches for operation, *_ in batch)
+    assert cosmos.stats.snapshot()["delete_items"]["failures"] == 1
+
+
+@pytest.mark.asyncio
+async def test_conversation_list_cache(cosmos):
+    cosmos.conversation_list_cache = ConversationListCache(max_users=10, ttl=30)
+    container = cosmos.container_client
+    charged = sample("cosmosdb_request_charge_bucket", operation="list_conversations", le="5.0")
+    saved = sample("chat_history_cache_request_charge_saved_total")
+    container.items["old"] = dict(conversation("2000-01-01T00:00:00"), id="old", title="Old")
+    container.items["conv"] = dict(conversation("2001-01-01T00:00:00"), title="New")
+    queries = []
+
+    def query_items(**kwargs):
+        queries.append(kwargs)
+        conversations = sorted(
+            (item for item in container.items.values() if item["type"] == "conversation"),
+            key=lambda item: item["updatedAt"],
+            reverse=True,
+        )
+        # Like the SDK, with the headers of the previous request
+        kwargs["response_hook"]({"x-ms-request-charge": "99.0"}, None)
+        return type("QueryResult", (), {
+            "by_page": lambda self, token=None: FakePages(
+                conversations, kwargs["max_item_count"], token, kwargs["response_hook"]
+            )
+        })()
+
+    container.query_items = query_items
+
+    page, _ = await cosmos.get_conversations_page("user", limit=25)
+    assert [c["id"] for c in page] == ["conv", "old"]
+
+    # Renames and appends update the cached page in place
+    await cosmos.update_conversation_title("user", "old", "Renamed")
+    await cosmos.create_message("msg", "old", "user", {"role": "user", "content": "hi"})
+    page, _ = await cosmos.get_conversations_page("user", limit=25)
+    assert [(c["id"], c["title"]) for c in page] == [("old", "Renamed"), ("conv", "New")]
+    assert page[0]["updatedAt"] == container.items["old"]["updatedAt"]
+    assert len(queries) == 1
+
+    # Deleting a conversation drops the user's pages
+    await cosmos.delete_items("user", ["conv"])
+    page, _ = await cosmos.get_conversations_page("user", limit=25)
+    assert [c["id"] for c in page] == ["old"]
+    assert len(queries) == 2
+
+    list_cache = cosmos.conversation_list_cache
+    assert (list_cache.hits, list_cache.misses, list_cache.request_charge_saved) == (1, 2, 3.5)
+    stats = cosmos.stats.snapshot()["list_conversations"]
+    assert stats["request_charge"] == 7.0
+    assert stats["avg_server_seconds"] == 0.002
+    assert sample("cosmosdb_request_charge_bucket", operation="list_conversations", le="5.0") == charged + 2
+    assert sample("chat_history_cache_request_charge_saved_total") == saved + 3.5
+
+    # Queries over all pages sum the charge of each page
+    await cosmos.get_conversations("user", limit=None)
+    assert cosmos.stats.snapshot()["list_conversations"]["request_charge"] == 10.5
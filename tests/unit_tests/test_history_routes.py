@@ -0,0 +1,104 @@
+import os
+import pytest
+from importlib import import_module, reload
+from types import SimpleNamespace
+from backend.aoai.admission import DeploymentAdmission
+from backend.aoai.routing import Deployment, DeploymentRouter
+from backend.history.memorystore import InMemoryConversationClient
+
+
+class FakeStream:
+    def __init__(self, contents):
+        self._chunks = iter(
+            SimpleNamespace(
+                id="c1", model="gpt", created=1, object="chat.completion.chunk",
+                choices=[SimpleNamespace(
+                    index=0, delta=SimpleNamespace(role="assistant", content=content), finish_reason=None
+                )],
+            )
+            for content in contents
+        )
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._chunks)
+        except StopIteration:
+            raise StopAsyncIteration
+
+    async def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def chat_app(monkeypatch):
+    monkeypatch.setenv(
+        "DOTENV_PATH", os.path.join(os.path.dirname(__file__), "dotenv_data", "dotenv_no_datasource_1")
+    )
+    reload(import_module("backend.settings"))
+    chat_app = reload(import_module("app"))
+    monkeypatch.setattr(chat_app.app_settings.azure_openai, "stream", True)
+    chat_app.app.response_cache = None
+    chat_app.app.semantic_cache = None
+    chat_app.cosmos_db_ready.set()
+    return chat_app
+
+
+@pytest.mark.asyncio
+async def test_failed_history_write_releases_the_upstream_stream(chat_app):
+    stream = FakeStream(["Hel", "lo"])
+
+    async def create(**kwargs):
+        return SimpleNamespace(parse=lambda: stream, headers={})
+
+    client = SimpleNamespace(
+        chat=SimpleNamespace(completions=SimpleNamespace(with_raw_response=SimpleNamespace(create=create)))
+    )
+    deployment = Deployment("gpt", "gpt", client, DeploymentAdmission("gpt"))
+    chat_app.app.deployment_router = DeploymentRouter([deployment])
+
+    history = InMemoryConversationClient()
+    conversation = await history.create_conversation("00000000-0000-0000-0000-000000000000", "Title")
+
+    async def create_message(*args, **kwargs):
+        raise RuntimeError("CosmosDB is unavailable")
+
+    history.create_message = create_message
+    chat_app.app.cosmos_conversation_client = history
+
+    response = await chat_app.app.test_client().post(
+        "/history/generate",
+        json={
+            "conversation_id": conversation["id"],
+            "messages": [{"id": "1", "role": "user", "content": "hi"}],
+        },
+    )
+
+    assert response.status_code == 500
+    assert (await response.get_json())["error"] == "CosmosDB is unavailable"
+    assert stream.closed
+    assert deployment.admission.stats.in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_invalid_paging_parameters_are_rejected(chat_app):
+    user_id = "00000000-0000-0000-0000-000000000000"
+    history = InMemoryConversationClient()
+    conversation = await history.create_conversation(user_id, "Title")
+    await history.create_message("m1", conversation["id"], user_id, {"role": "user", "content": "hi"})
+    chat_app.app.cosmos_conversation_client = history
+    client = chat_app.app.test_client()
+
+    for body in [{"limit": "abc"}, {"limit": 0}, {"limit": True}, {"limit": 2, "continuation_token": "abc"}]:
+        response = await client.post("/history/read", json={"conversation_id": conversation["id"], **body})
+        assert response.status_code == 400, body
+
+    response = await client.get("/history/list", query_string={"continuation_token": "abc"})
+    assert response.status_code == 400
+
+    response = await client.post("/history/read", json={"conversation_id": conversation["id"], "limit": 2})
+    assert [m["id"] for m in (await response.get_json())["messages"]] == ["m1"]
+    assert (await client.get("/history/list")).status_code == 200
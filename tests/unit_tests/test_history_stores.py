@@ -0,0 +1,94 @@
+import pytest
+from datetime import datetime, timedelta
+from backend.history.memorystore import InMemoryConversationClient
+from backend.history.sqlitestore import SqliteConversationClient
+from backend.history.store import InvalidContinuationToken, is_stale_deletion_job
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store_factory(request, tmp_path):
+    async def open_store():
+        if request.param == "memory":
+            return InMemoryConversationClient(enable_message_feedback=True)
+        store = SqliteConversationClient(str(tmp_path / "history.sqlite3"), enable_message_feedback=True)
+        await store.connect()
+        return store
+
+    return open_store
+
+
+def message(content):
+    return {"role": "user", "content": content}
+
+
+@pytest.mark.asyncio
+async def test_conversation_lifecycle(store_factory):
+    store = await store_factory()
+    try:
+        assert (await store.ensure())[0]
+        first = await store.create_conversation("user", "First")
+        second = await store.create_conversation("user", "Second")
+        await store.create_conversation("other-user", "Not mine")
+
+        assert await store.create_message("m0", "missing", "user", message("hi")) == "Conversation not found"
+        for i in range(3):
+            await store.create_message(f"m{i + 1}", first["id"], "user", message(f"hi {i}"))
+
+        # Appending moved the first conversation to the top of the list
+        conversations = await store.get_conversations("user", limit=None)
+        assert [c["title"] for c in conversations] == ["First", "Second"]
+        assert conversations[0]["updatedAt"] > first["updatedAt"]
+
+        page, token = await store.get_conversations_page("user", limit=1)
+        assert [c["id"] for c in page] == [first["id"]] and token
+        page, token = await store.get_conversations_page("user", limit=1, continuation_token=token)
+        assert [c["id"] for c in page] == [second["id"]] and token is None
+
+        messages, token = await store.get_messages_page("user", first["id"], limit=2)
+        assert [m["id"] for m in messages] == ["m1", "m2"]
+        messages, token = await store.get_messages_page("user", first["id"], limit=2, continuation_token=token)
+        assert [m["id"] for m in messages] == ["m3"] and token is None
+        with pytest.raises(InvalidContinuationToken):
+            await store.get_messages_page("user", first["id"], limit=2, continuation_token="abc")
+        since = (await store.get_messages("user", first["id"]))[0]["createdAt"]
+        messages, _ = await store.get_messages_page("user", first["id"], limit=10, since=since)
+        assert [m["id"] for m in messages] == ["m2", "m3"]
+
+        await store.update_conversation_title("user", second["id"], "Renamed")
+        assert (await store.get_conversation("user", second["id"]))["title"] == "Renamed"
+        assert (await store.update_message_feedback("user", "m1", "positive"))["feedback"] == "positive"
+        assert await store.get_conversation("user", "m1") is None
+        assert await store.get_conversation("other-user", first["id"]) is None
+    finally:
+        await store.close()
+
+
+@pytest.mark.asyncio
+async def test_deletion(store_factory):
+    store = await store_factory()
+    try:
+        first = await store.create_conversation("user", "First")
+        second = await store.create_conversation("user", "Second")
+        await store.create_message("m1", first["id"], "user", message("hi"))
+        await store.create_message("m2", second["id"], "user", message("hi"))
+
+        assert await store.get_deletion_ids("user", first["id"]) == [first["id"], "m1"]
+        assert await store.delete_messages(first["id"], "user") == ["m1"]
+        assert await store.get_messages("user", first["id"]) == []
+
+        job = await store.create_deletion_job("user", 3)
+        # A job left running by an exited worker
+        assert not is_stale_deletion_job(job)
+        assert is_stale_deletion_job(job, now=datetime.utcnow() + timedelta(hours=1))
+        ids = await store.get_deletion_ids("user")
+        assert sorted(ids[:2]) == sorted([first["id"], second["id"]]) and ids[2:] == ["m2"]
+        assert await store.delete_items("user", ids + ["gone"]) == 3
+        assert await store.get_conversations("user", limit=None) == []
+
+        await store.update_deletion_job("user", job["id"], "succeeded", 3)
+        job = await store.get_deletion_job("user", job["id"])
+        assert (job["status"], job["deleted"]) == ("succeeded", 3)
+        assert not is_stale_deletion_job(job, now=datetime.utcnow() + timedelta(hours=1))
+        assert store.stats.snapshot()["delete_items"]["count"] == 2
+    finally:
+        await store.close()
@@ -0,0 +1,53 @@
+import time
+import pytest
+from prometheus_client import REGISTRY
+from backend.metrics import observe_chat_stream, render_metrics
+
+
+def sample(name, route):
+    return REGISTRY.get_sample_value(name, {"route": route}) or 0
+
+
+def content_frame(content):
+    return {"choices": [{"messages": [{"role": "assistant", "content": content}]}]}
+
+
+@pytest.mark.asyncio
+async def test_observe_chat_stream():
+    route = "/test/observe_chat_stream"
+
+    async def frames():
+        yield {"choices": [{"messages": [{"role": "tool", "content": "{}"}]}]}
+        for content in ["Hel", "lo", " world"]:
+            yield content_frame(content)
+
+    stream = observe_chat_stream(frames(), route, time.perf_counter())
+    assert len([frame async for frame in stream]) == 4
+
+    assert sample("chat_time_to_first_token_seconds_count", route) == 1
+    assert sample("chat_request_duration_seconds_count", route) == 1
+    assert sample("chat_completion_tokens_per_second_count", route) == 1
+    assert sample("chat_streams_in_flight", route) == 0
+
+    body, content_type = render_metrics()
+    assert content_type.startswith("text/plain")
+    assert f'chat_request_duration_seconds_count{{route="{route}"}} 1.0' in body.decode()
+
+
+@pytest.mark.asyncio
+async def test_observe_chat_stream_closed_early():
+    route = "/test/observe_chat_stream_closed_early"
+
+    async def frames():
+        for content in ["Hel", "lo"]:
+            yield content_frame(content)
+
+    stream = observe_chat_stream(frames(), route, time.perf_counter())
+    await stream.__anext__()
+    assert sample("chat_streams_in_flight", route) == 1
+    await stream.aclose()
+
+    # A stream the client walked away from is not a complete answer
+    assert sample("chat_streams_in_flight", route) == 0
+    assert sample("chat_time_to_first_token_seconds_count", route) == 1
+    assert sample("chat_request_duration_seconds_count", route) == 0
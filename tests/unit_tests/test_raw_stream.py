@@ -0,0 +1,89 @@
+import json
+import httpx
+import openai
+import pytest
+from openai import AsyncAzureOpenAI
+from backend.aoai.admission import DeploymentAdmission
+from backend.aoai.cache import ResponseCache, record_stream
+from backend.aoai.routing import Deployment, DeploymentRouter
+from backend.utils import format_raw_stream_response, format_stream_response
+
+CONTEXT = {"citations": [{"title": "Handbook", "content": "Twenty days"}]}
+
+
+def sse_body(events):
+    body = "".join(f"data: {json.dumps(event)}\n\n" for event in events)
+    return (body + "data: [DONE]\n\n").encode()
+
+
+def chunk(delta, finish_reason=None):
+    return {
+        "id": "c1", "object": "chat.completion.chunk", "created": 1, "model": "gpt",
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+
+
+EVENTS = [
+    chunk({"role": "assistant", "content": None, "context": CONTEXT}),
+    chunk({"content": "Twenty"}),
+    chunk({"content": " days"}, "stop"),
+]
+
+
+def make_client(events):
+    def handler(request):
+        return httpx.Response(200, headers={"content-type": "text/event-stream"}, content=sse_body(events))
+
+    return AsyncAzureOpenAI(
+        api_key="key",
+        api_version="2024-05-01-preview",
+        azure_endpoint="https://example.openai.azure.com",
+        http_client=httpx.AsyncClient(transport=httpx.MockTransport(handler)),
+        max_retries=0,
+    )
+
+
+def make_router(events):
+    return DeploymentRouter([Deployment("gpt", "gpt", make_client(events), DeploymentAdmission("gpt"))])
+
+
+@pytest.mark.asyncio
+async def test_raw_stream_formats_like_sdk_stream():
+    args = {"messages": [{"role": "user", "content": "PTO?"}], "stream": True}
+
+    sdk_response, _ = await make_router(EVENTS).create_chat_completion(args)
+    sdk_frames = [format_stream_response(c, {}, "apim") async for c in sdk_response]
+
+    raw_response, _ = await make_router(EVENTS).create_chat_completion(args, raw_stream=True)
+    raw_frames = [format_raw_stream_response(c, {}, "apim") async for c in raw_response]
+
+    assert raw_frames == sdk_frames
+    assert [f["choices"][0]["messages"][0]["role"] for f in raw_frames] == ["tool", "assistant", "assistant"]
+
+
+@pytest.mark.asyncio
+async def test_raw_stream_error_event_is_retried():
+    router = make_router([{"error": {"code": "500", "message": "Internal error"}}])
+    router.primary.max_retries = 0
+    with pytest.raises(openai.APIError, match="Internal error"):
+        await router.create_chat_completion({"messages": [], "stream": True}, raw_stream=True)
+
+
+@pytest.mark.asyncio
+async def test_raw_stream_is_cached_and_replayed():
+    cache = ResponseCache()
+    response, _ = await make_router(EVENTS).create_chat_completion(
+        {"messages": [], "stream": True}, raw_stream=True
+    )
+    live = [
+        format_raw_stream_response(c, {}, None)
+        async for c in record_stream(response, lambda entry: cache.put("key", entry))
+    ]
+
+    cached = cache.get("key")
+    assert cached.content == "Twenty days"
+    assert cached.context == CONTEXT
+    replayed = [format_raw_stream_response(c, {}, None) async for c in cached.as_raw_stream()]
+    assert replayed[0]["choices"] == live[0]["choices"]
+    assert replayed[0]["id"] != live[0]["id"]
+    assert replayed[1]["choices"][0]["messages"][0]["content"] == "Twenty days"
@@ -0,0 +1,128 @@
+import pytest
+from types import SimpleNamespace
+from backend.aoai.cache import (
+    CachedCompletion,
+    ResponseCache,
+    record_stream,
+    response_cache_key,
+)
+from backend.utils import format_stream_response, format_non_streaming_response
+
+
+def make_chunk(delta, finish_reason=None):
+    return SimpleNamespace(
+        id="c1", model="gpt", created=1, object="chat.completion.chunk",
+        choices=[SimpleNamespace(index=0, delta=delta, finish_reason=finish_reason)],
+    )
+
+
+async def make_stream(chunks, error=None):
+    for chunk in chunks:
+        yield chunk
+    if error:
+        raise error
+
+
+STREAM = [
+    make_chunk(SimpleNamespace(role="assistant", content=None, context={"citations": [{"title": "Handbook"}]})),
+    make_chunk(SimpleNamespace(role="assistant", content="Twenty")),
+    make_chunk(SimpleNamespace(role=None, content=" days"), "stop"),
+]
+
+
+def test_cache_key_normalizes_messages():
+    args = {
+        "messages": [{"role": "user", "content": "How many  vacation days?\n", "id": "1"}],
+        "temperature": 0,
+        "stream": True,
+        "user": "alice",
+        "extra_body": {"data_sources": [{"type": "azure_search", "parameters": {"filter": "a"}}]},
+    }
+    same = {
+        **args,
+        "messages": [{"role": "user", "content": "How many vacation days?", "id": "2"}],
+        "stream": False,
+        "user": "bob",
+    }
+    other_filter = {**args, "extra_body": {"data_sources": [{"type": "azure_search", "parameters": {"filter": "b"}}]}}
+    other_params = {**args, "temperature": 1}
+
+    key = response_cache_key(args)
+    assert response_cache_key(same) == key
+    assert response_cache_key(other_filter) != key
+    assert response_cache_key(other_params) != key
+
+
+def test_lru_eviction_and_ttl(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr("backend.aoai.cache.time.monotonic", lambda: now[0])
+    cache = ResponseCache(max_entries=2, ttl=10)
+
+    cache.put("a", CachedCompletion("1", "gpt", 1, "chat.completion", "A"))
+    cache.put("b", CachedCompletion("2", "gpt", 1, "chat.completion", "B"))
+    assert cache.get("a").content == "A"
+    cache.put("c", CachedCompletion("3", "gpt", 1, "chat.completion", "C"))
+    assert cache.get("b") is None
+    assert cache.stats.evictions == 1
+
+    now[0] = 11
+    assert cache.get("a") is None
+    assert cache.stats.expirations == 1
+
+
+@pytest.mark.asyncio
+async def test_streamed_answer_replays_through_format_stream_response():
+    cache = ResponseCache()
+
+    def store(entry):
+        cache.put("key", entry)
+
+    original = [
+        format_stream_response(chunk, {}, None)
+        async for chunk in record_stream(make_stream(STREAM), store)
+    ]
+
+    cached = cache.get("key")
+    assert cached.content == "Twenty days"
+    replayed = [format_stream_response(chunk, {}, None) async for chunk in cached.as_stream()]
+    assert replayed[0]["choices"] == original[0]["choices"]
+    assert "".join(r["choices"][0]["messages"][0]["content"] for r in replayed[1:]) == "Twenty days"
+
+    completion = format_non_streaming_response(cached.as_completion(), {}, None)
+    assert [m["role"] for m in completion["choices"][0]["messages"]] == ["tool", "assistant"]
+
+
+@pytest.mark.asyncio
+async def test_every_replay_gets_a_new_id():
+    # The frontend stores the assistant message under the completion id
+    cached = CachedCompletion("c1", "gpt", 1, "chat.completion", "Twenty days")
+
+    first = [chunk.id async for chunk in cached.as_stream()]
+    second = [chunk.id async for chunk in cached.as_stream()]
+    raw = [chunk["id"] async for chunk in cached.as_raw_stream()]
+    assert len(set(first)) == 1 and len(set(second)) == 1
+    ids = {first[0], second[0], raw[0], cached.as_completion().id, cached.as_completion().id}
+    assert len(ids) == 5 and "c1" not in ids
+
+
+@pytest.mark.asyncio
+async def test_incomplete_stream_is_not_cached():
+    cache = ResponseCache()
+
+    def store(entry):
+        cache.put("key", entry)
+
+    with pytest.raises(RuntimeError):
+        async for _ in record_stream(make_stream(STREAM[:2], RuntimeError("boom")), store):
+            pass
+
+    stream = record_stream(make_stream(STREAM), store)
+    await stream.__anext__()
+    await stream.aclose()
+
+    filtered = STREAM[:2] + [make_chunk(SimpleNamespace(role=None, content=None), "content_filter")]
+    async for _ in record_stream(make_stream(filtered), store):
+        pass
+
+    assert cache.get("key") is None
+    assert cache.stats.stores == 0
@@ -0,0 +1,132 @@
+import asyncio
+import json
+import time
+import httpx
+import pytest
+from contextlib import asynccontextmanager
+from aiohttp import web
+from openai import AsyncAzureOpenAI
+from backend.aoai.admission import DeploymentAdmission
+from backend.aoai.retry import parse_duration, parse_retry_after, percentile
+from backend.aoai.routing import Deployment, DeploymentRouter
+
+
+def test_parse_retry_after():
+    assert parse_retry_after({"retry-after-ms": "250"}) == 0.25
+    assert parse_retry_after({"retry-after": "3"}) == 3
+    assert parse_retry_after({"x-ratelimit-reset-requests": "1s", "x-ratelimit-reset-tokens": "1m30s"}) == 90
+    assert parse_retry_after({"x-ratelimit-reset": "120ms"}) == 0.12
+    assert parse_retry_after({}) is None
+    assert parse_duration("soon") is None
+
+
+def test_percentile():
+    assert percentile(list(range(1, 101)), 95) == 95
+    assert percentile([], 95) is None
+
+
+def completion_chunk(content):
+    return {
+        "id": "c1", "object": "chat.completion.chunk", "created": 1, "model": "gpt",
+        "choices": [{"index": 0, "delta": {"role": "assistant", "content": content}, "finish_reason": None}],
+    }
+
+
+@asynccontextmanager
+async def fake_server():
+    calls = {}
+
+    async def chat_completions(request):
+        deployment = request.match_info["deployment"]
+        calls[deployment] = calls.get(deployment, 0) + 1
+        await request.read()
+
+        if deployment == "throttled" and calls[deployment] == 1:
+            return web.json_response(
+                {"error": {"code": "429", "message": "Rate limit"}},
+                status=429,
+                headers={"retry-after-ms": "200"},
+            )
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        if deployment == "slow":
+            await asyncio.sleep(2)
+        for content in ["Hel", "lo"]:
+            await response.write(f"data: {json.dumps(completion_chunk(content))}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+    app = web.Application()
+    app.router.add_post("/openai/deployments/{deployment}/chat/completions", chat_completions)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+
+    clients = []
+
+    def make_deployment(name, **kwargs):
+        client = AsyncAzureOpenAI(
+            api_key="key",
+            api_version="2024-05-01-preview",
+            azure_endpoint=f"http://127.0.0.1:{port}",
+            http_client=httpx.AsyncClient(),
+            max_retries=0,
+        )
+        clients.append(client)
+        return Deployment(name, name, client, DeploymentAdmission(name), **kwargs)
+
+    try:
+        yield make_deployment, calls
+    finally:
+        for client in clients:
+            await client.close()
+        await runner.cleanup()
+
+
+async def read_content(response):
+    return "".join([chunk.choices[0].delta.content async for chunk in response])
+
+
+@pytest.mark.asyncio
+async def test_retry_honors_retry_after():
+    async with fake_server() as (make_deployment, calls):
+        router = DeploymentRouter([make_deployment("throttled")])
+
+        start = time.monotonic()
+        response, _ = await router.create_chat_completion({"messages": [], "stream": True})
+
+        assert await read_content(response) == "Hello"
+        assert calls["throttled"] == 2
+        assert time.monotonic() - start >= 0.2
+
+
+@pytest.mark.asyncio
+async def test_retry_gives_up_after_max_retries():
+    async with fake_server() as (make_deployment, calls):
+        router = DeploymentRouter([make_deployment("throttled", max_retries=0)])
+
+        with pytest.raises(Exception) as excinfo:
+            await router.create_chat_completion({"messages": [], "stream": True})
+        assert excinfo.value.status_code == 429
+        assert calls["throttled"] == 1
+
+
+@pytest.mark.asyncio
+async def test_hedged_request_wins_over_slow_deployment():
+    async with fake_server() as (make_deployment, calls):
+        slow = make_deployment("slow", hedging=True, hedge_min_delay=0.1)
+        slow.latency_samples.extend([0.05] * 20)
+        fast = make_deployment("fast")
+        router = DeploymentRouter([slow, fast])
+
+        start = time.monotonic()
+        response, _ = await router.create_chat_completion({"messages": [], "stream": True})
+
+        assert await read_content(response) == "Hello"
+        assert time.monotonic() - start < 1
+        assert calls == {"slow": 1, "fast": 1}
+        assert slow.admission.stats.in_flight == 0
+        assert fast.admission.stats.in_flight == 0
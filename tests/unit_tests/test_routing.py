@@ -0,0 +1,165 @@
+import asyncio
+import httpx
+import openai
+import pytest
+from types import SimpleNamespace
+from backend.aoai.admission import DeploymentAdmission
+from backend.aoai.routing import Deployment, DeploymentRouter
+
+
+def make_chunk(content):
+    return SimpleNamespace(
+        id="c1", model="gpt", created=1, object="chat.completion.chunk",
+        choices=[SimpleNamespace(delta=SimpleNamespace(role="assistant", content=content))],
+    )
+
+
+def make_status_error(status_code):
+    request = httpx.Request("POST", "https://example.openai.azure.com")
+    response = httpx.Response(status_code, request=request)
+    return openai.APIStatusError("error", response=response, body=None)
+
+
+class FakeStream:
+    def __init__(self, chunks, error=None):
+        self._chunks = iter(chunks)
+        self._error = error
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._chunks)
+        except StopIteration:
+            if self._error:
+                raise self._error
+            raise StopAsyncIteration
+
+    async def close(self):
+        self.closed = True
+
+
+class FakeClient:
+    def __init__(self, results):
+        self.results = list(results)
+        self.calls = 0
+        self.chat = SimpleNamespace(
+            completions=SimpleNamespace(
+                with_raw_response=SimpleNamespace(create=self.create)
+            )
+        )
+
+    async def create(self, **kwargs):
+        self.calls += 1
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return SimpleNamespace(parse=lambda: result, headers={"apim-request-id": "abc"})
+
+
+def make_deployment(name, results):
+    return Deployment(name, name, FakeClient(results), DeploymentAdmission(name))
+
+
+@pytest.mark.asyncio
+async def test_failover_on_throttling():
+    completion = SimpleNamespace(usage=None)
+    primary = make_deployment("primary", [make_status_error(429)])
+    secondary = make_deployment("secondary", [completion])
+    router = DeploymentRouter([primary, secondary])
+
+    response, apim_request_id = await router.create_chat_completion({"messages": [], "stream": False})
+
+    assert response is completion
+    assert apim_request_id == "abc"
+    assert not primary.healthy
+    assert router.candidates()[0] is secondary
+
+
+@pytest.mark.asyncio
+async def test_non_retryable_errors_are_raised():
+    primary = make_deployment("primary", [make_status_error(400)])
+    secondary = make_deployment("secondary", [SimpleNamespace(usage=None)])
+    router = DeploymentRouter([primary, secondary])
+
+    with pytest.raises(openai.APIStatusError):
+        await router.create_chat_completion({"messages": [], "stream": False})
+    assert primary.healthy
+    assert secondary.client.calls == 0
+
+
+@pytest.mark.asyncio
+async def test_candidates_prefer_lower_latency():
+    slow = make_deployment("slow", [])
+    fast = make_deployment("fast", [])
+    slow.record_success(2.0)
+    fast.record_success(0.2)
+
+    assert DeploymentRouter([slow, fast]).candidates() == [fast, slow]
+
+
+def test_completion_latency_is_kept_apart_from_time_to_first_token():
+    # e.g. title completions, which are not streamed
+    streaming = make_deployment("streaming", [])
+    complete = make_deployment("complete", [])
+    streaming.record_success(0.3)
+    complete.record_success(0.5)
+    streaming.record_success(4.0, stream=False)
+    complete.record_success(2.0, stream=False)
+
+    router = DeploymentRouter([streaming, complete])
+    assert router.candidates() == [streaming, complete]
+    assert router.candidates(stream=False) == [complete, streaming]
+    assert list(streaming.latency_samples) == [0.3]
+
+
+@pytest.mark.asyncio
+async def test_stream_fails_over_before_first_token():
+    broken_stream = FakeStream([make_chunk("")], error=openai.APIConnectionError(request=None))
+    primary = make_deployment("primary", [broken_stream])
+    secondary = make_deployment("secondary", [FakeStream([make_chunk("Hel"), make_chunk("lo")])])
+    router = DeploymentRouter([primary, secondary])
+
+    response, _ = await router.create_chat_completion({"messages": [], "stream": True})
+    contents = [chunk.choices[0].delta.content async for chunk in response]
+
+    assert contents == ["Hel", "lo"]
+    assert broken_stream.closed
+    assert secondary.admission.stats.in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_hedging_loser_is_released_when_both_answer_at_once():
+    primary_stream = FakeStream([make_chunk("Hel"), make_chunk("lo")])
+    backup_stream = FakeStream([make_chunk("Hel"), make_chunk("lo")])
+    primary = make_deployment("primary", [primary_stream])
+    primary.hedging = True
+    primary.hedge_min_delay = 0.01
+    primary.latency_samples.extend([0.01] * 20)
+    backup = make_deployment("backup", [backup_stream])
+    router = DeploymentRouter([primary, backup])
+
+    # The primary answers as soon as the hedged request is sent, so both
+    # requests finish in the same round
+    hedged = asyncio.Event()
+    primary_create, backup_create = primary.client.create, backup.client.create
+
+    async def slow_create(**kwargs):
+        await hedged.wait()
+        return await primary_create(**kwargs)
+
+    async def hedge_create(**kwargs):
+        hedged.set()
+        return await backup_create(**kwargs)
+
+    primary.client.chat.completions.with_raw_response.create = slow_create
+    backup.client.chat.completions.with_raw_response.create = hedge_create
+
+    response, _ = await router.create_chat_completion({"messages": [], "stream": True})
+    assert [chunk.choices[0].delta.content async for chunk in response] == ["Hel", "lo"]
+
+    assert primary.admission.stats.in_flight == 0
+    assert backup.admission.stats.in_flight == 0
+    assert primary_stream.closed and backup_stream.closed
@@ -0,0 +1,92 @@
+import numpy as np
+import pytest
+from backend.aoai.cache import CachedCompletion
+from backend.aoai import semantic_cache as semantic_cache_module
+from backend.aoai.semantic_cache import SemanticCache, first_question, semantic_scope_key
+
+VECTORS = {
+    "How many vacation days do I get?": [1.0, 0.0, 0.0],
+    "How many days of vacation do I get?": [0.99, 0.1, 0.0],
+    "What is the dental plan?": [0.0, 1.0, 0.0],
+    "Who is my manager?": [0.0, 0.0, 1.0],
+}
+
+
+async def fake_embed(text):
+    return VECTORS[text]
+
+
+def answer(content):
+    return CachedCompletion("c1", "gpt", 1, "chat.completion", content)
+
+
+async def store(cache, scope, question, content):
+    cache.put(scope, await cache.embed(question), answer(content))
+
+
+async def lookup(cache, scope, question):
+    return await cache.get(scope, await cache.embed(question))
+
+
+def test_first_question():
+    system = {"role": "system", "content": "Be helpful"}
+    assert first_question([system, {"role": "user", "content": " Hi  there "}]) == "Hi there"
+    assert first_question([
+        {"role": "user", "content": "Hi"},
+        {"role": "assistant", "content": "Hello"},
+        {"role": "user", "content": "More"},
+    ]) is None
+    assert first_question([{"role": "user", "content": [{"type": "image_url"}]}]) is None
+
+
+def test_scope_ignores_user_messages():
+    args = {"messages": [{"role": "user", "content": "a"}], "temperature": 0}
+    assert semantic_scope_key(args) == semantic_scope_key({**args, "messages": [{"role": "user", "content": "b"}]})
+    assert semantic_scope_key(args) != semantic_scope_key({**args, "temperature": 1})
+
+
+@pytest.mark.asyncio
+async def test_similar_question_hits_within_scope():
+    cache = SemanticCache(fake_embed, threshold=0.95)
+    await store(cache, 1, "How many vacation days do I get?", "Twenty days")
+
+    assert (await lookup(cache, 1, "How many days of vacation do I get?")).content == "Twenty days"
+    assert await lookup(cache, 1, "What is the dental plan?") is None
+    assert await lookup(cache, 2, "How many vacation days do I get?") is None
+    assert cache.stats.hits == 1
+    assert cache.stats.misses == 2
+
+
+@pytest.mark.asyncio
+async def test_eviction_and_ttl(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(semantic_cache_module.time, "monotonic", lambda: now[0])
+    cache = SemanticCache(fake_embed, max_entries=2, ttl=10)
+
+    await store(cache, 1, "How many vacation days do I get?", "Twenty days")
+    now[0] = 1
+    await store(cache, 1, "What is the dental plan?", "Dental")
+    now[0] = 2
+    assert await lookup(cache, 1, "How many vacation days do I get?")
+    await store(cache, 1, "Who is my manager?", "Alice")
+
+    assert cache.size == 2
+    assert cache.stats.evictions == 1
+    assert await lookup(cache, 1, "What is the dental plan?") is None
+
+    now[0] = 20
+    assert await lookup(cache, 1, "Who is my manager?") is None
+    assert cache.stats.expirations == 1
+
+
+@pytest.mark.asyncio
+async def test_large_index_is_searched_off_the_event_loop(monkeypatch):
+    monkeypatch.setattr(semantic_cache_module, "OFFLOAD_THRESHOLD", 0)
+    cache = SemanticCache(fake_embed, max_entries=2000)
+    rng = np.random.default_rng(0)
+    for _ in range(1500):
+        vector = rng.normal(size=3).astype(np.float32)
+        cache.put(1, vector / np.linalg.norm(vector) * 0.5, answer("noise"))
+    await store(cache, 1, "Who is my manager?", "Alice")
+
+    assert (await lookup(cache, 1, "Who is my manager?")).content == "Alice"
@@ -0,0 +1,57 @@
+import pytest
+from backend.server_timing import (
+    ServerTiming,
+    append_server_timing_frame,
+    server_timing,
+    start_server_timing,
+)
+
+
+def test_server_timing_header():
+    timing = ServerTiming(start=10.0)
+    timing.add("ttft", 0.5)
+    timing.add("history", 0.01)
+    timing.add("history", 0.0025)
+
+    assert timing.milliseconds(now=11.0) == {"history": 12.5, "ttft": 500.0, "total": 1000.0}
+    assert timing.header(now=11.0) == (
+        'history;dur=12.5;desc="Chat history store", '
+        'ttft;dur=500.0;desc="Upstream time to first token", '
+        'total;dur=1000.0;desc="Total"'
+    )
+
+
+@pytest.mark.asyncio
+async def test_stages_add_to_the_current_request():
+    with server_timing("auth"):
+        pass
+
+    timing = start_server_timing(0.0)
+    with server_timing("datasource"):
+        pass
+    with server_timing("history"):
+        pass
+    with server_timing("history"):
+        pass
+
+    assert set(timing.seconds) == {"datasource", "history"}
+
+
+@pytest.mark.asyncio
+async def test_append_server_timing_frame():
+    async def frames():
+        yield {"choices": []}
+        yield {"choices": []}
+
+    timing = start_server_timing(0.0)
+    stream = append_server_timing_frame(frames(), timing)
+    result = [frame async for frame in stream]
+    assert len(result) == 3
+    assert set(result[-1]["server_timing"]) == {"stream", "total"}
+
+    # No breakdown for a client that went away
+    timing = start_server_timing(0.0)
+    stream = append_server_timing_frame(frames(), timing)
+    await stream.__anext__()
+    await stream.aclose()
+    assert timing.seconds == {}
@@ -1,6 +1,7 @@
 import os
 import pytest
 from importlib import import_module, reload
+from types import SimpleNamespace
 
 
 @pytest.fixture(scope="function")
@@ -70,3 +71,28 @@ def test_dotenv_with_elasticsearch_success(app_settings):
     
     
 
+def test_dotenv_with_azure_search_permitted_groups(app_settings, monkeypatch):
+    datasource = app_settings.datasource
+    monkeypatch.setattr(
+        datasource.__class__,
+        "_set_filter_string",
+        lambda self, request: f"group_ids/any(g:search.in(g, '{request.headers['user']}'))",
+    )
+
+    # The static payload is built once and cannot be modified
+    payload = datasource.compile_payload_configuration()
+    assert datasource.get_payload_configuration() is payload
+    assert "filter" not in payload["parameters"]
+    with pytest.raises(TypeError):
+        payload["parameters"]["top_n_documents"] = 1
+
+    # Security filters are overlaid per request without touching the settings
+    alice = SimpleNamespace(headers={"user": "alice"})
+    bob = SimpleNamespace(headers={"user": "bob"})
+    alice_payload = datasource.get_payload_configuration(request=alice)
+    bob_payload = datasource.get_payload_configuration(request=bob)
+    assert alice_payload["parameters"]["filter"] == "group_ids/any(g:search.in(g, 'alice'))"
+    assert bob_payload["parameters"]["filter"] == "group_ids/any(g:search.in(g, 'bob'))"
+    assert alice_payload["parameters"]["index_name"] == payload["parameters"]["index_name"]
+    assert datasource.filter is None
+    assert "filter" not in payload["parameters"]
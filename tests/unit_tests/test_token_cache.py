@@ -0,0 +1,77 @@
+import asyncio
+import time
+import pytest
+from azure.core.credentials import AccessToken
+from prometheus_client import REGISTRY
+from backend.auth.token_cache import CachedTokenCredential
+
+
+class FakeCredential:
+    def __init__(self, lifetime=3600):
+        self.lifetime = lifetime
+        self.calls = 0
+        self.closed = False
+
+    async def get_token(self, *scopes, **kwargs):
+        self.calls += 1
+        return AccessToken(f"token-{self.calls}", int(time.time() + self.lifetime))
+
+    async def close(self):
+        self.closed = True
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+@pytest.mark.asyncio
+async def test_get_token_is_cached():
+    fake = FakeCredential()
+    hits = sample("token_cache_lookups_total", result="hit")
+    fetches = sample("token_fetch_duration_seconds_count")
+    async with CachedTokenCredential(fake) as credential:
+        tokens = await asyncio.gather(
+            *[credential.get_token("scope/.default") for _ in range(10)]
+        )
+        assert {t.token for t in tokens} == {"token-1"}
+        assert fake.calls == 1
+
+        await credential.get_token("scope/.default")
+        assert credential.stats.hits >= 1
+        assert credential.stats.fetches == 1
+        assert sample("token_cache_lookups_total", result="hit") == hits + credential.stats.hits
+        assert sample("token_fetch_duration_seconds_count") == fetches + 1
+
+    assert fake.closed
+
+
+@pytest.mark.asyncio
+async def test_bearer_token_provider():
+    fake = FakeCredential()
+    async with CachedTokenCredential(fake) as credential:
+        provider = credential.bearer_token_provider("scope/.default")
+        assert await provider() == "token-1"
+        assert await provider() == "token-1"
+        assert fake.calls == 1
+
+
+@pytest.mark.asyncio
+async def test_background_refresh_before_expiry():
+    fake = FakeCredential(lifetime=4)
+    async with CachedTokenCredential(fake, refresh_margin=3, min_validity=1) as credential:
+        first = await credential.get_token("scope/.default")
+        await asyncio.sleep(2.5)
+        second = await credential.get_token("scope/.default")
+
+        assert first.token == "token-1"
+        assert second.token == "token-2"
+        assert credential.stats.background_refreshes >= 1
+
+
+@pytest.mark.asyncio
+async def test_claims_bypass_cache():
+    fake = FakeCredential()
+    async with CachedTokenCredential(fake) as credential:
+        await credential.get_token("scope/.default")
+        token = await credential.get_token("scope/.default", claims="challenge")
+        assert token.token == "token-2"
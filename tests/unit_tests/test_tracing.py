@@ -0,0 +1,61 @@
+import pytest
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+
+from backend import tracing
+from backend.tracing import (
+    end_request_span,
+    inject_trace_context,
+    span,
+    start_request_span,
+    trace_stream,
+)
+
+INCOMING_TRACE_ID = "0af7651916cd43dd8448eb211c80319c"
+
+
+@pytest.fixture
+def exporter(monkeypatch):
+    exporter = InMemorySpanExporter()
+    provider = TracerProvider()
+    provider.add_span_processor(SimpleSpanProcessor(exporter))
+    monkeypatch.setattr(tracing, "_tracer", provider.get_tracer("test"))
+    return exporter
+
+
+async def frames():
+    for content in ["Hel", "lo"]:
+        yield {"content": content}
+
+
+@pytest.mark.asyncio
+async def test_tracing_disabled():
+    assert span("noop") is span("other")
+    assert inject_trace_context({}) == {}
+    assert start_request_span("POST", "/conversation", {}) == (None, None)
+    stream = frames()
+    assert trace_stream(stream) is stream
+
+
+@pytest.mark.asyncio
+async def test_request_and_stream_spans(exporter):
+    incoming = {"traceparent": f"00-{INCOMING_TRACE_ID}-b7ad6b7169203331-01"}
+    request_span, token = start_request_span("POST", "/conversation", incoming)
+    with span("send_chat_request"):
+        outgoing = inject_trace_context({})
+    stream = trace_stream(frames(), request_span)
+    end_request_span(None, token, 200)
+
+    # The request span only ends with the stream it was handed to
+    assert [s.name for s in exporter.get_finished_spans()] == ["send_chat_request"]
+    assert len([frame async for frame in stream]) == 2
+
+    spans = {s.name: s for s in exporter.get_finished_spans()}
+    assert set(spans) == {"send_chat_request", "emit_stream", "POST /conversation"}
+    assert all(format(s.context.trace_id, "032x") == INCOMING_TRACE_ID for s in spans.values())
+    assert spans["emit_stream"].parent.span_id == request_span.get_span_context().span_id
+    assert spans["emit_stream"].attributes["chat.stream.frames"] == 2
+    assert outgoing["traceparent"].split("-")[1:3] == [
+        INCOMING_TRACE_ID, format(spans["send_chat_request"].context.span_id, "016x")
+    ]
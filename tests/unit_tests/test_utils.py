@@ -1,5 +1,17 @@
+import asyncio
+import json
 import pytest
-from backend.utils import format_as_ndjson, parse_multi_columns
+from backend.utils import (
+    coalesce_stream_frames,
+    format_as_ndjson,
+    format_delta_stream,
+    negotiate_stream_version,
+    format_pf_stream_response,
+    iter_sse_data,
+    parse_multi_columns,
+    redact_secrets,
+    heuristic_title,
+)
 
 
 @pytest.mark.asyncio
@@ -27,3 +39,152 @@ def test_parse_multi_columns():
     assert parse_multi_columns(test_pipes) == ["col1", "col2", "col3"]
     assert parse_multi_columns(test_commas) == ["col1", "col2", "col3"]
     assert parse_multi_columns(test_single) == ["col1"]
+
+
+@pytest.mark.asyncio
+async def test_iter_sse_data():
+    async def dummy_lines():
+        for line in ['data: {"reply": "Hel"}', "", ": keep-alive", 'data: {"reply": "lo"}', "data: [DONE]"]:
+            yield line
+
+    events = [json.loads(data) async for data in iter_sse_data(dummy_lines())]
+    assert events == [{"reply": "Hel"}, {"reply": "lo"}]
+
+
+def test_format_pf_stream_response():
+    history_metadata = {"conversation_id": "conv"}
+    citations = format_pf_stream_response(
+        {"documents": [{"title": "doc"}]}, history_metadata, "reply", "documents", "msg"
+    )
+    assert citations["id"] == "msg"
+    assert citations["choices"][0]["messages"] == [
+        {"role": "tool", "content": json.dumps({"citations": [{"title": "doc"}]})}
+    ]
+
+    content = format_pf_stream_response(
+        {"reply": "Hello"}, history_metadata, "reply", "documents", "msg"
+    )
+    assert content["history_metadata"] == history_metadata
+    assert content["choices"][0]["messages"] == [{"role": "assistant", "content": "Hello"}]
+
+    assert format_pf_stream_response({"reply": ""}, history_metadata, "reply", "documents") == {}
+
+
+def content_frame(content, id="c1"):
+    return {"id": id, "choices": [{"messages": [{"role": "assistant", "content": content}]}]}
+
+
+def tool_frame():
+    return {"id": "c1", "choices": [{"messages": [{"role": "tool", "content": "{}"}]}]}
+
+
+async def frames_with_delays(items):
+    for delay, frame in items:
+        await asyncio.sleep(delay)
+        yield frame
+
+
+def contents(frames):
+    return [
+        frame["choices"][0]["messages"][0].get("content") if frame.get("choices") else frame
+        for frame in frames
+    ]
+
+
+@pytest.mark.asyncio
+async def test_coalesce_stream_frames_merges_content_and_keeps_tool_frames():
+    frames = [
+        (0, {}),
+        (0, tool_frame()),
+        (0, content_frame("Hel")),
+        (0, content_frame("lo")),
+        (0, {"error": "boom"}),
+        (0, content_frame(" world")),
+        (0, content_frame("!", id="c2")),
+    ]
+    coalesced = [f async for f in coalesce_stream_frames(frames_with_delays(frames), 1, 1024)]
+
+    assert contents(coalesced) == [{}, "{}", "Hello", {"error": "boom"}, " world", "!"]
+    assert coalesced[1]["choices"][0]["messages"][0]["role"] == "tool"
+
+
+@pytest.mark.asyncio
+async def test_coalesce_stream_frames_flushes_on_size_and_interval():
+    frames = [(0, content_frame("ab")), (0, content_frame("cd")), (0, content_frame("e"))]
+    coalesced = [f async for f in coalesce_stream_frames(frames_with_delays(frames), 1, 4)]
+    assert contents(coalesced) == ["abcd", "e"]
+
+    # A stalled upstream does not hold back content already received
+    frames = [(0, content_frame("a")), (0, content_frame("b")), (0.2, content_frame("c"))]
+    stream = coalesce_stream_frames(frames_with_delays(frames), 0.05, 1024)
+    first = await asyncio.wait_for(stream.__anext__(), 0.15)
+    assert contents([first]) == ["ab"]
+    assert contents([f async for f in stream]) == ["c"]
+
+
+@pytest.mark.asyncio
+async def test_coalesce_stream_frames_closes_upstream():
+    closed = asyncio.Event()
+
+    async def upstream():
+        try:
+            yield content_frame("a")
+            await asyncio.sleep(10)
+            yield content_frame("b")
+        finally:
+            closed.set()
+
+    stream = coalesce_stream_frames(upstream(), 0.01, 1024)
+    assert contents([await stream.__anext__()]) == ["a"]
+    await stream.aclose()
+    assert closed.is_set()
+
+
+def test_negotiate_stream_version():
+    assert negotiate_stream_version("application/json-lines; v=2, application/json-lines;q=0.9") == 2
+    assert negotiate_stream_version("application/json-lines") == 1
+    assert negotiate_stream_version("*/*", "2") == 2
+    assert negotiate_stream_version(None) == 1
+
+
+@pytest.mark.asyncio
+async def test_format_delta_stream():
+    async def frames():
+        yield {}
+        yield {**tool_frame(), "history_metadata": {}}
+        yield {**content_frame("Hel"), "history_metadata": {}}
+        yield {**content_frame("lo"), "history_metadata": {}}
+        yield {**content_frame("!"), "history_metadata": {"title": "Greeting"}}
+        yield {"error": "boom"}
+
+    delta_frames = [frame async for frame in format_delta_stream(frames())]
+    assert delta_frames[0]["choices"][0]["messages"][0]["role"] == "tool"
+    assert delta_frames[1:3] == [{"d": "Hel"}, {"d": "lo"}]
+    assert delta_frames[3]["history_metadata"] == {"title": "Greeting"}
+    assert delta_frames[4] == {"error": "boom"}
+
+
+def test_redact_secrets():
+    model_args = {
+        "messages": [{"role": "user", "content": "key"}],
+        "extra_body": {"data_sources": ({"parameters": {
+            "key": "secret",
+            "index_name": "index",
+            "authentication": {"type": "api_key", "key": "secret"},
+            "embedding_dependency": {"authentication": {"api_key": "secret"}},
+        }},)},
+    }
+    redacted = json.dumps(redact_secrets(model_args))
+    assert "secret" not in redacted
+    assert '"index_name": "index"' in redacted
+    assert model_args["extra_body"]["data_sources"][0]["parameters"]["key"] == "secret"
+
+
+def test_heuristic_title():
+    messages = [
+        {"role": "user", "content": "Hi"},
+        {"role": "assistant", "content": "Hello! How can I help?"},
+        {"role": "user", "content": '  "What\'s the refund policy for damaged items, exactly?"'},
+    ]
+    assert heuristic_title(messages) == "What's the refund policy for damaged"
+    assert heuristic_title([{"role": "user", "content": [{"type": "image_url"}]}]) == "New conversation"
@@ -0,0 +1,218 @@
+"""
+Measure the time to first answer token of /history/generate against
+/conversation, i.e. the latency the conversation history adds in front of
+the chat completion.
+
+Azure OpenAI is replaced by a local server streaming its first token after
+--ttft seconds, Cosmos DB by an in-memory container answering every call
+after --cosmos-latency seconds. Creating a conversation and storing the
+user message costs two Cosmos round trips (create conversation, then a
+batch appending the message) which used to run before the chat completion
+was even sent. A follow-up turn in an existing conversation only appends the
+message:
+
+    python tools/benchmarks/history_generate_ttft.py --requests 20 --ttft 0.3 --cosmos-latency 0.03
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+
+import aiohttp
+from aiohttp import web
+from azure.cosmos import exceptions
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+AOAI_PORT = 8791
+APP_PORT = 8792
+
+
+class CosmosContainerStandIn:
+    def __init__(self, latency):
+        self.latency = latency
+        self.items = {}
+
+    async def read_item(self, item, partition_key, response_hook=None):
+        await asyncio.sleep(self.latency)
+        if item not in self.items or self.items[item]["userId"] != partition_key:
+            raise exceptions.CosmosResourceNotFoundError(status_code=404, message="Not found")
+        return dict(self.items[item])
+
+    async def upsert_item(self, body, response_hook=None):
+        await asyncio.sleep(self.latency)
+        self.items[body["id"]] = body
+        return body
+
+    async def patch_item(self, item, partition_key, patch_operations, response_hook=None):
+        await asyncio.sleep(self.latency)
+        for operation in patch_operations:
+            self.items[item][operation["path"].lstrip("/")] = operation["value"]
+        return self.items[item]
+
+    async def execute_item_batch(self, batch_operations, partition_key, response_hook=None):
+        await asyncio.sleep(self.latency)
+        results = []
+        for operation, args, *options in batch_operations:
+            if operation == "upsert":
+                self.items[args[0]["id"]] = args[0]
+                results.append({"statusCode": 200, "resourceBody": args[0]})
+            elif operation == "patch":
+                for patch in args[1]:
+                    self.items[args[0]][patch["path"].lstrip("/")] = patch["value"]
+                results.append({"statusCode": 200, "resourceBody": self.items[args[0]]})
+        return results
+
+    def query_items(self, query, parameters, partition_key, max_item_count=None, response_hook=None):
+        # Only the message queries of a conversation, answered in a single page
+        values = {p["name"]: p["value"] for p in parameters}
+        messages = sorted(
+            (
+                item for item in self.items.values()
+                if item["userId"] == partition_key and item["type"] == "message"
+                and item["conversationId"] == values.get("@conversationId")
+            ),
+            key=lambda item: item["createdAt"],
+        )
+        return QueryPagesStandIn(messages, self.latency)
+
+
+class QueryPagesStandIn:
+    continuation_token = None
+
+    def __init__(self, items, latency):
+        self.items = items
+        self.latency = latency
+
+    def by_page(self, continuation_token=None):
+        return self
+
+    async def __aiter__(self):
+        await asyncio.sleep(self.latency)
+        yield self._page()
+
+    async def _page(self):
+        for item in self.items:
+            yield item
+
+
+async def start_aoai_stand_in(ttft):
+    async def chat(request):
+        body = await request.json()
+        if not body.get("stream"):
+            # Title completion
+            await asyncio.sleep(ttft)
+            return web.json_response({
+                "id": "title", "object": "chat.completion", "created": 1, "model": "gpt",
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": "Benchmark title"}}],
+            })
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        await asyncio.sleep(ttft)
+        base = {"id": "answer", "object": "chat.completion.chunk", "created": 1, "model": "gpt"}
+        for delta in [{"role": "assistant", "content": ""}] + [{"content": " tok"}] * 20:
+            chunk = {**base, "choices": [{"index": 0, "delta": delta, "finish_reason": None}]}
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+    aoai = web.Application()
+    aoai.router.add_post("/openai/deployments/{deployment}/chat/completions", chat)
+    runner = web.AppRunner(aoai)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", AOAI_PORT).start()
+    return runner
+
+
+def question(conversation_id=None):
+    body = {"messages": [{"id": "1", "role": "user", "content": "What is the refund policy?"}]}
+    if conversation_id:
+        body["conversation_id"] = conversation_id
+    return body
+
+
+async def time_to_first_token(session, path, body):
+    start = time.perf_counter()
+    async with session.post(f"http://127.0.0.1:{APP_PORT}{path}", json=body) as response:
+        async for line in response.content:
+            frame = json.loads(line) if line.strip() else {}
+            if frame.get("choices", [{}])[0].get("messages", [{}])[0].get("content"):
+                return time.perf_counter() - start
+    raise RuntimeError(f"No answer from {path}")
+
+
+async def new_conversation(session):
+    async with session.post(f"http://127.0.0.1:{APP_PORT}/history/generate", json=question()) as response:
+        frames = [json.loads(line) async for line in response.content if line.strip()]
+    return next(
+        frame["history_metadata"]["conversation_id"] for frame in frames if frame.get("history_metadata")
+    )
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=20)
+    parser.add_argument("--ttft", type=float, default=0.3)
+    parser.add_argument("--cosmos-latency", type=float, default=0.03)
+    args = parser.parse_args()
+
+    aoai = await start_aoai_stand_in(args.ttft)
+    os.environ.update(
+        DOTENV_PATH=os.devnull,
+        AZURE_OPENAI_MODEL="gpt",
+        AZURE_OPENAI_KEY="benchmark",
+        AZURE_OPENAI_ENDPOINT=f"http://127.0.0.1:{AOAI_PORT}",
+        AZURE_OPENAI_STREAM="True",
+        STREAM_FLUSH_INTERVAL="0",
+    )
+
+    import uvicorn
+    import app as chat_app
+    from backend.history.cosmosdbservice import CosmosConversationClient
+
+    async def init_cosmos_stand_in(credential=None):
+        client = CosmosConversationClient("https://localhost:8081/", "benchmark", "db", "conversations")
+        client.container_client = CosmosContainerStandIn(args.cosmos_latency)
+        return client
+
+    chat_app.init_cosmosdb_client = init_cosmos_stand_in
+    server = uvicorn.Server(uvicorn.Config(chat_app.app, port=APP_PORT, log_level="warning"))
+    serving = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+
+    results = {}
+    async with aiohttp.ClientSession() as session:
+        conversation_id = await new_conversation(session)
+        async with session.post(
+            f"http://127.0.0.1:{APP_PORT}/history/read", json={"conversation_id": conversation_id}
+        ) as response:
+            assert len((await response.json())["messages"]) == 1
+
+        runs = {
+            "/conversation": ("/conversation", question()),
+            "/history/generate": ("/history/generate", question()),
+            "  follow-up turn": ("/history/generate", question(conversation_id)),
+        }
+        for label, (path, body) in runs.items():
+            await time_to_first_token(session, path, body)
+            samples = [await time_to_first_token(session, path, body) for _ in range(args.requests)]
+            results[label] = statistics.median(samples)
+            print(f"{label:<20} median time to first token {results[label] * 1000:7.1f} ms")
+
+    overhead = results["/history/generate"] - results["/conversation"]
+    sequential = 2 * args.cosmos_latency
+    print(f"history overhead {overhead * 1000:.1f} ms (sequential writes: {sequential * 1000:.1f} ms)")
+
+    server.should_exit = True
+    await serving
+    await aoai.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,90 @@
+"""
+Compare the latency of the chat history stores on the same workload: users
+creating conversations, appending messages, listing and reading them, then
+deleting everything. Each store records its own per-operation latency, which
+is printed side by side:
+
+    python tools/benchmarks/history_store_latency.py --users 20 --conversations 5 --messages 10
+
+The CosmosDB store is included with --stores cosmosdb when AZURE_COSMOSDB_ACCOUNT,
+AZURE_COSMOSDB_ACCOUNT_KEY, AZURE_COSMOSDB_DATABASE and
+AZURE_COSMOSDB_CONVERSATIONS_CONTAINER are set. It writes into that container.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import uuid
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+from backend.history.memorystore import InMemoryConversationClient
+
+
+async def open_store(name, directory):
+    if name == "memory":
+        return InMemoryConversationClient()
+    if name == "sqlite":
+        from backend.history.sqlitestore import SqliteConversationClient
+
+        store = SqliteConversationClient(os.path.join(directory, "history.sqlite3"))
+        await store.connect()
+        return store
+
+    from backend.history.cosmosdbservice import CosmosConversationClient
+
+    return CosmosConversationClient(
+        f"https://{os.environ['AZURE_COSMOSDB_ACCOUNT']}.documents.azure.com:443/",
+        os.environ["AZURE_COSMOSDB_ACCOUNT_KEY"],
+        os.environ["AZURE_COSMOSDB_DATABASE"],
+        os.environ["AZURE_COSMOSDB_CONVERSATIONS_CONTAINER"],
+    )
+
+
+async def user_session(store, user_id, conversations, messages):
+    for _ in range(conversations):
+        conversation = await store.create_conversation(user_id, "Benchmark")
+        for i in range(messages):
+            role = "user" if i % 2 == 0 else "assistant"
+            await store.create_message(str(uuid.uuid4()), conversation["id"], user_id, {"role": role, "content": "Benchmark message"})
+            await store.get_conversation(user_id, conversation["id"])
+        await store.get_conversations_page(user_id, limit=25)
+        await store.get_messages(user_id, conversation["id"])
+    await store.delete_items(user_id, await store.get_deletion_ids(user_id))
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stores", nargs="+", default=["memory", "sqlite"], choices=["memory", "sqlite", "cosmosdb"])
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--conversations", type=int, default=5)
+    parser.add_argument("--messages", type=int, default=10)
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for name in args.stores:
+            store = await open_store(name, directory)
+            start = time.perf_counter()
+            await asyncio.gather(*(
+                user_session(store, f"benchmark-{uuid.uuid4()}", args.conversations, args.messages)
+                for _ in range(args.users)
+            ))
+            print(f"{name:<10} workload finished in {time.perf_counter() - start:.2f} s")
+            results[name] = store.stats.snapshot()
+            await store.close()
+
+    operations = sorted({operation for stats in results.values() for operation in stats})
+    print(f"\n{'avg ms':<22}" + "".join(f"{name:>12}" for name in results))
+    for operation in operations:
+        row = "".join(
+            f"{stats[operation]['avg_seconds'] * 1000:12.3f}" if operation in stats else f"{'-':>12}"
+            for stats in results.values()
+        )
+        print(f"{operation:<22}{row}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,124 @@
+"""
+Compare per-request latency of chat completions when a new AsyncAzureOpenAI
+client is created for every request (previous behaviour) against the pooled,
+per-worker client created in create_app().
+
+The benchmark starts a local mock Azure OpenAI endpoint, so no Azure resources
+are needed:
+
+    python tools/benchmarks/openai_client_pool.py --requests 500 --concurrency 20
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+from aiohttp import web
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+COMPLETION = {
+    "id": "chatcmpl-benchmark",
+    "object": "chat.completion",
+    "created": 0,
+    "model": "gpt-35-turbo",
+    "choices": [
+        {
+            "index": 0,
+            "finish_reason": "stop",
+            "message": {"role": "assistant", "content": "Hello from the mock endpoint."},
+        }
+    ],
+    "usage": {"prompt_tokens": 10, "completion_tokens": 7, "total_tokens": 17},
+}
+
+
+async def start_mock_endpoint(host="127.0.0.1", port=0):
+    async def chat_completions(request):
+        await request.read()
+        return web.json_response(COMPLETION, headers={"apim-request-id": "benchmark"})
+
+    mock_app = web.Application()
+    mock_app.router.add_post(
+        "/openai/deployments/{deployment}/chat/completions", chat_completions
+    )
+    runner = web.AppRunner(mock_app)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    bound_port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://{host}:{bound_port}"
+
+
+def summarize(label, latencies):
+    latencies = sorted(latencies)
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    print(
+        f"{label:<22} mean={statistics.mean(latencies) * 1000:7.2f}ms "
+        f"p50={statistics.median(latencies) * 1000:7.2f}ms "
+        f"p95={p95 * 1000:7.2f}ms"
+    )
+
+
+async def run(get_client, release_client, total, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one_request():
+        async with semaphore:
+            start = time.perf_counter()
+            client = await get_client()
+            await client.chat.completions.create(
+                model="benchmark",
+                messages=[{"role": "user", "content": "Hello"}],
+            )
+            await release_client(client)
+            latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(*[one_request() for _ in range(total)])
+    return latencies
+
+
+async def main(args):
+    runner, endpoint = await start_mock_endpoint()
+    os.environ["AZURE_OPENAI_ENDPOINT"] = endpoint
+    os.environ["AZURE_OPENAI_KEY"] = "benchmark"
+    os.environ["AZURE_OPENAI_MODEL"] = "benchmark"
+
+    import app as app_module
+
+    try:
+        # Previous behaviour: a new client (and connection pool) per request
+        async def close_client(client):
+            await client.close()
+
+        per_request = await run(
+            app_module.init_openai_client, close_client, args.requests, args.concurrency
+        )
+
+        # Pooled behaviour: one client for the lifetime of the worker
+        pooled_client = await app_module.init_openai_client()
+
+        async def get_pooled_client():
+            return pooled_client
+
+        async def keep_client(client):
+            pass
+
+        pooled = await run(get_pooled_client, keep_client, args.requests, args.concurrency)
+        await pooled_client.close()
+    finally:
+        await runner.cleanup()
+
+    print(f"{args.requests} requests, concurrency {args.concurrency}")
+    summarize("client per request", per_request)
+    summarize("pooled client", pooled)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=20)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,114 @@
+"""
+Compare the CPU time spent per streamed token by the SDK streaming path
+(ChatCompletionChunk objects + format_stream_response) and the raw SSE path
+(AZURE_OPENAI_RAW_STREAM: decoded dicts + format_raw_stream_response).
+
+The upstream stream is served from memory by an httpx mock transport, so the
+numbers are the app's own parsing, formatting and NDJSON encoding cost:
+
+    python tools/benchmarks/raw_stream_cpu.py --tokens 500 --streams 200
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+import httpx
+from openai import AsyncAzureOpenAI
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+from backend.aoai.admission import DeploymentAdmission  # noqa: E402
+from backend.aoai.routing import Deployment, DeploymentRouter  # noqa: E402
+from backend.utils import (  # noqa: E402
+    format_as_ndjson,
+    format_delta_stream,
+    format_raw_stream_response,
+    format_stream_response,
+)
+
+
+def make_sse_body(tokens):
+    def event(delta, finish_reason=None):
+        chunk = {
+            "id": "chatcmpl-" + "x" * 29,
+            "object": "chat.completion.chunk",
+            "created": 1718000000,
+            "model": "gpt-4o",
+            "system_fingerprint": "fp_benchmark",
+            "choices": [
+                {
+                    "index": 0,
+                    "delta": delta,
+                    "logprobs": None,
+                    "finish_reason": finish_reason,
+                    "content_filter_results": {
+                        "hate": {"filtered": False, "severity": "safe"},
+                        "self_harm": {"filtered": False, "severity": "safe"},
+                        "sexual": {"filtered": False, "severity": "safe"},
+                        "violence": {"filtered": False, "severity": "safe"},
+                    },
+                }
+            ],
+        }
+        return f"data: {json.dumps(chunk)}\n\n"
+
+    events = [event({"role": "assistant", "content": ""})]
+    events += [event({"content": " tok"}) for _ in range(tokens)]
+    events += [event({}, "stop"), "data: [DONE]\n\n"]
+    return "".join(events).encode()
+
+
+def make_router(body):
+    def handler(request):
+        return httpx.Response(200, headers={"content-type": "text/event-stream"}, content=body)
+
+    client = AsyncAzureOpenAI(
+        api_key="benchmark",
+        api_version="2024-05-01-preview",
+        azure_endpoint="https://benchmark.openai.azure.com",
+        http_client=httpx.AsyncClient(transport=httpx.MockTransport(handler)),
+        max_retries=0,
+    )
+    return DeploymentRouter([Deployment("benchmark", "benchmark", client, DeploymentAdmission("benchmark"))])
+
+
+async def run(router, streams, raw_stream, delta):
+    format_chunk = format_raw_stream_response if raw_stream else format_stream_response
+    model_args = {"messages": [{"role": "user", "content": "Hello"}], "stream": True}
+    history_metadata = {"conversation_id": "00000000-0000-0000-0000-000000000000"}
+
+    start = time.process_time()
+    for _ in range(streams):
+        response, apim_request_id = await router.create_chat_completion(model_args, raw_stream=raw_stream)
+
+        async def frames():
+            async for chunk in response:
+                yield format_chunk(chunk, history_metadata, apim_request_id)
+
+        result = format_delta_stream(frames()) if delta else frames()
+        async for _line in format_as_ndjson(result):
+            pass
+    return time.process_time() - start
+
+
+async def main(args):
+    router = make_router(make_sse_body(args.tokens))
+    total_tokens = args.tokens * args.streams
+    print(f"{args.streams} streams x {args.tokens} tokens")
+    for stream_format, delta in [("v1", False), ("v2", True)]:
+        sdk = await run(router, args.streams, False, delta)
+        raw = await run(router, args.streams, True, delta)
+        print(
+            f"{stream_format}: SDK chunks {sdk / total_tokens * 1e6:6.1f}us/token, "
+            f"raw SSE {raw / total_tokens * 1e6:6.1f}us/token ({raw / sdk:.0%})"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--tokens", type=int, default=500)
+    parser.add_argument("--streams", type=int, default=200)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,121 @@
+"""
+Measure lookup latency of the semantic cache's in-memory vector index.
+
+Fills the index with random unit vectors (no Azure resources needed) and times
+similarity searches against it, and lookups of questions embedded by a hashing
+stand-in for the embedding deployment:
+
+    python tools/benchmarks/semantic_cache_lookup.py --entries 100000 --dimensions 1536
+"""
+import argparse
+import asyncio
+import hashlib
+import os
+import statistics
+import sys
+import time
+
+import numpy as np
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+from backend.aoai.cache import CachedCompletion  # noqa: E402
+from backend.aoai.semantic_cache import SemanticCache  # noqa: E402
+
+
+def summarize(label, latencies):
+    latencies = sorted(latencies)
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    print(
+        f"{label:<24} mean={statistics.mean(latencies) * 1000:7.2f}ms "
+        f"p50={statistics.median(latencies) * 1000:7.2f}ms "
+        f"p95={p95 * 1000:7.2f}ms"
+    )
+
+
+def random_unit_vectors(rng, count, dimensions):
+    vectors = rng.standard_normal((count, dimensions), dtype=np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+class HashingEmbedder:
+    # Deterministic stand-in for the embedding deployment: each word adds +1 or
+    # -1 to a dimension picked by its hash, so equal questions get equal vectors
+    def __init__(self, dimensions):
+        self.dimensions = dimensions
+
+    async def __call__(self, text):
+        vector = np.zeros(self.dimensions, dtype=np.float32)
+        for word in text.lower().split():
+            value = int.from_bytes(hashlib.blake2b(word.encode(), digest_size=8).digest(), "little")
+            vector[value % self.dimensions] += 1.0 if value >> 63 else -1.0
+        return vector
+
+
+async def main(args):
+    rng = np.random.default_rng(0)
+
+    cache = SemanticCache(HashingEmbedder(args.dimensions), max_entries=args.entries)
+    entry = CachedCompletion("c1", "gpt", 0, "chat.completion", "cached answer")
+
+    start = time.perf_counter()
+    put_latencies = []
+    for batch_start in range(0, args.entries, 10000):
+        batch = random_unit_vectors(rng, min(10000, args.entries - batch_start), args.dimensions)
+        for offset, vector in enumerate(batch):
+            put_start = time.perf_counter()
+            cache.put((batch_start + offset) % args.scopes, vector, entry)
+            put_latencies.append(time.perf_counter() - put_start)
+    fill_seconds = time.perf_counter() - start
+
+    queries = random_unit_vectors(rng, args.lookups, args.dimensions)
+    search_latencies = []
+    for query in queries:
+        search_start = time.perf_counter()
+        cache.search(0, query)
+        search_latencies.append(time.perf_counter() - search_start)
+
+    get_latencies = []
+    for query in queries:
+        get_start = time.perf_counter()
+        await cache.get(0, query)
+        get_latencies.append(time.perf_counter() - get_start)
+
+    # Embedding a question and finding the answer stored for it
+    questions = [f"What is the travel policy for trip number {i}?" for i in range(args.lookups)]
+    for question in questions:
+        cache.put(0, await cache.embed(question), entry)
+    hits = cache.stats.hits
+    embed_get_latencies = []
+    for question in questions:
+        embed_get_start = time.perf_counter()
+        await cache.get(0, await cache.embed(question))
+        embed_get_latencies.append(time.perf_counter() - embed_get_start)
+    assert cache.stats.hits - hits == len(questions)
+
+    # Replacing the least recently used entry once the index is full
+    evict_latencies = []
+    for vector in random_unit_vectors(rng, args.lookups, args.dimensions):
+        evict_start = time.perf_counter()
+        cache.put(0, vector, entry)
+        evict_latencies.append(time.perf_counter() - evict_start)
+
+    index_bytes = cache._vectors.nbytes + cache._scopes.nbytes + cache._last_used.nbytes + cache._stored_at.nbytes
+    print(
+        f"{cache.size} entries x {args.dimensions} dimensions, "
+        f"index {index_bytes / 2**20:.0f} MiB, filled in {fill_seconds:.1f}s"
+    )
+    summarize("put (growing)", put_latencies)
+    summarize("put (evicting LRU)", evict_latencies)
+    summarize("search", search_latencies)
+    summarize("get (off event loop)", get_latencies)
+    summarize("embed (hashed) + get", embed_get_latencies)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--entries", type=int, default=100000)
+    parser.add_argument("--dimensions", type=int, default=1536)
+    parser.add_argument("--scopes", type=int, default=1, help="Number of distinct cache scopes")
+    parser.add_argument("--lookups", type=int, default=200)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,114 @@
+"""
+Count the bytes and frames /conversation sends for a typical streamed answer
+in the original NDJSON format (v1) and the compact delta format (v2), with
+and without coalescing of answer text:
+
+    python tools/benchmarks/stream_format_bytes.py --tokens 500
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import uuid
+from types import SimpleNamespace
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+from backend.utils import (  # noqa: E402
+    coalesce_stream_frames,
+    format_as_ndjson,
+    format_delta_stream,
+    format_stream_response,
+)
+
+WORDS = (
+    "Employees accrue paid time off every pay period based on their years of "
+    "service and may carry over up to five unused days into the next year"
+).split()
+
+
+def make_chunks(tokens, citations):
+    def chunk(delta):
+        return SimpleNamespace(
+            id="chatcmpl-" + "x" * 29,
+            model="gpt-4o",
+            created=1718000000,
+            object="extensions.chat.completion.chunk",
+            choices=[SimpleNamespace(index=0, delta=delta, finish_reason=None)],
+        )
+
+    context = {
+        "citations": [
+            {
+                "content": "Paid time off policy. " * 30,
+                "title": f"Handbook section {i}",
+                "url": f"https://contoso.blob.core.windows.net/docs/handbook-{i}.pdf",
+                "filepath": f"handbook-{i}.pdf",
+                "chunk_id": str(i),
+            }
+            for i in range(citations)
+        ],
+        "intent": '["paid time off carry over"]',
+    }
+    yield chunk(SimpleNamespace(role="assistant", content=None, context=context))
+    for i in range(tokens):
+        # Tokens average about four characters of English text
+        yield chunk(SimpleNamespace(role=None, content=" " + WORDS[i % len(WORDS)][:3]))
+
+
+async def measure(tokens, citations, delta, coalesce):
+    history_metadata = {
+        "conversation_id": str(uuid.uuid4()),
+        "title": "Paid time off carry over",
+        "date": "2024-06-10T12:00:00.000000",
+    }
+    apim_request_id = str(uuid.uuid4())
+
+    async def frames():
+        for chunk in make_chunks(tokens, citations):
+            yield format_stream_response(chunk, history_metadata, apim_request_id)
+
+    result = frames()
+    if coalesce:
+        # Size-bound flushes only, so the result does not depend on timing
+        result = coalesce_stream_frames(result, 3600, 1024)
+    if delta:
+        result = format_delta_stream(result)
+
+    total_bytes = 0
+    total_frames = 0
+    async for line in format_as_ndjson(result):
+        total_bytes += len(line.encode("utf-8"))
+        total_frames += 1
+    return total_bytes, total_frames
+
+
+async def main(args):
+    print(f"{args.tokens}-token answer with {args.citations} citations")
+    baseline = None
+    for label, delta, coalesce in [
+        ("v1, frame per token", False, False),
+        ("v2, frame per token", True, False),
+        ("v1, coalesced", False, True),
+        ("v2, coalesced", True, True),
+    ]:
+        total_bytes, total_frames = await measure(args.tokens, args.citations, delta, coalesce)
+        baseline = baseline or total_bytes
+        print(
+            f"{label:<22} {total_bytes:>8} bytes {total_frames:>5} frames "
+            f"({total_bytes / baseline:6.1%} of v1)"
+        )
+
+    # Answer text alone, for reference
+    text = "".join(
+        chunk.choices[0].delta.content or "" for chunk in make_chunks(args.tokens, 0)
+    )
+    print(f"{'answer text only':<22} {len(json.dumps(text)):>8} bytes")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--tokens", type=int, default=500)
+    parser.add_argument("--citations", type=int, default=5)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,102 @@
+"""
+Measure what tracing adds to a chat turn: the time spent in the tracing
+helpers for the spans of one streamed /conversation request (the request
+span, prepare_model_args, send_chat_request, the upstream call, history
+writes and the emitted stream) with tracing off, with an OpenTelemetry SDK
+provider sampling nothing, and with one recording every span:
+
+    python tools/benchmarks/tracing_overhead.py --requests 20000 --frames 100
+
+The recording provider has no exporter, so export cost (batched on a
+background thread in the app) is not included.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+from opentelemetry.sdk.trace import TracerProvider  # noqa: E402
+from opentelemetry.sdk.trace.sampling import ALWAYS_OFF, ALWAYS_ON  # noqa: E402
+
+from backend import tracing  # noqa: E402
+from backend.tracing import (  # noqa: E402
+    end_request_span,
+    inject_trace_context,
+    set_span_attributes,
+    span,
+    start_request_span,
+    trace_stream,
+)
+
+HEADERS = {"content-type": "application/json"}
+
+
+async def frames(count):
+    for i in range(count):
+        yield i
+
+
+async def chat_turn(frame_count):
+    request_span, token = start_request_span("POST", "/history/generate", HEADERS)
+    for operation in ("read_conversation", "append_message"):
+        with span(f"cosmosdb {operation}"):
+            set_span_attributes({"db.cosmosdb.request_charge": 5.7})
+    with span("send_chat_request"):
+        with span("prepare_model_args"):
+            pass
+        with span("chat gpt-4o"):
+            inject_trace_context({})
+            set_span_attributes({"azure_openai.admission_wait_seconds": 0.0})
+    stream = trace_stream(frames(frame_count), request_span)
+    end_request_span(None, token, 200)
+    async for _ in stream:
+        pass
+
+
+async def best_of(repeat, run):
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await run()
+        seconds.append(time.perf_counter() - start)
+    return min(seconds)
+
+
+async def measure(requests, frame_count, repeat):
+    async def untraced():
+        for _ in range(requests):
+            async for _ in frames(frame_count):
+                pass
+
+    async def traced():
+        for _ in range(requests):
+            await chat_turn(frame_count)
+
+    # Streaming the frames without any tracing is subtracted from every mode
+    baseline = await best_of(repeat, untraced)
+    return (await best_of(repeat, traced) - baseline) / requests
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--frames", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    modes = {
+        "off": None,
+        "sampled out": TracerProvider(sampler=ALWAYS_OFF).get_tracer("benchmark"),
+        "recording": TracerProvider(sampler=ALWAYS_ON).get_tracer("benchmark"),
+    }
+    for name, tracer in modes.items():
+        tracing._tracer = tracer
+        seconds = await measure(args.requests, args.frames, args.repeat)
+        print(f"{name:<12} {seconds * 1e6:8.1f} us per request")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())